@@ -0,0 +1,177 @@
+"""Read-only JSON API for the local catalog, version 1.
+
+    GET /api/v1/products
+    GET /api/v1/brands/<name>
+    GET /api/v1/tags/<name>?tag=Vegan&match=any
+    GET /api/v1/browse?brand=..&product_type=..&tag=..&min_price=..&max_price=..
+
+Query parameters:
+
+- `fields=id,name,api_featured_image` returns only those fields (any of
+  FIELDS; default all)
+- `after=<id>` and `limit=<n>` page through the results by id; the body
+  ends with the URL of the next page
+- `format=ndjson` returns one JSON object per line instead, and without a
+  `limit` streams every match (a full catalog export)
+
+Responses are generated row by row and read from the database a batch
+at a time, so memory stays flat however many products match.
+
+/browse combines any of brand, product_type (both repeatable, OR), tag
+(repeatable, AND) and a price range, and answers with one page of
+listing cards plus facet counts for the other options. It is served from
+the in-memory facet index (facet_index.py), not the database.
+"""
+
+import json
+
+import numpy as np
+from flask import (Blueprint, Response, abort, current_app, jsonify, request,
+                   stream_with_context)
+from sqlalchemy import func
+
+from browse_index import term
+from facet_index import current_facet_index
+from http_cache import cache_policy
+from models import Product, Tag
+from pagination import product_page, next_page_url
+
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+FIELDS = ('id', 'brand', 'name', 'price', 'price_sign', 'image_link',
+          'product_link', 'website_link', 'description', 'rating',
+          'product_type', 'tag_list', 'api_featured_image')
+MAX_LIMIT = 1000
+EXPORT_BATCH = 1000
+
+
+def requested_fields():
+    """The `fields=` projection, or abort(400) on an unknown field."""
+
+    fields = request.args.get('fields')
+    if not fields:
+        return FIELDS
+    fields = tuple(dict.fromkeys(field.strip() for field in fields.split(',')
+                                 if field.strip()))
+    unknown = set(fields) - set(FIELDS)
+    if unknown:
+        abort(400, description=f"unknown fields: {', '.join(sorted(unknown))}")
+    return fields
+
+
+def record(row, fields):
+    """The API shape of one result row (tag_list as a list)."""
+
+    item = {field: getattr(row, field) for field in fields}
+    if 'tag_list' in item:
+        item['tag_list'] = [tag for tag in (item['tag_list'] or '').split(',') if tag]
+    return item
+
+
+def rows(query, after, limit):
+    """Yield rows of `query` by id after `after`, `limit` in total.
+
+    With limit None every row is yielded, fetched EXPORT_BATCH at a time.
+    """
+
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = EXPORT_BATCH if remaining is None else min(remaining, EXPORT_BATCH)
+        page, cursor = product_page(query, after, size)
+        yield from page
+        if cursor is None:
+            return
+        after = cursor
+        if remaining is not None:
+            remaining -= len(page)
+
+
+def products_response(query):
+    """Stream the products of `query` as JSON or NDJSON."""
+
+    fields = requested_fields()
+    after = request.args.get('after', type=int)
+    ndjson = request.args.get('format') == 'ndjson'
+    limit = request.args.get('limit', type=int)
+    if limit is None and not ndjson:
+        limit = current_app.config['PAGE_SIZE']
+    if limit is not None:
+        limit = max(1, min(limit, MAX_LIMIT))
+
+    columns = [getattr(Product, field) for field in ('id',) + fields]
+    query = query.with_entities(*dict.fromkeys(columns))
+
+    if ndjson:
+        def generate():
+            for row in rows(query, after, limit):
+                yield json.dumps(record(row, fields)) + '\n'
+        return Response(stream_with_context(generate()),
+                        mimetype='application/x-ndjson')
+
+    def generate():
+        # fetch one extra row to know whether there is a next page
+        last = None
+        yield '{"data": ['
+        for n, row in enumerate(rows(query, after, limit + 1)):
+            if n == limit:
+                yield '], "next": ' + json.dumps(next_page_url('after', last)) + '}'
+                return
+            yield (', ' if n else '') + json.dumps(record(row, fields))
+            last = row.id
+        yield '], "next": null}'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
+@api.route('/products')
+@cache_policy(per_user=False)
+def products():
+    """Every product."""
+
+    return products_response(Product.query)
+
+
+@api.route('/brands/<name>')
+@cache_policy(per_user=False)
+def brand_products(name):
+    """Products of one brand (case-insensitive)."""
+
+    return products_response(
+        Product.query.filter(func.lower(Product.brand) == term(name)))
+
+
+@api.route('/tags/<name>')
+@cache_policy(per_user=False)
+def tag_products(name):
+    """Products tagged `name` and every extra ?tag= (any of them with
+    match=any)."""
+
+    names = [term(tag) for tag in [name] + request.args.getlist('tag')]
+    match_all = request.args.get('match', 'all') != 'any'
+    return products_response(
+        Product.query.filter(Product.id.in_(Tag.product_ids(names, match_all))))
+
+
+@api.route('/browse')
+@cache_policy(per_user=False)
+def browse():
+    """Products matching every given facet, with counts for each facet."""
+
+    limit = max(1, min(request.args.get('limit', current_app.config['PAGE_SIZE'],
+                                        type=int), MAX_LIMIT))
+    after = request.args.get('after', type=int)
+
+    index = current_facet_index()
+    ids, facets = index.filter(
+        brands=request.args.getlist('brand'),
+        types=request.args.getlist('product_type'),
+        tags=request.args.getlist('tag'),
+        min_price=request.args.get('min_price', type=float),
+        max_price=request.args.get('max_price', type=float))
+
+    start = 0 if after is None else int(np.searchsorted(ids, after, side='right'))
+    page = ids[start:start + limit].tolist()
+    more = start + limit < len(ids)
+    return jsonify(total=len(ids), data=index.cards_for(page), facets=facets,
+                   next=next_page_url('after', page[-1]) if more else None)
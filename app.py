@@ -1,26 +1,68 @@
 import os
-import requests
+import hmac
 import json
+import logging
 import urllib3
 
 
-from flask import Flask, jsonify, Response, render_template, request, flash, redirect, session, g, abort, request
+from flask import (Flask, jsonify, Response, render_template, request, flash,
+                   redirect, session, g, abort, url_for)
 from flask_debugtoolbar import DebugToolbarExtension
+from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy import func, select
+from sqlalchemy.orm import joinedload, load_only
 from sqlalchemy.exc import IntegrityError
 import psycopg2
 
 
 from forms import UserAddForm, LoginForm, ReviewForm, ProfileEditForm, SelectFields
 from models import db, connect_db, User, Review, Favorite, Product, Category, Tag, Brand
+from catalog import catalog_cli, start_background_sync
+from migrations import db_cli
+from cache import make_cache, normalize_key
+from upstream import init_upstream, upstream_client, wait_json, UpstreamError
+from browse_index import current_index, product_card, term, CARD_FIELDS
+from search_index import current_search_index
+from autocomplete import autocomplete_index
+from pagination import product_page, id_page, review_page, next_page_url
+from instrumentation import init_instrumentation, query_budget
+from http_cache import init_http_cache, cache_policy
+from api import api
+from snapshots import stored_values
+from passwords import init_passwords, limit_attempts, password_stats
+from sessions import init_sessions, rotate_session, sessions_cli
+from images import init_images
+from recommendations import (recommendations_cli, mark_stale, neighbor_ids,
+                             start_background_refresh)
+from current_user import (configure_user_cache, load_current_user,
+                          remember_user, profile_changed, forget_user,
+                          user_cache)
+from favorites import (configure_favorites_cache, favorite_ids, favorite_sets,
+                       add_favorites, remove_favorites, toggle_favorite)
 
 
 CURR_USER_KEY = "curr_user"
+CURR_USER_VERSION_KEY = "curr_user_version"
 
 app = Flask(__name__)
 
+# `flask run --debug` sets FLASK_DEBUG; SQL echo and the toolbar are dev-only.
+DEV = os.environ.get('FLASK_DEBUG', '').lower() in ('1', 'true')
+
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+if not DEV:
+    # SQLAlchemy logs every statement at INFO; slow ones are logged by
+    # instrumentation.py instead.
+    logging.getLogger('sqlalchemy.engine').setLevel(logging.WARNING)
+
 secretskey = os.environ.get('KEY')
 
-API_URL = 'http://makeup-api.herokuapp.com/api/v1/products.json'
+# MAKEUP_API_URL points the app at another copy of the API (e.g. the
+# benchmark stub).
+API_BASE_URL = os.environ.get('MAKEUP_API_URL',
+                              'http://makeup-api.herokuapp.com/api/v1')
+API_URL = f'{API_BASE_URL}/products.json'
+PRODUCT_API_URL = API_BASE_URL + '/products/{}.json'
 
 # Get DB_URI from environ variable (useful for production/testing) or,
 # if not set there, use development local db.
@@ -28,25 +70,182 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL'))
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
+app.config['SQLALCHEMY_ECHO'] = DEV
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-debug = DebugToolbarExtension(app)
+
+# Catalog mirror: CATALOG_SOURCE may be the API url or a local JSON file.
+app.config['CATALOG_SOURCE'] = os.environ.get('CATALOG_SOURCE', API_URL)
+app.config['CATALOG_SYNC_INTERVAL'] = int(
+    os.environ.get('CATALOG_SYNC_INTERVAL', 0))
+app.config['CATALOG_SYNC_TIMEOUT'] = float(
+    os.environ.get('CATALOG_SYNC_TIMEOUT', 30))
+app.config['CATALOG_STALE_AFTER'] = int(
+    os.environ.get('CATALOG_STALE_AFTER', 24 * 60 * 60))
+
+# Cache for brand / product_type / product_tags queries to the API.
+# Use the 'file' backend to share one fill between gunicorn workers.
+app.config['UPSTREAM_CACHE_BACKEND'] = os.environ.get(
+    'UPSTREAM_CACHE_BACKEND', 'memory')
+app.config['UPSTREAM_CACHE_DIR'] = os.environ.get(
+    'UPSTREAM_CACHE_DIR', '/tmp/makeupfinder-cache')
+app.config['UPSTREAM_CACHE_TTL'] = int(
+    os.environ.get('UPSTREAM_CACHE_TTL', 15 * 60))
+app.config['UPSTREAM_CACHE_MAX_ENTRIES'] = int(
+    os.environ.get('UPSTREAM_CACHE_MAX_ENTRIES', 512))
+
+# HTTP client for the makeup API; the pool is per gunicorn worker.
+app.config['UPSTREAM_POOL_SIZE'] = int(
+    os.environ.get('UPSTREAM_POOL_SIZE', 10))
+app.config['UPSTREAM_CONNECT_TIMEOUT'] = float(
+    os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 3.05))
+app.config['UPSTREAM_READ_TIMEOUT'] = float(
+    os.environ.get('UPSTREAM_READ_TIMEOUT', 10))
+app.config['UPSTREAM_RETRIES'] = int(os.environ.get('UPSTREAM_RETRIES', 2))
+app.config['UPSTREAM_BACKOFF'] = float(
+    os.environ.get('UPSTREAM_BACKOFF', 0.25))
+app.config['UPSTREAM_BREAKER_THRESHOLD'] = int(
+    os.environ.get('UPSTREAM_BREAKER_THRESHOLD', 5))
+app.config['UPSTREAM_BREAKER_RESET'] = float(
+    os.environ.get('UPSTREAM_BREAKER_RESET', 30))
+# Most concurrent fetches per worker when a page needs several products.
+app.config['UPSTREAM_FANOUT'] = int(os.environ.get('UPSTREAM_FANOUT', 8))
+if DEV:
+    toolbar = DebugToolbarExtension(app)
 with app.app_context():
     connect_db(app)
 
+# Seconds between checks for catalog changes to fold into the browse index.
+app.config['BROWSE_INDEX_REFRESH'] = float(
+    os.environ.get('BROWSE_INDEX_REFRESH', 30))
+app.config['SEARCH_PAGE_SIZE'] = int(os.environ.get('SEARCH_PAGE_SIZE', 24))
+app.config['AUTOCOMPLETE_MAX_AGE'] = int(
+    os.environ.get('AUTOCOMPLETE_MAX_AGE', 300))
+
+# Listing page sizes (keyset pagination, see pagination.py)
+app.config['PAGE_SIZE'] = int(os.environ.get('PAGE_SIZE', 48))
+app.config['REVIEW_PAGE_SIZE'] = int(os.environ.get('REVIEW_PAGE_SIZE', 20))
+
+# Fail any request that runs more SQL statements than this (set in tests).
+app.config['SQL_QUERY_BUDGET'] = (int(os.environ['SQL_QUERY_BUDGET'])
+                                  if os.environ.get('SQL_QUERY_BUDGET') else None)
+
+# Log statements slower than this; add a Server-Timing header to responses.
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 100))
+app.config['SERVER_TIMING'] = os.environ.get(
+    'SERVER_TIMING', '1').lower() in ('1', 'true')
+# /_cache_stats is open in development; elsewhere it needs this token as
+# "Authorization: Bearer <token>" (and 404s without one configured).
+app.config['STATS_TOKEN'] = os.environ.get('STATS_TOKEN')
+
+# Per-worker cache of logged-in user snapshots (see current_user.py). The
+# TTL bounds how long another worker can show an old profile or favorites.
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 1024))
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 30))
+configure_user_cache(app.config)
+configure_favorites_cache(app.config)
+
+# Browser/CDN caching of catalog pages (see http_cache.py) and response
+# compression for bodies of at least COMPRESS_MIN_SIZE bytes.
+app.config['CATALOG_PAGE_MAX_AGE'] = int(
+    os.environ.get('CATALOG_PAGE_MAX_AGE', 5 * 60))
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+PAGE_MAX_AGE = app.config['CATALOG_PAGE_MAX_AGE']
+
+# Rendered catalog pages; 'file' shares them between gunicorn workers.
+app.config['PAGE_CACHE_BACKEND'] = os.environ.get('PAGE_CACHE_BACKEND', 'memory')
+app.config['PAGE_CACHE_DIR'] = os.environ.get(
+    'PAGE_CACHE_DIR', '/tmp/makeupfinder-pages')
+app.config['PAGE_CACHE_TTL'] = int(os.environ.get('PAGE_CACHE_TTL', 60 * 60))
+app.config['PAGE_CACHE_MAX_ENTRIES'] = int(
+    os.environ.get('PAGE_CACHE_MAX_ENTRIES', 2048))
+
+# bcrypt cost and the pool that runs it (see passwords.py). Logins past
+# the queue or the rate limit get a 429 rather than tying up the worker.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_WORKERS'] = int(os.environ.get('PASSWORD_WORKERS', 1))
+app.config['PASSWORD_MAX_PENDING'] = int(
+    os.environ.get('PASSWORD_MAX_PENDING', 4))
+app.config['PASSWORD_TIMEOUT'] = float(os.environ.get('PASSWORD_TIMEOUT', 5))
+app.config['LOGIN_RATE_LIMIT'] = int(os.environ.get('LOGIN_RATE_LIMIT', 10))
+app.config['LOGIN_RATE_WINDOW'] = int(os.environ.get('LOGIN_RATE_WINDOW', 60))
+
+# Proxies in front of the app (Render's router is one). Their
+# X-Forwarded-For entries become request.remote_addr, so the login limit
+# counts clients rather than the proxy; 0 if clients connect directly.
+app.config['PROXY_FIX_X_FOR'] = int(os.environ.get('PROXY_FIX_X_FOR', 1))
+if app.config['PROXY_FIX_X_FOR']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+
+# Where session data lives (see sessions.py): 'database' (shared by all
+# workers), 'memory' (this worker only) or 'cookie' (Flask's default).
+app.config['SESSION_BACKEND'] = os.environ.get('SESSION_BACKEND', 'database')
+app.config['SESSION_SWEEP_INTERVAL'] = int(
+    os.environ.get('SESSION_SWEEP_INTERVAL', 5 * 60))
+app.config['SESSION_SWEEP_BATCH'] = int(
+    os.environ.get('SESSION_SWEEP_BATCH', 500))
+# Per-worker copy of the session rows it used; the TTL bounds how long a
+# logout through another worker can go unseen here (0 to always query).
+app.config['SESSION_CACHE_SIZE'] = int(
+    os.environ.get('SESSION_CACHE_SIZE', 1024))
+app.config['SESSION_CACHE_TTL'] = int(os.environ.get('SESSION_CACHE_TTL', 5))
+
+# "Also favorited" products kept per product (see recommendations.py).
+app.config['RECOMMENDATIONS_TOP_K'] = int(
+    os.environ.get('RECOMMENDATIONS_TOP_K', 12))
+# How often rows marked stale by favorite changes are recomputed (0: only
+# by `flask recommendations refresh`).
+app.config['RECOMMENDATIONS_REFRESH_INTERVAL'] = int(
+    os.environ.get('RECOMMENDATIONS_REFRESH_INTERVAL', 60))
+
+# Product image thumbnails served from /img (see images.py).
+app.config['IMAGE_CACHE_DIR'] = os.environ.get(
+    'IMAGE_CACHE_DIR', '/tmp/makeupfinder-images')
+app.config['IMAGE_CACHE_MAX_BYTES'] = int(
+    os.environ.get('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+app.config['IMAGE_MAX_SOURCE_BYTES'] = int(
+    os.environ.get('IMAGE_MAX_SOURCE_BYTES', 10 * 1024 * 1024))
+app.config['IMAGE_QUALITY'] = int(os.environ.get('IMAGE_QUALITY', 80))
+app.config['IMAGE_MAX_AGE'] = int(os.environ.get('IMAGE_MAX_AGE', 24 * 60 * 60))
+
+init_upstream(app)
+init_passwords(app)
+init_instrumentation(app)
+app.cli.add_command(catalog_cli)
+app.cli.add_command(db_cli)
+app.cli.add_command(sessions_cli)
+app.cli.add_command(recommendations_cli)
+session_store = init_sessions(app)
+image_cache = init_images(app)
+upstream_cache = make_cache(app.config, 'UPSTREAM_CACHE')
+if app.config['CATALOG_SYNC_INTERVAL']:
+    start_background_sync(app, app.config['CATALOG_SYNC_INTERVAL'])
+if app.config['RECOMMENDATIONS_REFRESH_INTERVAL']:
+    start_background_refresh(app, app.config['RECOMMENDATIONS_REFRESH_INTERVAL'])
+
 
 #############################################################
-toolbar = DebugToolbarExtension(app)
 # User signup/login/logout
 
 
+# Endpoints that never show who is logged in: skip the session lookup.
+ANONYMOUS_ENDPOINTS = {'static', 'images.thumbnail', 'autocomplete'}
+
+
 @app.before_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    if request.endpoint in ANONYMOUS_ENDPOINTS:
+        g.user = None
+    elif CURR_USER_KEY in session:
+        g.user = load_current_user(session[CURR_USER_KEY],
+                                   session.get(CURR_USER_VERSION_KEY))
+        if g.user is None:
+            do_logout()
+        elif session.get(CURR_USER_VERSION_KEY) != g.user.profile_version:
+            session[CURR_USER_VERSION_KEY] = g.user.profile_version
 
     else:
         g.user = None
@@ -55,7 +254,11 @@ def add_user_to_g():
 def do_login(user):
     """Log in user."""
 
+    rotate_session(session)
     session[CURR_USER_KEY] = user.id
+    session[CURR_USER_VERSION_KEY] = user.profile_version
+    # the row was just read; don't let an older snapshot stand in for it
+    remember_user(user)
 
 
 def do_logout():
@@ -63,6 +266,37 @@ def do_logout():
 
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
+    session.pop(CURR_USER_VERSION_KEY, None)
+
+
+def current_favorites():
+    """Product ids the logged-in user has favorited (empty if anonymous)."""
+
+    if not g.user:
+        return frozenset()
+    return favorite_ids(g.user.id, g.user.favorites_version)
+
+
+def favorites_changed(product_ids):
+    """After the logged-in user's favorites of `product_ids` changed.
+
+    Marks the similar products of `product_ids` for recomputing and
+    reloads g.user, whose favorites_version the change bumped.
+    """
+
+    mark_stale(db.session.connection(), g.user.id, product_ids)
+    db.session.commit()
+    g.user = load_current_user(g.user.id, g.user.profile_version)
+
+
+def page_user_state():
+    """What a cacheable page's ETag varies with for a logged-in user."""
+
+    return g.user.id, g.user.profile_version, g.user.favorites_version
+
+
+page_cache = init_http_cache(app, page_user_state)
+app.register_blueprint(api)
 
 
 @app.route('/signup', methods=["GET", "POST"])
@@ -80,6 +314,7 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        limit_attempts()
         try:
             user = User.signup(
                 username=form.username.data,
@@ -108,10 +343,13 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
+        limit_attempts(form.username.data)
         user = User.authenticate(form.username.data,
                                  form.password.data)
 
         if user:
+            # saves the password if it was rehashed at a new cost
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -156,38 +394,36 @@ def list_users():
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
-
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    reviews = (Review
-               .query
-               .filter(Review.user_id == user_id)
-               .order_by(Review.timestamp.desc())
-               .limit(100)
-               .all())
+    user = db.get_or_404(User, user_id)
 
-    liked_favorites = [product.id for product in g.user.favorites]
+    # the template only shows how many; count them rather than load them
+    review_count = db.session.scalar(
+        select(func.count()).where(Review.user_id == user_id))
+    favorite_count = db.session.scalar(
+        select(func.count()).where(Favorite.user_id == user_id))
 
-    return render_template('users/show.html', user=user,  reviews=reviews, favorites=liked_favorites)
+    return render_template('users/show.html', user=user,
+                           review_count=review_count,
+                           favorite_count=favorite_count,
+                           favorites=current_favorites())
 
 
 @app.route('/users/<int:user_id>/reviews')
 def reviews_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    reviews = (Review
-               .query
-               .filter(Review.user_id == user_id)
-               .order_by(Review.timestamp.desc())
-               .limit(100)
-               .all())
+    reviews, cursor = review_page(Review.query
+                                  .options(joinedload(Review.user))
+                                  .filter(Review.user_id == user_id),
+                                  request.args.get('before'),
+                                  app.config['REVIEW_PAGE_SIZE'])
 
-    return render_template('reviews/show.html', user=user,  reviews=reviews)
+    return render_template('reviews/show.html', user=user,  reviews=reviews,
+                           next_url=next_page_url('before', cursor))
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
@@ -203,14 +439,15 @@ def profile():
     form = ProfileEditForm(obj=user)
 
     if form.validate_on_submit():
-        if User.authenticate(user.username, form.password.data):
-            profile.username = form.username.data
-            profile.email = form.email.data
-            profile.image_url = form.image_url.data
-            profile.header_image_url = form.header_image_url.data
-            profile.bio = form.email.data
+        limit_attempts(user.username)
+        if user.orm.check_password(form.password.data):
+            user.username = form.username.data
+            user.email = form.email.data
+            user.image_url = form.image_url.data or None
+            profile_changed(user.orm)
 
             db.session.commit()
+            session[CURR_USER_VERSION_KEY] = user.orm.profile_version
 
             return redirect(f"/users/{g.user.id}")
 
@@ -227,20 +464,27 @@ def show_favorites(user_id):
         flash("Please Register or Login!", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
     favorites = (Favorite
                  .query
                  .filter(Favorite.user_id == user_id)
                  .limit(100)
                  .all())
-    res = requests.get(
-        f'http://makeup-api.herokuapp.com/api/v1/products.json')
-    products_data = res.json()
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
+    product_ids = [fav.product_id for fav in favorites]
+
+    user = db.get_or_404(User, user_id)
+    products_data = {product.id: product.to_dict() for product in
+                     Product.query.filter(Product.id.in_(product_ids))}
+
+    # only products missing from the local catalog are asked of the API,
+    # all at once
+    client = upstream_client()
+    missing = [product_id for product_id in product_ids
+               if product_id not in products_data]
+    pending = [client.submit_json(PRODUCT_API_URL.format(product_id))
+               for product_id in missing]
+    for product_id, record in zip(missing, wait_json(pending)):
+        products_data[product_id] = (None if isinstance(record, Exception)
+                                     else record)
 
     return render_template('users/favorites.html', user=user, favorites=favorites, products_data=products_data)
 
@@ -255,8 +499,9 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    db.session.delete(g.user.orm)
     db.session.commit()
+    forget_user(g.user.id)
 
     return redirect("/signup")
 
@@ -277,7 +522,7 @@ def reviews_add(product_id):
 
     form = ReviewForm()
 
-    product = Product.query.get_or_404(product_id)
+    product = db.get_or_404(Product, product_id)
 
     if form.validate_on_submit():
         new_review = Review(text=request.form['text'],
@@ -301,7 +546,7 @@ def reviews_delete(review_id, product_id):
         flash("Please Register or Login!", "danger")
         return redirect("/")
 
-    review = Review.query.get_or_404(review_id)
+    review = db.get_or_404(Review, review_id)
     if review.user_id != g.user.id:
         flash("Access unauthorized.", "danger")
         return redirect("/")
@@ -316,33 +561,55 @@ def reviews_delete(review_id, product_id):
 
 
 @app.route('/products', methods=["GET"])
+@cache_policy(PAGE_MAX_AGE)
 def products_show():
+    """All products, a page at a time: /products?after=<last id>"""
 
-    products = Product.query.all()
+    products, cursor = product_page(Product.query,
+                                    request.args.get('after', type=int),
+                                    app.config['PAGE_SIZE'])
 
-    res = requests.get(
-        f'http://makeup-api.herokuapp.com/api/v1/products.json')
-    show_products = res.json()
-
-    return render_template("products/show.html", products=products, show_products=show_products)
+    return render_template("products/show.html", products=products,
+                           favorites=current_favorites(),
+                           next_url=next_page_url('after', cursor))
 
 
 @app.route('/products/<int:product_id>', methods=['GET', 'POST'])
 def get_product_id(product_id):
     """Show a id product."""
 
-    product = Product.query.get_or_404(product_id)
-
-    res = requests.get(
-        f'http://makeup-api.herokuapp.com/api/v1/products/{product_id}.json')
-    product_unique = res.json()
-
-    reviews = (Review
+    product = (Product
                .query
-               .filter(Review.product_id == product_id)
-               .order_by(Review.timestamp.desc())
-               .limit(100)
-               .all())
+               .options(joinedload(Product.snapshot),
+                        joinedload(Product.neighbors))
+               .filter(Product.id == product_id)
+               .first_or_404())
+
+    # price, rating and links as of the last catalog sync
+    product_unique = product.to_dict()
+    pending = None
+    if product.snapshot is not None:
+        product_unique.update(stored_values(product.snapshot))
+    else:
+        # not synced since snapshots were added: ask the API while the
+        # reviews load
+        pending = upstream_client().submit_json(
+            PRODUCT_API_URL.format(product_id))
+
+    # listing cards from the browse index, so no further SQL
+    similar = current_index().cards_for(neighbor_ids(product.neighbors))
+
+    reviews, cursor = review_page(Review.query
+                                  .options(joinedload(Review.user))
+                                  .filter(Review.product_id == product_id),
+                                  request.args.get('before'),
+                                  app.config['REVIEW_PAGE_SIZE'])
+
+    if pending is not None:
+        [fetched] = wait_json([pending])
+        # an unreachable API or a body that isn't JSON: keep the local row
+        if not isinstance(fetched, Exception):
+            product_unique = fetched
 
     form = ReviewForm()
 
@@ -363,10 +630,20 @@ def get_product_id(product_id):
         return redirect(f"/products/{product_id}")
     else:
 
-        return render_template('products/index.html', reviews=reviews, product_unique=product_unique, product=product, form=form)
+        return render_template('products/index.html', reviews=reviews,
+                               product_unique=product_unique, product=product,
+                               form=form, favorites=current_favorites(),
+                               similar=similar,
+                               next_url=next_page_url('before', cursor))
+
+
+# the writes, the version bump, marking similar products stale
+# (recommendations.py) and reloading the user
+FAVORITES_WRITE_BUDGET = 8
 
 
 @app.route('/products/<int:product_id>/favorite', methods=['POST'])
+@query_budget(FAVORITES_WRITE_BUDGET)
 def add_favorite(product_id):
     """Toggle a favorite message for the currently-logged-in user."""
 
@@ -374,89 +651,216 @@ def add_favorite(product_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    favorite_product = Product.query.get_or_404(product_id)
-
-    user_favorites = g.user.favorites
-
-    if favorite_product in user_favorites:
-        g.user.favorites = [
-            favorite for favorite in user_favorites if favorite != favorite_product]
-        flash(f"Removed from your favorites!")
-    else:
-        g.user.favorites.append(favorite_product)
+    favorited = toggle_favorite(g.user.id, product_id)
+    if favorited is None:
+        abort(404)
+    if favorited:
         flash(f"Added to your favorites!")
+    else:
+        flash(f"Removed from your favorites!")
     db.session.commit()
+    favorites_changed([product_id])
 
     return redirect(f"/products/{product_id}")
 
+
+##############################################################################
+# Favorites JSON API
+
+
+def requested_ids(data, key):
+    """The list of integer ids under `key` in a JSON body, or abort(400)."""
+
+    ids = data.get(key, [])
+    if not isinstance(ids, list) or not all(
+            isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        abort(400, description=f"'{key}' must be a list of product ids")
+    return ids
+
+
+@app.route('/api/favorites', methods=['GET', 'POST'])
+@query_budget(FAVORITES_WRITE_BUDGET)
+def api_favorites():
+    """The logged-in user's favorite product ids.
+
+    POST {"add": [1048, 1047], "remove": [495]} changes several at once
+    and answers with what was added and removed plus the new set.
+    """
+
+    if not g.user:
+        return jsonify(error="login required"), 401
+
+    if request.method == 'GET':
+        return jsonify(favorites=sorted(current_favorites()))
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400, description="expected a JSON object")
+    add, remove = requested_ids(data, 'add'), requested_ids(data, 'remove')
+
+    added = add_favorites(g.user.id, set(add) - set(remove))
+    removed = remove_favorites(g.user.id, remove)
+    db.session.commit()
+    if added or removed:
+        favorites_changed(added | removed)
+
+    return jsonify(added=sorted(added), removed=sorted(removed),
+                   favorites=sorted(current_favorites()))
+
+
+@app.route('/api/favorites/<int:product_id>', methods=['POST'])
+@query_budget(FAVORITES_WRITE_BUDGET)
+def api_toggle_favorite(product_id):
+    """Toggle one favorite; answers {"product_id": ..., "favorited": ...}."""
+
+    if not g.user:
+        return jsonify(error="login required"), 401
+
+    favorited = toggle_favorite(g.user.id, product_id)
+    if favorited is None:
+        return jsonify(error="no such product"), 404
+    db.session.commit()
+    favorites_changed([product_id])
+
+    return jsonify(product_id=product_id, favorited=favorited)
+
+
+def local_products(field, value):
+    """Products from the local catalog matching an API filter."""
+
+    value = value.replace('+', ' ').strip().lower()
+    if field == 'brand':
+        query = Product.query.filter(func.lower(Product.brand) == value)
+    elif field == 'product_type':
+        query = Product.query.filter(
+            func.lower(Product.product_type) == value.replace(' ', '_'))
+    else:
+        query = Product.query.filter(
+            func.lower(Product.tag_list).like(f"%{value}%"))
+    return [product.to_dict() for product in query.order_by(Product.id)]
+
+
+def upstream_products(field, value):
+    """Products from the API filtered on `field`, e.g. brand=Almay.
+
+    Responses are cached on the case-folded query, and concurrent misses
+    for the same query share a single upstream request. If the API is
+    unavailable the local catalog answers instead (and isn't cached).
+    """
+
+    def fetch():
+        return upstream_client().get_json(
+            API_URL, params={field: value.replace('+', ' ')})
+
+    try:
+        return upstream_cache.get_or_fill(normalize_key(field, value), fetch)
+    except UpstreamError:
+        return local_products(field, value)
+
+
+def browse_products(field, values, api_field):
+    """One page of product cards where `field` matches all `values`.
+
+    Served from the in-memory browse index; until the catalog has been
+    synced the API answers the first value instead.
+
+    Returns (cards, next page url).
+    """
+
+    after = request.args.get('after', type=int)
+    size = app.config['PAGE_SIZE']
+
+    index = current_index()
+    if not len(index):
+        cards = {item['id']: item
+                 for item in upstream_products(api_field, values[0])}
+        ids, cursor = id_page(sorted(cards), after, size)
+        return [cards[product_id] for product_id in ids], next_page_url('after', cursor)
+
+    ids, cursor = id_page(index.all_of(field, values), after, size)
+    return index.cards_for(ids), next_page_url('after', cursor)
+
 ##############################################################################
 # Categories
 
 
 @app.route('/categories', methods=["GET"])
+@cache_policy(PAGE_MAX_AGE)
 def all_categories():
     """Show all brands."""
-    products = Product.query.all()
-    return render_template('categories/show.html', products=products)
+    return render_template('categories/show.html')
 
 
 @app.route('/categories/<string:name>', methods=["GET"])
+@cache_policy(PAGE_MAX_AGE)
 def each_category(name):
     """Show each brand name."""
-    res = requests.get(
-        f'http://makeup-api.herokuapp.com/api/v1/products.json?product_type={name}')
-    category_data = res.json()
+    category_data, next_url = browse_products('product_type', [name], 'product_type')
 
     # if this is keyword is not in api, return "none"
 
-    return render_template('categories/index.html', name=name, category_data=category_data)
+    return render_template('categories/index.html', name=name, category_data=category_data, next_url=next_url)
 
 ##############################################################################
 # Brand
 
 
 @app.route('/brands', methods=["GET"])
+@cache_policy(PAGE_MAX_AGE)
 def all_brands():
     """Show all brands."""
-    products = Product.query.all()
 
-    return render_template('brands/show.html', products=products)
+    return render_template('brands/show.html')
 
 
 @app.route('/brands/<string:name>', methods=["GET"])
+@cache_policy(PAGE_MAX_AGE)
 def each_brand(name):
     """Show each brand name."""
-    res = requests.get(
-        f'http://makeup-api.herokuapp.com/api/v1/products.json?brand={name}')
-    brand_data = res.json()
+    brand_data, next_url = browse_products('brand', [name], 'brand')
 
     # if this is keyword is not in api, return "none"
 
-    return render_template('brands/index.html', name=name, brand_data=brand_data)
+    return render_template('brands/index.html', name=name, brand_data=brand_data, next_url=next_url)
 
 ##############################################################################
 # Tags
 
 
 @app.route('/tags', methods=["GET"])
+@cache_policy(PAGE_MAX_AGE)
 def all_tags():
     """Show tags."""
 
-    products = Product.query.all()
-
-    return render_template('tags/show.html', products=products)
+    return render_template('tags/show.html')
 
 
 @app.route('/tags/<string:name>', methods=["GET"])
+@cache_policy(PAGE_MAX_AGE)
 def each_tag(name):
-    """Show tags."""
-    res = requests.get(
-        f'http://makeup-api.herokuapp.com/api/v1/products.json?product_tags={name}')
-    tag_data = res.json()
+    """Show tags.
 
-    products = Product.query.all()
+    Extra ?tag= args combine tags: /tags/Vegan?tag=cruelty+free is
+    products tagged Vegan AND cruelty free; add &match=any for OR.
+    """
+    names = [term(tag) for tag in [name] + request.args.getlist('tag')]
+    match_all = request.args.get('match', 'all') != 'any'
 
-    return render_template('tags/index.html', name=name, tag_data=tag_data, products=products)
+    if not len(current_index()):
+        # catalog not synced yet: ask the API
+        tag_data, next_url = browse_products('tag', names, 'product_tags')
+    else:
+        products, cursor = product_page(
+            Product.query
+            .options(load_only(*(getattr(Product, field) for field in CARD_FIELDS)))
+            .filter(Product.id.in_(Tag.product_ids(names, match_all))),
+            request.args.get('after', type=int),
+            app.config['PAGE_SIZE'])
+        tag_data = [product_card(product) for product in products]
+        next_url = next_page_url('after', cursor)
+
+    joiner = ' & ' if match_all else ' or '
+    return render_template('tags/index.html', name=joiner.join(names), tag_data=tag_data, next_url=next_url)
 
 
 ##############################################################################
@@ -464,28 +868,71 @@ def each_tag(name):
 
 ##############################################################################
 # Search
+@app.route('/search', methods=["GET"])
+@cache_policy(PAGE_MAX_AGE)
+def search():
+    """Ranked product search: /search?q=lipstick&page=2"""
+
+    q = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    page_size = app.config['SEARCH_PAGE_SIZE']
+
+    index = current_search_index()
+    hits = index.search(q) if q else []
+    start = (page - 1) * page_size
+    products = index.cards_for(
+        [product_id for product_id, score in hits[start:start + page_size]])
+
+    return render_template('results.html', products=products, q=q, page=page,
+                           total=len(hits), has_next=start + page_size < len(hits))
+
+
 @app.route('/results', methods=["GET"])
 def search_result():
-    """Show results."""
-    res = requests.get(
-        f'http://makeup-api.herokuapp.com/api/v1/products.json')
-    products = res.json()
+    """Old results page; now the same as /search."""
 
-    # if this is keyword is not in api, return "none"
+    return redirect(url_for('search', **request.args))
+
+
+@app.route('/_cache_stats', methods=['GET'])
+def cache_stats():
+    """Hit / miss / eviction counters for this worker's caches."""
+
+    token = app.config['STATS_TOKEN']
+    if not DEV:
+        if not token:
+            abort(404)
+        sent = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(sent.encode(), f'Bearer {token}'.encode()):
+            abort(401)
 
-    return render_template('results.html',  products=products)
+    breaker = upstream_client().breaker
+    return jsonify(upstream=upstream_cache.stats(),
+                   users=user_cache.stats(),
+                   favorites=favorite_sets.stats(),
+                   pages=page_cache.stats(),
+                   passwords=password_stats(),
+                   sessions=session_store.stats() if session_store else None,
+                   images=image_cache.stats(),
+                   circuit_breaker={'state': breaker.state,
+                                    'failures': breaker.failures})
 
 
 ##############################################################################
 # Homepage and error pages
 @app.route('/_autocomplete', methods=['GET'])
-def autocomplete():  # can use for autocomplete
+@cache_policy(app.config['AUTOCOMPLETE_MAX_AGE'], per_user=False)
+def autocomplete():
+    """Completions for the search box: /_autocomplete?prefix=li&limit=10"""
 
-    words = ["lipstick", "blush", "pencil", "eyeshadow", "lip liner", "foundation", "eyeliner",
-             "bronzer", "eyeliner", "bronzer", "eyebrow", "mascara", "nail polish", "bronzer"]
+    prefix = request.args.get('prefix', '')
+    limit = request.args.get('limit', 10, type=int)
+
+    words = autocomplete_index.refresh(app).complete(prefix, limit)
     return Response(json.dumps(words), mimetype='application/json')
 
 
+# not cacheable: the search form carries the session's CSRF token
 @app.route('/', methods=['GET', 'POST'])
 def homepage():
     """Show homepage:
@@ -500,29 +947,10 @@ def homepage():
         name = form.name.data
         return redirect(f'/tags/{name}')
 
-    products = Product.query.all()
-    return render_template("home.html", form=form, products=products)
-
-##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-
-@ app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+    return render_template("home.html", form=form)
 
 
-@ app.errorhandler(404)
+@app.errorhandler(404)
 def not_found(e):
     """404 error page"""
 
@@ -0,0 +1,153 @@
+"""Prefix completions for the search box.
+
+Phrases are product names, brands, product types and tags from the
+browse index. Each phrase is filed under every word it contains, in a
+sorted array, so "pen" finds "Lippie Pencil" with a binary search.
+Completions are ranked by popularity: how many products carry a
+brand / type / tag, or how many users favorited a product.
+
+Top results for one- and two-letter prefixes are precomputed, since
+those match the most phrases and are typed on every keystroke.
+"""
+
+import heapq
+import logging
+import threading
+from bisect import bisect_left
+from collections import namedtuple
+
+from sqlalchemy import func
+
+from browse_index import current_index
+from models import db, Favorite
+
+
+logger = logging.getLogger(__name__)
+
+MAX_LIMIT = 20
+PRECOMPUTED_PREFIX_LEN = 2
+
+
+# One build's arrays; replaced as a whole so readers never mix builds.
+Completions = namedtuple('Completions',
+                         'keys phrase_ids phrases popularity top version')
+
+
+class Autocomplete:
+    """Sorted (word-start key, phrase id) arrays with popularity ranks."""
+
+    def __init__(self):
+        self.completions = Completions([], [], [], [], {}, None)
+        self._building = False
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        return self.completions.version
+
+    def build(self, phrases, version=None):
+        """Index `phrases`, a dict of phrase -> popularity."""
+
+        texts = list(phrases)
+        popularity = [phrases[text] for text in texts]
+        entries = []
+        for phrase_id, text in enumerate(texts):
+            words = text.casefold().split()
+            for i in range(len(words)):
+                entries.append((' '.join(words[i:]), phrase_id))
+        entries.sort()
+
+        top = {}
+        for key, phrase_id in entries:
+            for length in range(1, PRECOMPUTED_PREFIX_LEN + 1):
+                if len(key) >= length:
+                    top.setdefault(key[:length], set()).add(phrase_id)
+        top = {prefix: heapq.nlargest(MAX_LIMIT, ids,
+                                      key=lambda i: (popularity[i], -i))
+               for prefix, ids in top.items()}
+
+        # One reference swap: readers only ever see a complete build.
+        self.completions = Completions([key for key, _ in entries],
+                                       [phrase_id for _, phrase_id in entries],
+                                       texts, popularity, top, version)
+
+    def complete(self, prefix, limit=10):
+        """Up to `limit` phrases with a word starting with `prefix`."""
+
+        prefix = ' '.join(prefix.casefold().split())
+        limit = max(1, min(limit, MAX_LIMIT))
+        completions = self.completions
+        phrases, popularity = completions.phrases, completions.popularity
+
+        if not prefix:
+            ids = heapq.nlargest(limit, range(len(phrases)),
+                                 key=lambda i: (popularity[i], -i))
+        elif len(prefix) <= PRECOMPUTED_PREFIX_LEN:
+            ids = completions.top.get(prefix, [])[:limit]
+        else:
+            keys, phrase_ids = completions.keys, completions.phrase_ids
+            found = set()
+            i = bisect_left(keys, prefix)
+            while i < len(keys) and keys[i].startswith(prefix):
+                found.add(phrase_ids[i])
+                i += 1
+            ids = heapq.nlargest(limit, found,
+                                 key=lambda i: (popularity[i], -i))
+        return [phrases[i] for i in ids]
+
+    def rebuild_from(self, index):
+        """Rebuild from the browse index's brands, types, tags and names."""
+
+        phrases = {}
+        for field in ('brand', 'product_type', 'tag'):
+            for phrase, count in index.keys(field).items():
+                phrases[phrase] = phrases.get(phrase, 0) + count
+
+        favorite_counts = dict(db.session
+                               .query(Favorite.product_id, func.count())
+                               .group_by(Favorite.product_id)
+                               .all())
+        seen = {phrase.casefold() for phrase in phrases}
+        for product_id, card in list(index.cards.items()):
+            name = ' '.join((card['name'] or '').split())
+            if name and name.casefold() not in seen:
+                seen.add(name.casefold())
+                phrases[name] = 1 + favorite_counts.get(product_id, 0)
+
+        self.build(phrases, index.watermark)
+
+    def refresh(self, app):
+        """Bring completions up to date with the browse index.
+
+        The first build runs inline; later rebuilds run on a background
+        thread while the previous arrays keep answering.
+        """
+
+        index = current_index()
+        if index.watermark == self.version:
+            return self
+
+        if not self.completions.phrases:
+            self.rebuild_from(index)
+            return self
+
+        with self._lock:
+            if self._building:
+                return self
+            self._building = True
+
+        def rebuild():
+            try:
+                with app.app_context():
+                    self.rebuild_from(index)
+            except Exception:
+                logger.exception("Autocomplete rebuild failed")
+            finally:
+                self._building = False
+
+        threading.Thread(target=rebuild, name='autocomplete-rebuild',
+                         daemon=True).start()
+        return self
+
+
+autocomplete_index = Autocomplete()
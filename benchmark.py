@@ -0,0 +1,289 @@
+"""Benchmark the hot routes against a seeded database and a fake makeup API.
+
+    python benchmark.py                          # SQLite, 200 requests/route
+    python benchmark.py --latency 80 -n 500      # slower fake upstream
+    python benchmark.py --database-url postgresql:///makeup_bench
+    python benchmark.py --compare bench_before.json
+
+The fake API serves fixtures/products.json (with the brand / product_type
+/ product_tags filters and /products/<id>.json) after --latency ms.
+Requests go through Flask's test client, so the numbers are server time
+without network noise. For each route this reports throughput,
+p50/p95/p99 latency, SQL statements per request and the peak RSS while
+that route ran (the high-water mark is reset per route, which needs
+Linux; elsewhere it is left out), and writes them as JSON (--output) to
+compare across commits.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURE = os.path.join(HERE, 'fixtures', 'products.json')
+
+ROUTES = [
+    ('home', '/', False),
+    ('products', '/products', False),
+    ('product_detail', '/products/{product_id}', True),
+    ('brand', '/brands/{brand}', False),
+    ('tag', '/tags/{tag}', False),
+    ('search', '/search?q=lip', False),
+    ('user', '/users/{user_id}', True),
+]
+
+
+def make_stub_handler(products, latency):
+    """Request handler serving `products` like the makeup API."""
+
+    by_id = {product['id']: product for product in products}
+    filters = {
+        'brand': lambda p, v: (p.get('brand') or '').lower() == v.lower(),
+        'product_type': lambda p, v: (p.get('product_type') or '').lower() == v.lower(),
+        'product_tags': lambda p, v: v.lower() in
+        [tag.lower() for tag in p.get('tag_list') or []],
+    }
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            url = urlparse(self.path)
+            if url.path.endswith('/products.json'):
+                body = products
+                for field, values in parse_qs(url.query).items():
+                    if field in filters:
+                        body = [p for p in body if filters[field](p, values[0])]
+            else:
+                try:
+                    product_id = int(url.path.rsplit('/', 1)[-1].split('.')[0])
+                    body = by_id[product_id]
+                except (ValueError, KeyError):
+                    self.send_error(404)
+                    return
+
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+def start_stub(products, latency):
+    """Run the fake API on a free port; returns its base URL."""
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                 make_stub_handler(products, latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/api/v1"
+
+
+def seed(app, users=5, reviews_per_user=20):
+    """Create tables, load the fixture catalog and add users and reviews."""
+
+    from catalog import sync_catalog
+    from models import db, User, Review, Product
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        sync_catalog(FIXTURE)
+
+        products = Product.query.order_by(Product.id).all()
+        for n in range(users):
+            user = User.signup(username=f'bench{n}', email=f'bench{n}@example.com',
+                               password='benchmark', image_url=None)
+            db.session.flush()
+            user.favorites = products[n::users]
+            for i in range(reviews_per_user):
+                db.session.add(Review(text=f'review {i}', user_id=user.id,
+                                      product_id=products[i % len(products)].id))
+        db.session.commit()
+        return User.query.first().id, products[0].id, products[0].brand
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def reset_peak_rss():
+    """Restart the kernel's peak RSS count for this process; False if the
+    platform can't (only Linux has /proc/self/clear_refs)."""
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def rss_kb():
+    """(current RSS, peak RSS since the last reset_peak_rss()) in KB."""
+
+    values = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in ('VmRSS', 'VmHWM'):
+                values[name] = int(value.split()[0])
+    return values['VmRSS'], values['VmHWM']
+
+
+def run_route(client, url, requests):
+    """Time `requests` GETs of `url`; returns a result dict."""
+
+    from instrumentation import assert_max_queries
+
+    client.get(url)  # warm caches and indexes
+    measure_rss = reset_peak_rss()
+    start_rss = rss_kb()[0] if measure_rss else None
+
+    latencies = []
+    statements = []
+    status = None
+    started = time.perf_counter()
+    for _ in range(requests):
+        with assert_max_queries(float('inf')) as executed:
+            start = time.perf_counter()
+            res = client.get(url)
+            latencies.append(time.perf_counter() - start)
+        statements.append(len(executed))
+        status = res.status_code
+    elapsed = time.perf_counter() - started
+
+    return {
+        'url': url,
+        'status': status,
+        'requests': requests,
+        'throughput_rps': round(requests / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'sql_statements': round(statistics.mean(statements), 2),
+        'peak_rss_kb': rss_kb()[1] if measure_rss else None,
+        # how far the route pushed RSS above where it started
+        'rss_growth_kb': rss_kb()[1] - start_rss if measure_rss else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def print_table(results, previous=None):
+    header = (f"{'route':16} {'status':>6} {'req/s':>9} {'p50 ms':>9} "
+              f"{'p95 ms':>9} {'p99 ms':>9} {'sql':>6} {'rss MB':>8} {'+rss KB':>8}")
+    print(header)
+    print('-' * len(header))
+    for name, r in results.items():
+        rss = (f"{r['peak_rss_kb'] / 1024:>8.1f} {r['rss_growth_kb']:>8}"
+               if r['peak_rss_kb'] is not None else f"{'-':>8} {'-':>8}")
+        line = (f"{name:16} {r['status']:>6} {r['throughput_rps']:>9} {r['p50_ms']:>9} "
+                f"{r['p95_ms']:>9} {r['p99_ms']:>9} {r['sql_statements']:>6} {rss}")
+        if previous and name in previous:
+            before = previous[name]['p50_ms']
+            if before:
+                line += f"   p50 {100 * (r['p50_ms'] - before) / before:+.0f}%"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--requests', type=int, default=200,
+                        help='requests per route (default 200)')
+    parser.add_argument('--latency', type=float, default=20,
+                        help='fake upstream latency in ms (default 20)')
+    parser.add_argument('--database-url',
+                        help='database to seed (default: a temporary SQLite file)')
+    parser.add_argument('--output', default=os.path.join(HERE, 'bench_output.json'),
+                        help='where to write JSON results')
+    parser.add_argument('--compare', help='earlier results file to diff against')
+    parser.add_argument('--route', action='append',
+                        help='only run these route names')
+    args = parser.parse_args(argv)
+
+    with open(FIXTURE) as f:
+        products = json.load(f)
+
+    db_file = None
+    if not args.database_url:
+        db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        args.database_url = f'sqlite:///{db_file.name}'
+
+    # app.py reads its settings from the environment at import time.
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ['MAKEUP_API_URL'] = start_stub(products, args.latency / 1000)
+    os.environ['CATALOG_SOURCE'] = FIXTURE
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.pop('FLASK_DEBUG', None)
+    sys.path.insert(0, HERE)
+
+    from app import app
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    user_id, product_id, brand = seed(app)
+
+    anonymous = app.test_client()
+    logged_in = app.test_client()
+    logged_in.post('/login', data={'username': 'bench0', 'password': 'benchmark'})
+
+    params = {
+        'product_id': product_id,
+        'brand': brand,
+        'tag': 'Vegan',
+        'user_id': user_id,
+    }
+
+    results = {}
+    for name, url, needs_login in ROUTES:
+        if args.route and name not in args.route:
+            continue
+        client = logged_in if needs_login else anonymous
+        results[name] = run_route(client, url.format(**params), args.requests)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['routes']
+
+    print_table(results, previous)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'requests_per_route': args.requests,
+            'upstream_latency_ms': args.latency,
+            'database': args.database_url.split(':', 1)[0],
+            'routes': results,
+        }, f, indent=2)
+    print(f"\nWrote {args.output}")
+
+    if db_file is not None:
+        os.unlink(db_file.name)
+
+
+if __name__ == '__main__':
+    main()
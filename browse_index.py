@@ -0,0 +1,219 @@
+"""In-memory inverted index for tag / brand / category browsing.
+
+Maps each tag, brand and product_type to a sorted array of product ids,
+plus a small "card" per product (what the listing templates show), so
+tag, brand and category pages don't touch the database.
+
+The index follows the local catalog: `refresh()` picks up products whose
+`updated_at` moved since the last refresh, so only rows a catalog sync
+actually changed are re-indexed.
+"""
+
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from flask import current_app
+
+from cache import normalize_key
+from models import Product
+
+
+FIELDS = ('tag', 'brand', 'product_type')
+
+CARD_FIELDS = ('id', 'name', 'brand', 'product_type', 'image_link',
+               'api_featured_image')
+
+
+def term(value):
+    """Normalize a tag / brand / type for lookup.
+
+    URLs use "Lip Liner" where the API uses "lip_liner", and
+    "cruelty+free" where it uses "cruelty free".
+    """
+
+    return normalize_key(value).replace('_', ' ')
+
+
+def product_terms(product):
+    """{field: set of terms} for one Product."""
+
+    return {
+        'tag': {term(tag) for tag in product.tag_names},
+        'brand': {term(product.brand)} if product.brand else set(),
+        'product_type': ({term(product.product_type)}
+                         if product.product_type else set()),
+    }
+
+
+def intersect(postings):
+    """Ids present in every sorted array in `postings`.
+
+    Walks the shortest list and binary-searches the others, so the cost
+    is driven by the rarest term.
+    """
+
+    if not postings:
+        return []
+    postings = sorted(postings, key=len)
+    smallest, others = postings[0], postings[1:]
+    result = []
+    for product_id in smallest:
+        for posting in others:
+            i = bisect_left(posting, product_id)
+            if i == len(posting) or posting[i] != product_id:
+                break
+        else:
+            result.append(product_id)
+    return result
+
+
+def union(postings):
+    """Sorted ids present in any array in `postings`."""
+
+    return sorted(set().union(*postings))
+
+
+def product_card(product):
+    """The fields listing templates need from a Product."""
+
+    return {name: getattr(product, name) for name in CARD_FIELDS}
+
+
+class CatalogIndex:
+    """Base for in-memory indexes that track the local catalog.
+
+    Subclasses implement `build(products)` (replace everything) and
+    `update(products)` (re-index changed rows), keeping `self.cards`.
+    """
+
+    def __init__(self):
+        self.cards = {}
+        self.watermark = None
+        self.checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.cards)
+
+    def build(self, products):
+        raise NotImplementedError
+
+    def update(self, products):
+        raise NotImplementedError
+
+    def cards_for(self, ids):
+        """Listing-card dicts for `ids`, in the same order."""
+
+        return [self.cards[product_id] for product_id in ids
+                if product_id in self.cards]
+
+    def refresh(self):
+        """Index products changed since the last refresh."""
+
+        with self._lock:
+            query = Product.query
+            if self.watermark is not None:
+                query = query.filter(Product.updated_at > self.watermark)
+            changed = query.all()
+
+            if self.watermark is None:
+                self.build(changed)
+            elif changed:
+                self.update(changed)
+
+            if changed:
+                self.watermark = max(product.updated_at for product in changed)
+            self.checked_at = time.monotonic()
+
+    def refresh_if_due(self, interval):
+        """Refresh when the last check is more than `interval` s old."""
+
+        if time.monotonic() - self.checked_at >= interval:
+            self.refresh()
+        return self
+
+
+class BrowseIndex(CatalogIndex):
+    """term -> sorted array('i') of product ids, per field."""
+
+    def __init__(self):
+        super().__init__()
+        self.postings = {field: {} for field in FIELDS}
+        self.terms = {}
+
+    def lookup(self, field, value):
+        """Sorted ids for one term; empty if unknown."""
+
+        return self.postings[field].get(term(value), array('i'))
+
+    def all_of(self, field, values):
+        """Ids matching every value, e.g. Vegan AND cruelty free."""
+
+        return intersect([self.lookup(field, value) for value in values])
+
+    def any_of(self, field, values):
+        """Ids matching at least one value."""
+
+        return union([self.lookup(field, value) for value in values])
+
+    def keys(self, field):
+        """Known terms for `field` with their product counts."""
+
+        return {key: len(ids) for key, ids in self.postings[field].items()}
+
+    def build(self, products):
+        """Replace the whole index with `products`."""
+
+        lists = {field: {} for field in FIELDS}
+        terms = {}
+        cards = {}
+        for product in products:
+            terms[product.id] = product_terms(product)
+            cards[product.id] = product_card(product)
+            for field, keys in terms[product.id].items():
+                for key in keys:
+                    lists[field].setdefault(key, []).append(product.id)
+
+        postings = {field: {key: array('i', sorted(ids))
+                            for key, ids in lists[field].items()}
+                    for field in FIELDS}
+
+        # Swap in one go so readers never see a half-built index.
+        self.postings, self.terms, self.cards = postings, terms, cards
+
+    def update(self, products):
+        """Re-index changed products without rebuilding everything.
+
+        Touched posting arrays are copied and replaced rather than edited,
+        so a reader holding the old array is never affected.
+        """
+
+        for product in products:
+            old = self.terms.get(product.id, {field: set() for field in FIELDS})
+            new = product_terms(product)
+            for field in FIELDS:
+                postings = self.postings[field]
+                for key in old[field] - new[field]:
+                    ids = [i for i in postings[key] if i != product.id]
+                    if ids:
+                        postings[key] = array('i', ids)
+                    else:
+                        del postings[key]
+                for key in new[field] - old[field]:
+                    ids = postings.get(key, array('i'))
+                    i = bisect_left(ids, product.id)
+                    postings[key] = ids[:i] + array('i', [product.id]) + ids[i:]
+            self.terms[product.id] = new
+            self.cards[product.id] = product_card(product)
+
+
+browse_index = BrowseIndex()
+
+
+def current_index():
+    """The worker's index, refreshed at most every BROWSE_INDEX_REFRESH s."""
+
+    return browse_index.refresh_if_due(
+        current_app.config['BROWSE_INDEX_REFRESH'])
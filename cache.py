@@ -0,0 +1,310 @@
+"""TTL + LRU caches for upstream makeup API responses.
+
+Two backends share one interface:
+
+- MemoryCache keeps entries in the worker process.
+- FileCache keeps JSON files in a directory every gunicorn worker on the
+  host can see, so one worker's fill is reused by the others.
+
+`get_or_fill(key, fill)` coalesces concurrent misses: only one caller runs
+`fill()` for a key while the others wait for its result (FileCache also
+coalesces across processes with a lock file).
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def normalize_key(*parts):
+    """Build a cache key from query parts, case-folded.
+
+    '+' and ' ' mean the same thing in a query string, so
+    `cruelty+free` and `Cruelty Free` share one entry.
+    """
+
+    return ':'.join(str(part).replace('+', ' ').strip().casefold()
+                    for part in parts)
+
+
+class BaseCache:
+    """Shared bookkeeping: counters and per-key fill coalescing."""
+
+    def __init__(self, max_entries=256, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+        self._key_locks = {}
+        self._key_locks_guard = threading.Lock()
+
+    def get(self, key):
+        """Return (found, value) for `key`."""
+
+        raise NotImplementedError
+
+    def set(self, key, value):
+        """Store `value` under `key` for `ttl` seconds."""
+
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Drop `key` if present."""
+
+        raise NotImplementedError
+
+    def clear(self):
+        """Drop every entry."""
+
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    @contextmanager
+    def _fill_lock(self, key):
+        """Hold a lock private to `key` for the duration of one fill."""
+
+        with self._key_locks_guard:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._key_locks_guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._key_locks[key]
+
+    def get_or_fill(self, key, fill):
+        """Return the cached value for `key`, calling `fill()` on a miss."""
+
+        found, value = self.get(key)
+        if found:
+            self.hits += 1
+            return value
+
+        with self._fill_lock(key):
+            # Someone else may have filled it while we waited on the lock.
+            found, value = self.get(key)
+            if found:
+                self.coalesced += 1
+                return value
+
+            self.misses += 1
+            value = fill()
+            self.set(key, value)
+            return value
+
+    def stats(self):
+        """Counters for this worker."""
+
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            'backend': type(self).__name__,
+            'entries': len(self),
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions,
+            'hit_ratio': (self.hits + self.coalesced) / lookups if lookups else 0.0,
+        }
+
+
+class MemoryCache(BaseCache):
+    """In-process cache; an OrderedDict kept in least-recently-used order."""
+
+    def __init__(self, max_entries=256, ttl=300):
+        super().__init__(max_entries, ttl)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return False, None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return False, None
+            self._data.move_to_end(key)
+            return True, value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class FileCache(BaseCache):
+    """Cache shared between processes through a directory of JSON files.
+
+    File mtime is the last-use time, so LRU eviction removes the files
+    with the oldest mtime. Values must be JSON serializable.
+    """
+
+    def __init__(self, directory, max_entries=256, ttl=300):
+        super().__init__(max_entries, ttl)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, suffix='.json'):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + suffix)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return False, None
+
+        if entry['expires'] < time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return False, None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return True, entry['value']
+
+    def set(self, key, value):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'expires': time.time() + self.ttl, 'value': value}, f)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _entries(self):
+        with os.scandir(self.directory) as it:
+            return [entry for entry in it if entry.name.endswith('.json')]
+
+    def _evict(self):
+        entries = self._entries()
+        overflow = len(entries) - self.max_entries
+        if overflow <= 0:
+            return
+
+        def last_used(entry):
+            try:
+                return entry.stat().st_mtime
+            except OSError:
+                return 0
+
+        for entry in sorted(entries, key=last_used)[:overflow]:
+            try:
+                os.remove(entry.path)
+                self.evictions += 1
+            except OSError:
+                continue
+            self._remove_lock_file(entry.path[:-len('.json')] + '.lock')
+
+    @staticmethod
+    def _remove_lock_file(path):
+        """Delete a lock file unless some process is filling its key.
+
+        It is removed while locked here; _fill_lock notices a lock taken
+        on a removed file and locks the path again.
+        """
+
+        try:
+            lock_file = open(path, 'a')
+        except OSError:
+            return
+        with lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    @contextmanager
+    def _fill_lock(self, key):
+        # Threads in this worker coalesce on the in-process lock; other
+        # workers wait on an exclusive lock on the key's lock file.
+        path = self._path(key, '.lock')
+        with super()._fill_lock(key):
+            while True:
+                lock_file = open(path, 'a')
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    current = os.stat(path).st_ino
+                except OSError:
+                    current = None
+                if current == os.fstat(lock_file.fileno()).st_ino:
+                    break
+                lock_file.close()  # evicted while we waited
+            with lock_file:
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.json'):
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+                elif entry.name.endswith('.lock'):
+                    self._remove_lock_file(entry.path)
+
+    def __len__(self):
+        return len(self._entries())
+
+
+def make_cache(config, prefix):
+    """Build the cache described by the `<prefix>_*` config keys.
+
+    `<prefix>_BACKEND` is 'memory' or 'file'; 'file' stores entries in
+    `<prefix>_DIR`.
+    """
+
+    max_entries = config[f'{prefix}_MAX_ENTRIES']
+    ttl = config[f'{prefix}_TTL']
+
+    if config[f'{prefix}_BACKEND'] == 'file':
+        return FileCache(config[f'{prefix}_DIR'], max_entries, ttl)
+    return MemoryCache(max_entries, ttl)
@@ -0,0 +1,570 @@
+"""Local mirror of the makeup API catalog.
+
+The routes read products, brands, categories and tags from the database
+only. This module keeps those tables in sync with the upstream catalog,
+either from the `flask catalog sync` command or from a background thread.
+If a sync fails the previous rows are left alone, so the site keeps
+serving the last good (stale) copy until upstream comes back.
+"""
+
+import io
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+
+import click
+import requests
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import column, or_, select, table
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import selectinload
+
+from models import db, Product, Brand, Category, Tag, CatalogSync, product_tags
+from snapshots import record_snapshots, changed_since
+from upstream import upstream_client
+
+
+logger = logging.getLogger(__name__)
+
+catalog_cli = AppGroup('catalog', help='Manage the local product catalog.')
+
+
+def load_source(source, previous=None):
+    """Load the raw product list from a URL or a local JSON file.
+
+    A file path lets a fixture stand in for the makeup API in tests.
+    For URLs the validators of the `previous` run are sent along, and
+    records is None when upstream answers 304 Not Modified.
+
+    Returns (records, etag, last_modified).
+    """
+
+    if not source.startswith(('http://', 'https://')):
+        with open(source) as f:
+            return json.load(f), None, None
+
+    client = upstream_client()
+    res = client.get_if_modified(
+        source,
+        etag=previous.etag if previous else None,
+        last_modified=previous.last_modified if previous else None,
+        timeout=(client.timeout[0], current_app.config['CATALOG_SYNC_TIMEOUT']))
+    etag = res.headers.get('ETag')
+    last_modified = res.headers.get('Last-Modified')
+    if res.status_code == 304:
+        return None, etag or previous.etag, last_modified or previous.last_modified
+    return res.json(), etag, last_modified
+
+
+def clean_names(record):
+    """(brand, product_type, tag names) of a record, whitespace trimmed."""
+
+    brand = (record.get('brand') or '').strip()
+    product_type = (record.get('product_type') or '').strip()
+    tag_names = [name.strip() for name in record.get('tag_list') or []
+                 if name and name.strip()]
+    return brand, product_type, tag_names
+
+
+def product_fields(record):
+    """Product column values for an upstream record (ids excepted)."""
+
+    brand, product_type, tag_names = clean_names(record)
+    return {
+        'brand': brand or None,
+        'name': record.get('name'),
+        'image_link': record.get('image_link'),
+        'api_featured_image': record.get('api_featured_image'),
+        'product_type': product_type or None,
+        'description': record.get('description'),
+        'price': record.get('price'),
+        'price_sign': record.get('price_sign'),
+        'rating': record.get('rating'),
+        'product_link': record.get('product_link'),
+        'website_link': record.get('website_link'),
+        'tag_list': ','.join(tag_names) or None,
+    }
+
+
+def apply_records(records):
+    """Upsert upstream product records into the local tables.
+
+    Returns the number of products written. Nothing is committed here.
+    """
+
+    # replacing all_tags diffs against the current collection: load every
+    # product's tags in one query rather than one per record
+    products = {product.id: product for product in
+                Product.query.options(selectinload(Product.all_tags))}
+    brands = {brand.name: brand for brand in Brand.query.all()}
+    categories = {category.product_type: category
+                  for category in Category.query.all()}
+    tags = {tag.tag_list: tag for tag in Tag.query.all()}
+
+    for record in records:
+        brand_name, product_type, tag_names = clean_names(record)
+        if brand_name and brand_name not in brands:
+            brands[brand_name] = Brand(name=brand_name)
+            db.session.add(brands[brand_name])
+
+        if product_type and product_type not in categories:
+            categories[product_type] = Category(product_type=product_type)
+            db.session.add(categories[product_type])
+
+        for name in tag_names:
+            if name not in tags:
+                tags[name] = Tag(tag_list=name)
+                db.session.add(tags[name])
+
+        product = products.get(record['id'])
+        if product is None:
+            product = Product(id=record['id'])
+            products[product.id] = product
+            db.session.add(product)
+
+        for field, value in product_fields(record).items():
+            setattr(product, field, value)
+        product.category = categories.get(product_type)
+        product.tags = tags[tag_names[0]] if tag_names else None
+        product.all_tags = list({tags[name] for name in tag_names})
+
+    return len(records)
+
+
+def sync_catalog(source=None):
+    """Pull the catalog from `source` into the database.
+
+    Returns the CatalogSync row for this run. On any upstream or parse
+    error the run is recorded as failed and existing rows are kept.
+    """
+
+    source = source or current_app.config['CATALOG_SOURCE']
+    previous = last_successful_sync()
+    if previous is not None and previous.source != source:
+        previous = None
+
+    run = CatalogSync(source=source)
+    db.session.add(run)
+    db.session.commit()
+
+    try:
+        records, run.etag, run.last_modified = load_source(source, previous)
+        if records is None:
+            run.status = 'unchanged'
+            run.product_count = previous.product_count
+            run.finished_at = datetime.utcnow()
+            db.session.commit()
+            logger.info("Catalog at %s unchanged since sync %d",
+                        source, previous.id)
+            return run
+        count = apply_records(records)
+        # a re-sync of the same data sets every attribute to its old value
+        changed = bool(db.session.new) or any(
+            db.session.is_modified(obj) for obj in db.session.dirty)
+        db.session.flush()
+        for batch in batches(records, 1000):
+            changed |= bool(record_snapshots(db.session.connection(), batch))
+    except (requests.RequestException, OSError, ValueError, KeyError) as e:
+        db.session.rollback()
+        run.status = 'failed'
+        run.error = str(e)
+        run.finished_at = datetime.utcnow()
+        db.session.commit()
+        logger.warning("Catalog sync from %s failed: %s", source, e)
+        return run
+
+    # 'unchanged' keeps catalog_version(), and so every cached page, valid
+    run.status = 'ok' if changed else 'unchanged'
+    run.product_count = count
+    run.finished_at = datetime.utcnow()
+    db.session.commit()
+    logger.info("Catalog sync from %s wrote %d products (%s)",
+                source, count, run.status)
+    return run
+
+
+def last_successful_sync():
+    """Return the newest CatalogSync that reached upstream, or None.
+
+    This includes 'unchanged' runs, which confirm the data is current.
+    """
+
+    return (CatalogSync
+            .query
+            .filter(CatalogSync.status.in_(['ok', 'unchanged']))
+            .order_by(CatalogSync.id.desc())
+            .first())
+
+
+def catalog_version():
+    """Id of the newest sync that wrote data; 0 if never loaded."""
+
+    run = (CatalogSync
+           .query
+           .filter(CatalogSync.status == 'ok')
+           .order_by(CatalogSync.id.desc())
+           .first())
+    return run.id if run else 0
+
+
+def catalog_is_stale():
+    """True when the last good sync is older than CATALOG_STALE_AFTER."""
+
+    run = last_successful_sync()
+    if run is None:
+        return True
+    max_age = timedelta(seconds=current_app.config['CATALOG_STALE_AFTER'])
+    return datetime.utcnow() - run.finished_at > max_age
+
+
+def start_background_sync(app, interval):
+    """Re-sync the catalog every `interval` seconds on a daemon thread.
+
+    Several workers may each start a thread; a run is skipped when another
+    worker already synced within the interval.
+    """
+
+    def run_forever():
+        while True:
+            with app.app_context():
+                try:
+                    last = last_successful_sync()
+                    due = (last is None or
+                           datetime.utcnow() - last.finished_at >=
+                           timedelta(seconds=interval))
+                    if due:
+                        sync_catalog()
+                except Exception:
+                    logger.exception("Background catalog sync crashed")
+                finally:
+                    db.session.remove()
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run_forever, name='catalog-sync',
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+##############################################################################
+# Bulk import
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_json_array(chunks):
+    """Yield the items of a top-level JSON array read from text `chunks`.
+
+    Only the current item is held in memory, however large the array.
+    """
+
+    decoder = json.JSONDecoder()
+    buffer, pos, started = '', 0, False
+    for chunk in chunks:
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                break
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError("catalog dump is not a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break  # the item continues in the next chunk
+            yield item
+    raise ValueError("catalog dump ended in the middle of the array")
+
+
+def source_chunks(source):
+    """Text chunks of a catalog dump from a URL or a local file."""
+
+    if not source.startswith(('http://', 'https://')):
+        with open(source, encoding='utf-8') as f:
+            yield from iter(lambda: f.read(CHUNK_SIZE), '')
+        return
+
+    client = upstream_client()
+    res = client.get(source, stream=True, timeout=(
+        client.timeout[0], current_app.config['CATALOG_SYNC_TIMEOUT']))
+    res.encoding = res.encoding or 'utf-8'
+    with res:
+        yield from res.iter_content(CHUNK_SIZE, decode_unicode=True)
+
+
+def batches(items, size):
+    items = iter(items)
+    while batch := list(islice(items, size)):
+        yield batch
+
+
+def copy_value(value):
+    """`value` in PostgreSQL COPY text format."""
+
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+class BulkImporter:
+    """Batched upserts of upstream records, one transaction per batch.
+
+    Brands and categories are inserted with ON CONFLICT DO NOTHING and
+    tags looked up by name; the name -> id maps are kept between batches
+    (they grow with the vocabulary, not with the dump). product_tags and
+    the price snapshots (snapshots.py) are only written where they
+    differ from what is stored. Products are
+    upserted on id and only rows whose data changed are written, so
+    their updated_at (and the browse index) only moves for real changes.
+    PostgreSQL loads each batch with COPY into a temporary table first;
+    SQLite uses executemany.
+    """
+
+    COLUMNS = ['id', 'brand', 'name', 'image_link', 'api_featured_image',
+               'product_type', 'description', 'price', 'price_sign', 'rating',
+               'product_link', 'website_link', 'tag_list', 'category_id',
+               'tag_id', 'updated_at']
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.dialect = engine.dialect.name
+        if self.dialect not in ('postgresql', 'sqlite'):
+            raise ValueError(f"bulk import doesn't support {self.dialect}")
+        self.brands = set()
+        self.category_ids = {}
+        self.tag_ids = {}
+        self.products = 0
+        self.changed = 0
+        self.snapshots = 0
+
+    def insert(self, model):
+        module = postgresql if self.dialect == 'postgresql' else sqlite
+        return module.insert(model.__table__)
+
+    def add_brands(self, conn, names):
+        new = names - self.brands
+        if new:
+            conn.execute(self.insert(Brand).on_conflict_do_nothing(
+                index_elements=['name']), [{'name': name} for name in new])
+            self.brands |= new
+
+    def add_categories(self, conn, names):
+        new = names - self.category_ids.keys()
+        if new:
+            conn.execute(self.insert(Category).on_conflict_do_nothing(
+                index_elements=['product_type']),
+                [{'product_type': name} for name in new])
+            self.category_ids.update(conn.execute(
+                select(Category.product_type, Category.id)
+                .where(Category.product_type.in_(new))).all())
+
+    def add_tags(self, conn, names):
+        new = names - self.tag_ids.keys()
+        if not new:
+            return
+        lookup = select(Tag.tag_list, Tag.id).where(Tag.tag_list.in_(new))
+        self.tag_ids.update(conn.execute(lookup).all())
+        missing = new - self.tag_ids.keys()
+        if missing:
+            conn.execute(Tag.__table__.insert(),
+                         [{'tag_list': name} for name in missing])
+            self.tag_ids.update(conn.execute(lookup).all())
+
+    def link_tags(self, conn, records):
+        """Bring the product_tags rows of this batch's products up to date."""
+
+        links = {(record['id'], self.tag_ids[name])
+                 for record in records for name in clean_names(record)[2]}
+        stored = set(conn.execute(
+            select(product_tags.c.product_id, product_tags.c.tag_id)
+            .where(product_tags.c.product_id.in_(
+                [record['id'] for record in records]))).all())
+
+        for product_id, tag_id in stored - links:
+            conn.execute(product_tags.delete().where(
+                product_tags.c.product_id == product_id,
+                product_tags.c.tag_id == tag_id))
+        if links - stored:
+            conn.execute(product_tags.insert(),
+                         [{'product_id': product_id, 'tag_id': tag_id}
+                          for product_id, tag_id in links - stored])
+
+    def product_rows(self, records):
+        now = datetime.utcnow()
+        rows = []
+        for record in records:
+            _, product_type, tag_names = clean_names(record)
+            rows.append({
+                'id': record['id'],
+                **product_fields(record),
+                'category_id': self.category_ids.get(product_type),
+                'tag_id': self.tag_ids[tag_names[0]] if tag_names else None,
+                'updated_at': now,
+            })
+        return rows
+
+    def upsert_statement(self, stmt):
+        changes = [name for name in self.COLUMNS
+                   if name not in ('id', 'updated_at')]
+        products = Product.__table__.c
+        return stmt.on_conflict_do_update(
+            index_elements=['id'],
+            set_={name: stmt.excluded[name] for name in changes + ['updated_at']},
+            where=or_(*[products[name].is_distinct_from(stmt.excluded[name])
+                        for name in changes]))
+
+    def copy_products(self, conn, rows):
+        """COPY `rows` into a temp table, then upsert from it."""
+
+        cursor = conn.connection.cursor()
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS products_import "
+                       "(LIKE products) ON COMMIT DELETE ROWS")
+        data = io.StringIO(''.join(
+            '\t'.join(copy_value(row[name]) for name in self.COLUMNS) + '\n'
+            for row in rows))
+        cursor.copy_expert(f"COPY products_import ({', '.join(self.COLUMNS)}) "
+                           "FROM STDIN", data)
+        cursor.close()
+
+        staged = table('products_import', *[column(name) for name in self.COLUMNS])
+        stmt = self.insert(Product).from_select(self.COLUMNS, select(*staged.c))
+        return conn.execute(self.upsert_statement(stmt)).rowcount
+
+    def write(self, records):
+        """Upsert one batch of records in its own transaction.
+
+        A product listed twice in the batch is written once, from its
+        last record: PostgreSQL's ON CONFLICT DO UPDATE can't touch a
+        row twice in one statement.
+        """
+
+        records = list({record['id']: record for record in records}.values())
+        names = [clean_names(record) for record in records]
+        with self.engine.begin() as conn:
+            self.add_brands(conn, {brand for brand, _, _ in names if brand})
+            self.add_categories(conn, {kind for _, kind, _ in names if kind})
+            self.add_tags(conn, {tag for _, _, tags in names for tag in tags})
+
+            rows = self.product_rows(records)
+            if self.dialect == 'postgresql':
+                changed = self.copy_products(conn, rows)
+            else:
+                changed = conn.execute(
+                    self.upsert_statement(self.insert(Product)), rows).rowcount
+            self.link_tags(conn, records)
+            self.snapshots += record_snapshots(conn, records)
+        self.products += len(rows)
+        self.changed += max(changed, 0)
+
+
+def import_catalog(source=None, batch_size=1000, progress=None):
+    """Stream a catalog dump from `source` into the database in batches.
+
+    Safe to rerun: unchanged products aren't touched. Returns the
+    CatalogSync row for the run ('unchanged' when nothing changed) and
+    the BulkImporter with its counts. `progress(importer)` is called
+    after each batch.
+    """
+
+    source = source or current_app.config['CATALOG_SOURCE']
+    run = CatalogSync(source=source)
+    db.session.add(run)
+    db.session.commit()
+
+    importer = BulkImporter(db.engine)
+    try:
+        for batch in batches(iter_json_array(source_chunks(source)), batch_size):
+            importer.write(batch)
+            if progress is not None:
+                progress(importer)
+    except (requests.RequestException, OSError, ValueError, KeyError) as e:
+        run.status = 'failed'
+        run.error = str(e)
+        logger.warning("Catalog import from %s failed after %d products: %s",
+                       source, importer.products, e)
+    else:
+        run.status = ('ok' if importer.changed or importer.snapshots
+                      else 'unchanged')
+    run.product_count = importer.products
+    run.finished_at = datetime.utcnow()
+    db.session.commit()
+    return run, importer
+
+
+@catalog_cli.command('sync')
+@click.option('--source', default=None,
+              help='URL or JSON file to load instead of CATALOG_SOURCE.')
+def sync_command(source):
+    """Load the upstream catalog into the local database."""
+
+    run = sync_catalog(source)
+    if run.status == 'failed':
+        raise click.ClickException(f"sync failed: {run.error}")
+    if run.status == 'unchanged':
+        click.echo("Catalog unchanged upstream; nothing to do.")
+        return
+    click.echo(f"Synced {run.product_count} products (version {run.id}).")
+
+
+@catalog_cli.command('status')
+def status_command():
+    """Show when the catalog was last synced."""
+
+    run = last_successful_sync()
+    if run is None:
+        click.echo("Catalog has never been synced.")
+        return
+    stale = " (stale)" if catalog_is_stale() else ""
+    click.echo(f"Version {catalog_version()}: {run.product_count} products "
+               f"from {run.source}, checked at "
+               f"{run.finished_at:%Y-%m-%d %H:%M:%S}{stale}")
+
+
+@catalog_cli.command('import')
+@click.option('--source', default=None,
+              help='URL or JSON file to load instead of CATALOG_SOURCE.')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Products per transaction.')
+def import_command(source, batch_size):
+    """Stream a full catalog dump into the database in batches."""
+
+    start = time.perf_counter()
+
+    def progress(importer):
+        elapsed = time.perf_counter() - start
+        click.echo(f"  {importer.products} products, "
+                   f"{importer.products / elapsed:.0f} rows/s")
+
+    run, importer = import_catalog(source, batch_size, progress)
+    elapsed = time.perf_counter() - start
+    if run.status == 'failed':
+        raise click.ClickException(
+            f"import failed after {importer.products} products: {run.error}")
+    click.echo(f"Imported {importer.products} products "
+               f"({importer.changed} new or changed, {importer.snapshots} "
+               f"price snapshots updated) in {elapsed:.2f}s, "
+               f"{importer.products / elapsed:.0f} rows/s.")
+
+
+@catalog_cli.command('changed')
+@click.option('--since', required=True, type=click.DateTime(),
+              help='UTC time, e.g. 2024-01-31T00:00:00.')
+def changed_command(since):
+    """List products whose price snapshot changed after --since."""
+
+    for product_id in db.session.execute(changed_since(since)).scalars():
+        click.echo(product_id)
@@ -0,0 +1,103 @@
+"""Cached identity for the logged-in user.
+
+`add_user_to_g` runs before every request. Instead of loading the User
+row each time, each worker keeps a small LRU of user snapshots (the few
+columns templates show, plus the favorites version) keyed by id. The
+session cookie carries the user's `profile_version`; a snapshot is used
+only while its version matches the cookie, and profile edits bump the
+version. A change made through another session or worker (a favorite,
+say) reaches this worker when the snapshot expires after USER_CACHE_TTL
+seconds, or at once on the next login.
+
+`g.user` is a CurrentUser: snapshot fields are read without touching the
+database, and anything else (favorites, reviews, assignment, deleting)
+loads the real User row the first time it is needed.
+"""
+
+from cache import MemoryCache
+from models import db, User
+
+
+SNAPSHOT_FIELDS = ('id', 'username', 'email', 'image_url', 'profile_version',
+                   'favorites_version')
+
+user_cache = MemoryCache()
+
+
+def configure_user_cache(config):
+    user_cache.max_entries = config['USER_CACHE_SIZE']
+    user_cache.ttl = config['USER_CACHE_TTL']
+
+
+def snapshot(user):
+    return {field: getattr(user, field) for field in SNAPSHOT_FIELDS}
+
+
+class CurrentUser:
+    """A user snapshot that turns into the ORM User on demand."""
+
+    def __init__(self, snapshot, orm=None):
+        object.__setattr__(self, '_snapshot', snapshot)
+        object.__setattr__(self, '_orm', orm)
+
+    @property
+    def orm(self):
+        """The full User row, loaded the first time it is asked for."""
+
+        if self._orm is None:
+            object.__setattr__(self, '_orm',
+                               db.session.get(User, self._snapshot['id']))
+        return self._orm
+
+    def __getattr__(self, name):
+        if name in self._snapshot:
+            return self._snapshot[name]
+        return getattr(self.orm, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.orm, name, value)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self._snapshot['id']}: {self._snapshot['username']}>"
+
+
+def load_current_user(user_id, version):
+    """CurrentUser for `user_id`, or None if that user no longer exists.
+
+    `version` is the profile_version from the session cookie. The cache
+    is used when it agrees; otherwise the row is read and cached again.
+    """
+
+    found, cached = user_cache.get(user_id)
+    if found and cached['profile_version'] == version:
+        user_cache.hits += 1
+        return CurrentUser(cached)
+
+    user_cache.misses += 1
+    user = db.session.get(User, user_id)
+    if user is None:
+        user_cache.delete(user_id)
+        return None
+
+    cached = snapshot(user)
+    user_cache.set(user_id, cached)
+    return CurrentUser(cached, user)
+
+
+def remember_user(user):
+    """Cache a User row just read from the database (e.g. at login)."""
+
+    user_cache.set(user.id, snapshot(user))
+
+
+def profile_changed(user):
+    """Bump `user`'s profile_version; call before committing an edit."""
+
+    user.profile_version = (user.profile_version or 0) + 1
+    user_cache.delete(user.id)
+
+
+def forget_user(user_id):
+    """Drop a deleted or logged-out user from this worker's cache."""
+
+    user_cache.delete(user_id)
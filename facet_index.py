@@ -0,0 +1,212 @@
+"""Faceted filtering over the local catalog with NumPy columns.
+
+Every product is one bit position. Each brand, product_type, tag and
+price bucket has a bitset of the products carrying it, so a filter is a
+few ANDs / ORs over packed words, and a facet count is a popcount of the
+facet's bitsets ANDed with the filter. Nothing loops per product and
+nothing touches the database: a filter with all facet counts over 50k
+products takes a few hundred microseconds.
+
+- brand and product_type take several values, matched as OR
+- tags are matched as AND, like the tag pages
+- min_price / max_price bound the price; products without one drop out
+  once a bound is given
+
+Each facet is counted with every filter except its own. The counts show
+what picking another brand (or type, or price range) would return, not
+only the option already picked. Tag counts use every filter, so they say
+how many products would remain if that tag were added.
+
+The columns follow the catalog like the browse index. On a change they
+are rebuilt from the per-product rows kept here and swapped in at once.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+from flask import current_app
+
+from browse_index import CatalogIndex, product_card, term
+
+
+FACETS = ('brand', 'product_type', 'tag')
+
+# price facet buckets: [0, 10), [10, 25), ... [100, inf)
+PRICE_EDGES = (0, 10, 25, 50, 100)
+
+# numpy >= 2.0 counts bits natively; older ones use a table
+if hasattr(np, 'bitwise_count'):
+    def bit_counts(words):
+        return np.bitwise_count(words.view(np.uint64))
+else:
+    _BITS16 = np.array([bin(i).count('1') for i in range(1 << 16)], np.uint8)
+
+    def bit_counts(words):
+        return _BITS16[words.view(np.uint16)]
+
+
+Facet = namedtuple('Facet', 'names codes bits')
+Columns = namedtuple('Columns', 'ids prices everything facets price_bits')
+
+
+def parse_price(value):
+    try:
+        price = float(value)
+    except (TypeError, ValueError):
+        return np.nan
+    return price if price >= 0 else np.nan
+
+
+def pack(masks, size):
+    """Bool rows -> bitsets padded to whole 64-bit words."""
+
+    masks = np.atleast_2d(masks)
+    padded = np.zeros((len(masks), -(-size // 64) * 64), np.bool_)
+    padded[:, :masks.shape[1]] = masks
+    return np.packbits(padded, axis=1)
+
+
+def popcounts(rows, bits):
+    """Set bits of each row of `rows` AND `bits`."""
+
+    return bit_counts(rows & bits).sum(axis=1, dtype=np.int64)
+
+
+def facet(values, size):
+    """A Facet for per-product value lists: labels, term -> row, bitsets."""
+
+    names, codes, members = [], {}, []
+    for position, product_values in enumerate(values):
+        for value in product_values:
+            key = term(value)
+            if key not in codes:
+                codes[key] = len(names)
+                names.append(value)
+                members.append([])
+            members[codes[key]].append(position)
+    masks = np.zeros((len(names), size), np.bool_)
+    for row, positions in enumerate(members):
+        masks[row, positions] = True
+    return Facet(names, codes, pack(masks, size))
+
+
+def ranked(counts, names):
+    """[{'value', 'count'}] for the non-zero counts, most common first."""
+
+    found = np.flatnonzero(counts)
+    order = found[np.lexsort((found, -counts[found]))]
+    return [{'value': names[i], 'count': int(counts[i])} for i in order]
+
+
+class FacetIndex(CatalogIndex):
+    """Bitsets over the catalog for faceted filtering."""
+
+    def __init__(self):
+        super().__init__()
+        self.rows = {}
+        self.columns = self._columns({})
+
+    def _columns(self, rows):
+        ids = np.array(sorted(rows), np.int64)
+        records = [rows[product_id] for product_id in ids.tolist()]
+        size = len(ids)
+
+        facets = {name: facet([record[i] for record in records], size)
+                  for i, name in enumerate(FACETS)}
+        prices = np.array([record[3] for record in records], np.float64)
+        # no price: bucket -1, which no facet row matches (as in filter())
+        buckets = np.where(np.isnan(prices), -1,
+                           np.digitize(prices, PRICE_EDGES) - 1)
+        price_bits = pack(buckets == np.arange(len(PRICE_EDGES))[:, None], size)
+
+        return Columns(ids, prices, pack(np.ones(size, np.bool_), size)[0],
+                       facets, price_bits)
+
+    @staticmethod
+    def _row(product):
+        return ([product.brand] if product.brand else [],
+                [product.product_type] if product.product_type else [],
+                product.tag_names,
+                parse_price(product.price))
+
+    def build(self, products):
+        """Replace the whole index with `products`."""
+
+        rows, cards = {}, {}
+        for product in products:
+            rows[product.id] = self._row(product)
+            cards[product.id] = product_card(product)
+        columns = self._columns(rows)
+        self.rows, self.cards, self.columns = rows, cards, columns
+
+    def update(self, products):
+        """Re-index changed products (the bitsets are rebuilt)."""
+
+        rows, cards = dict(self.rows), dict(self.cards)
+        for product in products:
+            rows[product.id] = self._row(product)
+            cards[product.id] = product_card(product)
+        columns = self._columns(rows)
+        self.rows, self.cards, self.columns = rows, cards, columns
+
+    @staticmethod
+    def _select(facet, values, combine, everything):
+        """Bitset of products with any (combine=OR) or all (AND) `values`."""
+
+        if not values:
+            return everything
+        rows = [facet.codes.get(term(value)) for value in values]
+        if combine is np.bitwise_and and None in rows:
+            return np.zeros_like(everything)
+        rows = [row for row in rows if row is not None]
+        if not rows:
+            return np.zeros_like(everything)
+        return combine.reduce(facet.bits[rows], axis=0)
+
+    def filter(self, brands=(), types=(), tags=(), min_price=None,
+               max_price=None):
+        """(matching ids, facet counts) for one combination of filters."""
+
+        columns = self.columns
+        everything, facets = columns.everything, columns.facets
+
+        brand = self._select(facets['brand'], brands, np.bitwise_or, everything)
+        kind = self._select(facets['product_type'], types, np.bitwise_or,
+                            everything)
+        tag = self._select(facets['tag'], tags, np.bitwise_and, everything)
+        price = everything
+        if min_price is not None or max_price is not None:
+            in_range = np.ones(len(columns.ids), np.bool_)
+            if min_price is not None:
+                in_range &= columns.prices >= min_price
+            if max_price is not None:
+                in_range &= columns.prices <= max_price
+            price = pack(in_range, len(columns.ids))[0]
+
+        matches = brand & kind & tag & price
+        counts = {
+            'brand': popcounts(facets['brand'].bits, kind & tag & price),
+            'product_type': popcounts(facets['product_type'].bits,
+                                      brand & tag & price),
+            'tag': popcounts(facets['tag'].bits, matches),
+        }
+        result = {name: ranked(counts[name], facets[name].names)
+                  for name in FACETS}
+        result['price'] = [
+            {'min': low, 'max': high, 'count': int(count)}
+            for low, high, count in zip(
+                PRICE_EDGES, PRICE_EDGES[1:] + (None,),
+                popcounts(columns.price_bits, brand & kind & tag))]
+
+        selected = np.unpackbits(matches, count=len(columns.ids)).view(np.bool_)
+        return columns.ids[selected], result
+
+
+facet_index = FacetIndex()
+
+
+def current_facet_index():
+    """The worker's facet index, refreshed like the browse index."""
+
+    return facet_index.refresh_if_due(
+        current_app.config['BROWSE_INDEX_REFRESH'])
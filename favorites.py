@@ -0,0 +1,123 @@
+"""Set-based access to the favorites table.
+
+Adding or removing any number of favorites is one statement: an
+`INSERT ... SELECT ... ON CONFLICT DO NOTHING` or a
+`DELETE ... WHERE product_id IN (...)`, both returning the product ids
+they touched. Nothing loads the `User.favorites` collection.
+
+`favorite_ids(user_id, version)` answers "is this favorited?" from a
+per-worker cache of frozensets. The version is users.favorites_version:
+every add or remove bumps it in the same transaction, so every session
+and every worker sees a cached set (or page, see page_user_state in
+app.py) go stale as soon as its copy of the user does. That can be up
+to USER_CACHE_TTL seconds, so writes like toggle_favorite never decide
+from the cached set.
+"""
+
+from sqlalchemy import delete, insert, literal, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from cache import MemoryCache
+from current_user import forget_user
+from models import db, Favorite, Product, User
+
+
+favorite_sets = MemoryCache()
+
+
+def configure_favorites_cache(config):
+    favorite_sets.max_entries = config['USER_CACHE_SIZE']
+    favorite_sets.ttl = config['USER_CACHE_TTL']
+
+
+def favorite_ids(user_id, version=None):
+    """Frozenset of product ids `user_id` has favorited.
+
+    `version` is the user's favorites_version; a set cached under
+    another version is read again.
+    """
+
+    found, cached = favorite_sets.get(user_id)
+    if found and cached[0] == version:
+        favorite_sets.hits += 1
+        return cached[1]
+
+    favorite_sets.misses += 1
+    ids = frozenset(product_id for (product_id,) in db.session.execute(
+        select(Favorite.product_id).where(Favorite.user_id == user_id)))
+    favorite_sets.set(user_id, (version, ids))
+    return ids
+
+
+def _changed(user_id):
+    """Bump `user_id`'s favorites_version and drop this worker's copies."""
+
+    db.session.execute(update(User).where(User.id == user_id)
+                       .values(favorites_version=User.favorites_version + 1))
+    favorite_sets.delete(user_id)
+    forget_user(user_id)
+
+
+def _insert_ignoring_conflicts():
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(Favorite).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return sqlite.insert(Favorite).on_conflict_do_nothing()
+    return insert(Favorite)
+
+
+def add_favorites(user_id, product_ids):
+    """Favorite every existing product in `product_ids`.
+
+    Returns the set of ids that were added; ids that don't exist or were
+    already favorited are skipped.
+    """
+
+    product_ids = set(product_ids)
+    if not product_ids:
+        return set()
+
+    already = select(Favorite.product_id).where(Favorite.user_id == user_id)
+    rows = (select(literal(user_id), Product.id)
+            .where(Product.id.in_(product_ids), Product.id.not_in(already)))
+    stmt = (_insert_ignoring_conflicts()
+            .from_select(['user_id', 'product_id'], rows)
+            .returning(Favorite.product_id))
+    added = {product_id for (product_id,) in db.session.execute(stmt)}
+    if added:
+        _changed(user_id)
+    return added
+
+
+def remove_favorites(user_id, product_ids):
+    """Unfavorite `product_ids`; returns the set of ids that were removed."""
+
+    product_ids = set(product_ids)
+    if not product_ids:
+        return set()
+
+    stmt = (delete(Favorite)
+            .where(Favorite.user_id == user_id,
+                   Favorite.product_id.in_(product_ids))
+            .returning(Favorite.product_id))
+    removed = {product_id for (product_id,) in db.session.execute(stmt)}
+    if removed:
+        _changed(user_id)
+    return removed
+
+
+def toggle_favorite(user_id, product_id):
+    """Flip one favorite.
+
+    The DELETE decides: a cached set could be older than a change made
+    in another worker. Returns True if it is now favorited, False if it
+    was removed and None if there is no such product.
+    """
+
+    if remove_favorites(user_id, [product_id]):
+        return False
+    if add_favorites(user_id, [product_id]):
+        return True
+    # added by a concurrent request, or not a product at all
+    return True if db.session.get(Product, product_id) is not None else None
@@ -0,0 +1,248 @@
+"""HTTP caching and compression for responses.
+
+Views opt in to shared caching with @cache_policy(max_age). Such a page
+depends only on the URL, the catalog and who is looking at it, so its
+ETag is computed from those before the view runs: a matching
+If-None-Match is answered with 304 without touching the view (or the
+database). Anonymous visitors get `public, max-age=...` so browsers and
+CDNs can reuse the page; logged-in users get `private, no-cache` since
+the page shows their name and favorites.
+
+The same key also finds the rendered body in the page cache (a
+cache.py backend configured by the PAGE_CACHE_* settings), so a visitor
+without a cached copy still skips the view and the template. The
+catalog stamp is part of the key: when a sync changes the catalog, old
+pages simply stop being looked up.
+
+A page that turns out to embed a CSRF token (a form rendered with
+hidden_tag()) is neither stored nor sent as public: the token belongs to
+one session.
+
+Every other GET gets `private, no-cache` and an ETag of its body, so a
+revalidation still saves the transfer. Static files linked through
+`static_url()` carry a content hash in the URL and are cached for a year.
+
+HTML, JSON and text bodies of at least COMPRESS_MIN_SIZE bytes are
+compressed with Brotli (when the brotli package is installed) or gzip,
+whichever the client accepts.
+"""
+
+import gzip
+import hashlib
+import os
+from functools import wraps
+
+from flask import current_app, g, request, session, url_for
+
+from browse_index import current_index
+from cache import make_cache
+
+try:
+    import brotli
+except ImportError:  # optional; gzip only
+    brotli = None
+
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript',
+                      'application/x-ndjson')
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+_fingerprints = {}
+
+
+def catalog_stamp():
+    """Changes whenever the catalog the pages are rendered from changes."""
+
+    watermark = current_index().watermark
+    return watermark.isoformat() if watermark else ''
+
+
+def state_etag(user_state):
+    """Strong ETag for the current URL, catalog and `user_state`.
+
+    Also the page cache key.
+    """
+
+    parts = [request.full_path, catalog_stamp(), repr(user_state)]
+    return hashlib.sha1('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+def etag_matches(etag):
+    """True if the request's If-None-Match names `etag` in any encoding."""
+
+    tags = request.if_none_match
+    return tags.star_tag or any(tag.split('-', 1)[0] == etag
+                                for tag in tags.as_set(include_weak=True))
+
+
+def rendered_csrf_token():
+    """True if this request generated a CSRF token (Flask-WTF keeps it on g)."""
+
+    return current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token') in g
+
+
+def cache_policy(max_age=None, per_user=True):
+    """Decorator: let anonymous responses be cached for `max_age` seconds.
+
+    Only for GET views whose output depends on nothing but the URL, the
+    catalog and (unless per_user is False) the logged-in user. `max_age`
+    defaults to CATALOG_PAGE_MAX_AGE.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # a pending flash message has to be shown, so render normally;
+            # per_user=False responses never show one (nor read the session)
+            if request.method != 'GET' or (per_user and session.get('_flashes')):
+                return view(*args, **kwargs)
+
+            extension = current_app.extensions['http_cache']
+            user_state = None
+            if per_user and g.get('user'):
+                user_state = extension['user_state']()
+            etag = state_etag(user_state)
+            if etag_matches(etag):
+                res = current_app.response_class(status=304)
+            else:
+                res = cached_page(extension['pages'], etag,
+                                  lambda: view(*args, **kwargs))
+                if res.status_code != 200:
+                    return res
+                if rendered_csrf_token():
+                    res.headers['Cache-Control'] = 'private, no-store'
+                    return res
+            res.set_etag(etag)
+            if user_state is None:
+                seconds = (current_app.config['CATALOG_PAGE_MAX_AGE']
+                           if max_age is None else max_age)
+                res.headers['Cache-Control'] = f'public, max-age={seconds}'
+            else:
+                res.headers['Cache-Control'] = 'private, no-cache'
+            if per_user:
+                res.vary.add('Cookie')
+            return res
+        return wrapper
+    return decorator
+
+
+def cached_page(pages, key, render):
+    """The response for `key` from `pages`, calling `render()` on a miss.
+
+    Only 200 responses without a CSRF token in them are stored.
+    """
+
+    found, cached = pages.get(key)
+    if found:
+        pages.hits += 1
+        body, mimetype = cached
+        return current_app.response_class(body, mimetype=mimetype)
+
+    pages.misses += 1
+    res = current_app.make_response(render())
+    if (res.status_code == 200 and not res.is_streamed
+            and not rendered_csrf_token()):
+        pages.set(key, (res.get_data(as_text=True), res.mimetype))
+    return res
+
+
+def static_url(filename):
+    """URL of a static file with its content hash, e.g. makeup.css?v=1a2b3c4d."""
+
+    path = os.path.join(current_app.static_folder, filename)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return url_for('static', filename=filename)
+
+    cached = _fingerprints.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as f:
+            cached = (mtime, hashlib.sha1(f.read()).hexdigest()[:8])
+        _fingerprints[path] = cached
+    return url_for('static', filename=filename, v=cached[1])
+
+
+def set_cache_headers(res):
+    """Cache-Control and ETag for responses no view chose a policy for."""
+
+    if request.endpoint == 'static':
+        if request.args.get('v'):
+            res.headers['Cache-Control'] = (
+                f'public, max-age={STATIC_MAX_AGE}, immutable')
+        else:
+            res.headers['Cache-Control'] = 'public, no-cache'
+        return res
+
+    if 'Cache-Control' in res.headers:
+        return res
+
+    if request.method != 'GET' or res.status_code != 200 or res.is_streamed:
+        res.headers['Cache-Control'] = 'no-store'
+        return res
+
+    res.headers['Cache-Control'] = 'private, no-cache'
+    if not res.direct_passthrough:
+        res.add_etag()
+        if etag_matches(res.get_etag()[0]):
+            res.status_code = 304
+            res.set_data(b'')
+    return res
+
+
+def choose_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(res):
+    """Compress a large enough text response if the client accepts it."""
+
+    if (res.status_code != 200 or res.direct_passthrough or res.is_streamed
+            or 'Content-Encoding' in res.headers
+            or not res.mimetype.startswith(COMPRESSIBLE_TYPES)):
+        return res
+
+    res.vary.add('Accept-Encoding')
+    data = res.get_data()
+    if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+        return res
+    encoding = choose_encoding()
+    if encoding is None:
+        return res
+
+    level = current_app.config['COMPRESS_LEVEL']
+    if encoding == 'br':
+        res.set_data(brotli.compress(data, quality=min(level, 11)))
+    else:
+        res.set_data(gzip.compress(data, compresslevel=level))
+    res.headers['Content-Encoding'] = encoding
+
+    # a different body needs a different strong ETag
+    etag, weak = res.get_etag()
+    if etag:
+        res.set_etag(f'{etag}-{encoding}', weak)
+    return res
+
+
+def init_http_cache(app, user_state):
+    """Install the caching and compression hooks.
+
+    `user_state()` returns what a logged-in user's pages vary with
+    (e.g. their id and profile version); it is part of the ETag.
+    Returns the page cache.
+    """
+
+    pages = make_cache(app.config, 'PAGE_CACHE')
+    app.extensions['http_cache'] = {'user_state': user_state, 'pages': pages}
+    app.jinja_env.globals['static_url'] = static_url
+
+    @app.after_request
+    def cache_and_compress(res):
+        return compress(set_cache_headers(res))
+
+    return pages
@@ -0,0 +1,348 @@
+"""Image proxy and thumbnail cache.
+
+Listing pages link product images as /img/<product_id>/<size> (through
+the `thumbnail_url()` template helper) instead of hotlinking the
+full-size upstream files. The first request for an image fetches it
+once; thumbnails are then made and served from a directory on local
+disk:
+
+- files are content-addressed: the original is stored under the SHA-256
+  of its bytes, and each thumbnail under that hash plus size and format,
+  so products sharing a picture share the files. A small per-URL file
+  maps the source URL to that hash
+- thumbnails are WebP for browsers that accept it, JPEG otherwise, made
+  with Pillow when it is installed; without Pillow the original is
+  served as is
+- the directory is kept under IMAGE_CACHE_MAX_BYTES by deleting the
+  least recently used files (mtime is the last use, as in FileCache)
+- files go out through send_file, so gunicorn can use sendfile(), and
+  URLs carrying the source's `v=` hash are cached for a year
+
+If the image can't be fetched the client is redirected to the original
+URL, so the page still shows it.
+"""
+
+import hashlib
+import io
+import os
+import threading
+from contextlib import contextmanager
+
+import requests
+from flask import (Blueprint, abort, current_app, redirect, request, send_file,
+                   url_for)
+
+from browse_index import current_index
+from http_cache import STATIC_MAX_AGE
+from models import db, Product
+from upstream import UpstreamClient, UpstreamError
+
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError
+except ImportError:  # optional; originals are served unresized
+    Image = None
+
+
+images = Blueprint('images', __name__)
+
+SIZES = {'small': 160, 'medium': 320, 'large': 640}
+FORMATS = {'webp': ('WEBP', 'image/webp'), 'jpg': ('JPEG', 'image/jpeg')}
+
+
+class ImageCache:
+    """Files in a directory, evicted least recently used past max_bytes."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = None
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.directory, name[:2], name)
+
+    def get(self, name):
+        """Path of `name` if cached (marking it used), else None."""
+
+        path = self.path(name)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def read(self, name):
+        path = self.get(name)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, name, data):
+        """Store `data` as `name` atomically; returns its path."""
+
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self._total()
+            else:
+                self._bytes += len(data)
+            over = self._bytes > self.max_bytes
+        if over:
+            self.evict()
+        return path
+
+    @contextmanager
+    def lock(self, name):
+        """Hold a lock private to `name`, so one thread makes each file.
+
+        Entries are counted and dropped by their last user, as in
+        BaseCache._fill_lock, so the dict doesn't grow with every file.
+        """
+
+        with self._lock:
+            entry = self._locks.setdefault(name, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[name]
+
+    def _files(self):
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size,
+                              os.path.join(root, name)))
+        return files
+
+    def _total(self):
+        return sum(size for _, size, _ in self._files())
+
+    def evict(self):
+        """Delete the least recently used files down to 90% of max_bytes.
+
+        Every worker shares the directory, so the real total is counted
+        again here rather than trusted from this worker's estimate.
+        """
+
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+        with self._lock:
+            self._bytes = total
+
+    def stats(self):
+        """Hits and misses count source images, not thumbnails."""
+
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'bytes': self._bytes,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else None}
+
+
+def source_url(item):
+    """The upstream image URL of a product card, Product or API record."""
+
+    get = item.get if isinstance(item, dict) else (
+        lambda name: getattr(item, name, None))
+    url = get('api_featured_image') or get('image_link')
+    if url and url.startswith('//'):
+        url = 'https:' + url
+    return url if url and url.startswith(('http://', 'https://')) else None
+
+
+def url_version(url):
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()[:8]
+
+
+def thumbnail_url(item, size='medium'):
+    """URL of `item`'s image at `size` for templates (the original URL if
+    there is no product id)."""
+
+    url = source_url(item)
+    product_id = item.get('id') if isinstance(item, dict) else getattr(item, 'id', None)
+    if url is None or product_id is None:
+        return url or ''
+    return url_for('images.thumbnail', product_id=product_id, size=size,
+                   v=url_version(url))
+
+
+def product_source(product_id):
+    """The image URL of a product, from the browse index when possible."""
+
+    card = current_index().cards.get(product_id)
+    if card is None:
+        card = db.session.get(Product, product_id)
+    return source_url(card) if card is not None else None
+
+
+def fetch(extension, url):
+    """(content hash, content type) of `url`, downloading it on a miss."""
+
+    cache = extension['cache']
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest() + '.url'
+    with cache.lock(key):
+        known = cache.read(key)
+        if known is not None:
+            digest, content_type = known.decode('ascii').split(' ', 1)
+            if cache.get(digest) is not None:
+                cache.hits += 1
+                return digest, content_type
+
+        cache.misses += 1
+
+        limit = current_app.config['IMAGE_MAX_SOURCE_BYTES']
+        res = extension['client'].get(url, stream=True)
+        try:
+            content_type = res.headers.get('Content-Type', '').split(';')[0]
+            if not content_type.startswith('image/'):
+                raise UpstreamError(f"{url} is {content_type or 'untyped'}")
+            data = bytearray()
+            for chunk in res.iter_content(64 * 1024):
+                data += chunk
+                if len(data) > limit:
+                    raise UpstreamError(f"{url} is over {limit} bytes")
+        except UpstreamError:
+            raise
+        except requests.RequestException as e:
+            # the connection dropped mid-body (ChunkedEncodingError etc.)
+            raise UpstreamError(f"{url} failed while reading: {e}") from e
+        finally:
+            res.close()
+
+        digest = hashlib.sha256(data).hexdigest()
+        cache.put(digest, bytes(data))
+        cache.put(key, f"{digest} {content_type}".encode('ascii'))
+        return digest, content_type
+
+
+def resize(data, width, fmt):
+    """`data` scaled to fit width x width and encoded as `fmt`."""
+
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft('RGB', (width, width))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((width, width))
+        if fmt == 'JPEG' and image.mode != 'RGB':
+            image = image.convert('RGB')
+        out = io.BytesIO()
+        image.save(out, fmt, quality=current_app.config['IMAGE_QUALITY'])
+        return out.getvalue()
+
+
+def thumbnail_file(extension, digest, content_type, size):
+    """(path, mimetype) of the `size` thumbnail of original `digest`.
+
+    The path is None if the original was evicted since it was fetched.
+    """
+
+    cache = extension['cache']
+    if Image is None:
+        return cache.get(digest), content_type
+
+    # only an explicit image/webp counts; old browsers send */* too
+    webp = 'image/webp' in request.accept_mimetypes.values()
+    ext = 'webp' if webp else 'jpg'
+    fmt, mimetype = FORMATS[ext]
+    name = f"{digest}-{size}.{ext}"
+    with cache.lock(name):
+        path = cache.get(name)
+        if path is None:
+            original = cache.read(digest)
+            if original is None:
+                return None, None
+            try:
+                path = cache.put(name, resize(original, SIZES[size], fmt))
+            except (UnidentifiedImageError, Image.DecompressionBombError,
+                    OSError):
+                # not something Pillow can (or should) scale: serve it unchanged
+                return cache.get(digest), content_type
+    return path, mimetype
+
+
+@images.route('/img/<int:product_id>/<size>')
+def thumbnail(product_id, size):
+    """A product's image at one of SIZES."""
+
+    if size not in SIZES:
+        abort(404)
+    url = product_source(product_id)
+    if url is None:
+        abort(404)
+
+    extension = current_app.extensions['images']
+    # another worker may evict the original between fetch and use; the
+    # second fetch downloads it again
+    for _ in range(2):
+        try:
+            digest, content_type = fetch(extension, url)
+        except UpstreamError:
+            return redirect(url)
+        path, mimetype = thumbnail_file(extension, digest, content_type, size)
+        if path is not None:
+            break
+    else:
+        return redirect(url)
+
+    try:
+        res = send_file(path, mimetype=mimetype, conditional=True,
+                        etag=os.path.basename(path))
+    except FileNotFoundError:
+        return redirect(url)
+    if request.args.get('v') == url_version(url):
+        res.headers['Cache-Control'] = f'public, max-age={STATIC_MAX_AGE}, immutable'
+    else:
+        res.headers['Cache-Control'] = (
+            f"public, max-age={current_app.config['IMAGE_MAX_AGE']}")
+    if Image is not None:
+        res.vary.add('Accept')
+    return res
+
+
+def init_images(app):
+    """Register /img and the thumbnail_url() template helper.
+
+    Images come through their own UpstreamClient, so a slow CDN can't
+    open the makeup API's circuit breaker. Returns the ImageCache.
+    """
+
+    cache = ImageCache(app.config['IMAGE_CACHE_DIR'],
+                       app.config['IMAGE_CACHE_MAX_BYTES'])
+    client = UpstreamClient(pool_size=app.config['UPSTREAM_POOL_SIZE'],
+                            connect_timeout=app.config['UPSTREAM_CONNECT_TIMEOUT'],
+                            read_timeout=app.config['UPSTREAM_READ_TIMEOUT'],
+                            retries=1)
+    app.extensions['images'] = {'cache': cache, 'client': client}
+    app.jinja_env.globals['thumbnail_url'] = thumbnail_url
+    app.register_blueprint(images)
+    return cache
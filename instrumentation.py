@@ -0,0 +1,189 @@
+"""Per-request instrumentation.
+
+For every request this records, on `g`:
+
+- the number of SQL statements and the time spent in them
+- time spent waiting on the makeup API (upstream.py reports it)
+- time spent rendering templates
+
+and then adds a `Server-Timing` header and logs one structured line per
+request to the "makeupfinder.requests" logger. Statements slower than
+SLOW_QUERY_MS are logged on their own to "makeupfinder.sql.slow", which
+replaces SQLALCHEMY_ECHO outside development.
+
+Query budgets: when SQL_QUERY_BUDGET is set (the test configuration sets
+it), a request that runs more statements than its budget fails with
+QueryBudgetExceeded, so an N+1 regression breaks the build instead of
+slowing production. A view can get its own budget with @query_budget(n).
+`assert_max_queries(n)` does the same check around any block of code.
+"""
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import (g, current_app, has_app_context, has_request_context,
+                   request, before_render_template, template_rendered)
+from sqlalchemy import event
+
+from models import db
+
+
+request_logger = logging.getLogger('makeupfinder.requests')
+slow_query_logger = logging.getLogger('makeupfinder.sql.slow')
+
+
+class QueryBudgetExceeded(AssertionError):
+    """A request or block ran more SQL statements than allowed."""
+
+
+_counters = threading.local()
+
+
+def add_timing(name, seconds):
+    """Add `seconds` to the current request's `name` timer."""
+
+    if has_request_context():
+        timings = g.setdefault('timings', {})
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    if has_request_context():
+        g.sql_statements = g.get('sql_statements', 0) + 1
+    for block in getattr(_counters, 'stack', ()):
+        block.append(statement)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    add_timing('db', elapsed)
+
+    threshold = (current_app.config.get('SLOW_QUERY_MS')
+                 if has_app_context() else None)
+    if threshold is not None and elapsed * 1000 >= threshold:
+        slow_query_logger.warning("%.1f ms: %s %r", elapsed * 1000,
+                                  statement, parameters)
+
+
+def _before_render(sender, template, context, **extra):
+    g.setdefault('render_start', []).append(time.perf_counter())
+
+
+def _after_render(sender, template, context, **extra):
+    starts = g.get('render_start')
+    if starts:
+        add_timing('template', time.perf_counter() - starts.pop())
+
+
+def query_budget(limit):
+    """Decorator: allow the view at most `limit` SQL statements."""
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            return view(*args, **kwargs)
+        wrapper.query_budget = limit
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def assert_max_queries(limit):
+    """Fail if the block runs more than `limit` SQL statements.
+
+        with assert_max_queries(3):
+            client.get('/products/1048')
+    """
+
+    statements = []
+    stack = getattr(_counters, 'stack', None)
+    if stack is None:
+        stack = _counters.stack = []
+    stack.append(statements)
+    try:
+        yield statements
+    finally:
+        stack.remove(statements)
+    if len(statements) > limit:
+        raise QueryBudgetExceeded(
+            f"{len(statements)} SQL statements, budget {limit}:\n" +
+            "\n".join(statements))
+
+
+def server_timing(timings, statements, total):
+    """Server-Timing header value, e.g. `db;dur=3.1;desc="4 queries"`."""
+
+    parts = [f'db;dur={timings.get("db", 0.0) * 1000:.1f};'
+             f'desc="{statements} queries"']
+    for name in ('upstream', 'template'):
+        if name in timings:
+            parts.append(f'{name};dur={timings[name] * 1000:.1f}')
+    parts.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(parts)
+
+
+def init_instrumentation(app):
+    """Hook SQL, template and request timing into `app`."""
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute',
+                     _before_cursor_execute)
+        event.listen(db.engine, 'after_cursor_execute',
+                     _after_cursor_execute)
+
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def report_timings(res):
+        start = g.get('request_start')
+        if start is None:
+            return res
+
+        total = time.perf_counter() - start
+        timings = g.get('timings', {})
+        statements = g.get('sql_statements', 0)
+
+        if app.config['SERVER_TIMING']:
+            res.headers['Server-Timing'] = server_timing(
+                timings, statements, total)
+
+        request_logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': res.status_code,
+            'duration_ms': round(total * 1000, 1),
+            'sql_count': statements,
+            'sql_ms': round(timings.get('db', 0.0) * 1000, 1),
+            'upstream_ms': round(timings.get('upstream', 0.0) * 1000, 1),
+            'template_ms': round(timings.get('template', 0.0) * 1000, 1),
+        }))
+        return res
+
+    @app.after_request
+    def check_query_budget(res):
+        if app.config.get('SQL_QUERY_BUDGET') is None:
+            return res
+        view = app.view_functions.get(request.endpoint)
+        budget = getattr(view, 'query_budget', None)
+        if budget is None:
+            budget = app.config['SQL_QUERY_BUDGET']
+        count = g.get('sql_statements', 0)
+        if count > budget:
+            raise QueryBudgetExceeded(
+                f"{request.method} {request.path} ran {count} SQL "
+                f"statements, budget {budget}")
+        return res
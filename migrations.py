@@ -0,0 +1,298 @@
+"""Schema migrations and index checks.
+
+`flask db upgrade` applies, in order, every migration in MIGRATIONS that
+isn't recorded in the schema_migrations table yet. Each step checks what
+is already there before changing it, so a fresh database (where step one
+creates everything from models.py) and an old one both end up with the
+same schema.
+
+`flask db explain` runs EXPLAIN on the app's hot lookups and fails if
+the planner doesn't use the index meant for each one.
+"""
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import inspect, select, text
+
+from models import (db, User, Review, Favorite, Product, Category, Tag,
+                    ProductSnapshot, ProductNeighbors, SchemaMigration,
+                    StoredSession, product_tags)
+from snapshots import record_snapshots, changed_since
+
+
+db_cli = AppGroup('db', help='Manage the database schema.')
+
+
+def add_column(conn, model, name, default=None):
+    """ALTER TABLE ... ADD COLUMN for `model.name` unless it exists."""
+
+    table = model.__table__
+    existing = {column['name'] for column in inspect(conn).get_columns(table.name)}
+    if name in existing:
+        return
+
+    column = table.columns[name]
+    ddl = f"ALTER TABLE {table.name} ADD COLUMN {name} " \
+          f"{column.type.compile(conn.dialect)}"
+    if default is not None:
+        ddl += f" DEFAULT {default}"
+    if not column.nullable:
+        ddl += " NOT NULL"
+    conn.execute(text(ddl))
+
+
+def create_indexes(conn, model):
+    for index in model.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
+def create_tables(conn):
+    """Create any table from models.py that doesn't exist yet."""
+
+    db.metadata.create_all(conn)
+
+
+def add_product_details(conn):
+    """Columns added for the local catalog and the current-user cache."""
+
+    for name in ('product_type', 'description', 'price', 'price_sign',
+                 'rating', 'product_link', 'website_link'):
+        add_column(conn, Product, name)
+    # rows from before this column get picked up by the next full index build
+    add_column(conn, Product, 'updated_at', "'1970-01-01 00:00:00'")
+    add_column(conn, User, 'profile_version', '1')
+    create_indexes(conn, Product)
+
+
+def drop_favorite_product_unique(conn):
+    """favorites.product_id was UNIQUE: one user per product, ever."""
+
+    constraints = [c for c in inspect(conn).get_unique_constraints('favorites')
+                   if c['column_names'] == ['product_id']]
+    if not constraints:
+        return
+
+    if conn.dialect.name != 'sqlite':
+        for constraint in constraints:
+            conn.execute(text(
+                f"ALTER TABLE favorites DROP CONSTRAINT {constraint['name']}"))
+        return
+
+    # SQLite can't drop a constraint; copy the rows into a new table.
+    conn.execute(text("ALTER TABLE favorites RENAME TO favorites_old"))
+    Favorite.__table__.create(conn)
+    conn.execute(text("INSERT INTO favorites (id, user_id, product_id) "
+                      "SELECT id, user_id, product_id FROM favorites_old"))
+    conn.execute(text("DROP TABLE favorites_old"))
+
+
+def add_hot_path_indexes(conn):
+    """Indexes for the review, favorite, tag and username lookups."""
+
+    drop_favorite_product_unique(conn)
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    for model in (Favorite, Review, Tag, User):
+        create_indexes(conn, model)
+
+
+def fill_product_tags(conn):
+    """Create product_tags and fill it from products.tag_list."""
+
+    product_tags.create(conn, checkfirst=True)
+    if conn.execute(select(product_tags.c.product_id).limit(1)).first():
+        return
+
+    tag_ids = {}
+    for tag_id, name in conn.execute(select(Tag.id, Tag.tag_list)):
+        tag_ids.setdefault(name, tag_id)
+
+    links = set()
+    rows = conn.execute(select(Product.id, Product.tag_list)
+                        .where(Product.tag_list.is_not(None)))
+    for product_id, tag_list in rows:
+        for name in filter(None, tag_list.split(',')):
+            if name not in tag_ids:
+                tag_ids[name] = conn.execute(
+                    Tag.__table__.insert().values(tag_list=name)
+                ).inserted_primary_key[0]
+            links.add((product_id, tag_ids[name]))
+    if links:
+        conn.execute(product_tags.insert(),
+                     [{'product_id': product_id, 'tag_id': tag_id}
+                      for product_id, tag_id in links])
+
+
+def fill_product_snapshots(conn):
+    """Create product_snapshots and fill it from the products table."""
+
+    ProductSnapshot.__table__.create(conn, checkfirst=True)
+    columns = [Product.id] + [getattr(Product, field) for field in
+                              ('price', 'price_sign', 'rating', 'product_link',
+                               'website_link', 'image_link', 'api_featured_image')]
+    result = conn.execute(select(*columns).order_by(Product.id))
+    while batch := result.fetchmany(1000):
+        record_snapshots(conn, [row._asdict() for row in batch])
+
+
+def create_sessions(conn):
+    """Table for server-side sessions (sessions.py)."""
+
+    StoredSession.__table__.create(conn, checkfirst=True)
+
+
+def create_product_neighbors(conn):
+    """Table for precomputed similar products; filled by
+    `flask recommendations build`."""
+
+    ProductNeighbors.__table__.create(conn, checkfirst=True)
+
+
+def add_favorites_version(conn):
+    """users.favorites_version, bumped on every favorites change."""
+
+    add_column(conn, User, 'favorites_version', '0')
+
+
+MIGRATIONS = [
+    ('0001_create_tables', create_tables),
+    ('0002_product_details', add_product_details),
+    ('0003_hot_path_indexes', add_hot_path_indexes),
+    ('0004_product_tags', fill_product_tags),
+    ('0005_product_snapshots', fill_product_snapshots),
+    ('0006_sessions', create_sessions),
+    ('0007_product_neighbors', create_product_neighbors),
+    ('0008_favorites_version', add_favorites_version),
+]
+
+
+def applied_migrations(conn):
+    if not inspect(conn).has_table(SchemaMigration.__tablename__):
+        return set()
+    return set(conn.execute(select(SchemaMigration.name)).scalars())
+
+
+def upgrade():
+    """Apply pending migrations; returns the names applied."""
+
+    applied = []
+    with db.engine.begin() as conn:
+        SchemaMigration.__table__.create(conn, checkfirst=True)
+        done = applied_migrations(conn)
+        for name, migrate in MIGRATIONS:
+            if name in done:
+                continue
+            migrate(conn)
+            conn.execute(SchemaMigration.__table__.insert().values(name=name))
+            applied.append(name)
+    return applied
+
+
+def hot_queries():
+    """(description, statement, index it should use, dialects) tuples.
+
+    The statements match the ones the routes run. An index of None means
+    any index will do (e.g. one backing a UNIQUE constraint).
+    """
+
+    return [
+        ('reviews of a product, newest first',
+         select(Review).where(Review.product_id == 1)
+         .order_by(Review.timestamp.desc(), Review.id.desc()).limit(21),
+         'ix_reviews_product_timestamp', None),
+        ('reviews by a user, newest first',
+         select(Review).where(Review.user_id == 1)
+         .order_by(Review.timestamp.desc(), Review.id.desc()).limit(21),
+         'ix_reviews_user_timestamp', None),
+        ('favorites of a user',
+         select(Favorite.product_id).where(Favorite.user_id == 1),
+         'ix_favorites_user_product', None),
+        ('tag by name',
+         select(Tag).where(Tag.tag_list == 'Vegan'),
+         'ix_tags_tag_list', None),
+        ('products carrying every tag in a set',
+         Tag.product_ids(['Vegan', 'cruelty free']),
+         'ix_product_tags_tag_product', None),
+        ('price snapshots changed since a time',
+         changed_since('2024-01-01'),
+         'ix_product_snapshots_changed_at', None),
+        ('expired sessions to sweep',
+         select(StoredSession.sid)
+         .where(StoredSession.expires_at <= '2024-01-01').limit(500),
+         'ix_sessions_expires_at', None),
+        ('category by product type',
+         select(Category).where(Category.product_type == 'lipstick'),
+         None, None),
+        ('username substring search',
+         select(User).where(User.username.like('%ann%')),
+         'ix_users_username_trgm', ('postgresql',)),
+    ]
+
+
+def explain(conn, statement):
+    """The query plan for `statement` as a list of lines."""
+
+    sql = str(statement.compile(dialect=conn.dialect,
+                                compile_kwargs={'literal_binds': True}))
+    if conn.dialect.name == 'sqlite':
+        return [row[-1] for row in conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+    return [row[0] for row in conn.execute(text(f"EXPLAIN {sql}"))]
+
+
+def uses_index(plan, index):
+    plan = '\n'.join(plan)
+    if index is not None:
+        return index in plan
+    return 'INDEX' in plan.upper()
+
+
+def check_plans():
+    """Yield (description, plan, ok) for every hot query on this database."""
+
+    with db.engine.connect() as conn:
+        if conn.dialect.name not in ('sqlite', 'postgresql'):
+            return
+        if conn.dialect.name == 'postgresql':
+            # small dev tables would otherwise always be scanned
+            conn.execute(text("SET enable_seqscan = off"))
+        for description, statement, index, dialects in hot_queries():
+            if dialects and conn.dialect.name not in dialects:
+                continue
+            plan = explain(conn, statement)
+            yield description, plan, uses_index(plan, index)
+        conn.rollback()
+
+
+@db_cli.command('upgrade')
+def upgrade_command():
+    """Bring the database schema up to date."""
+
+    applied = upgrade()
+    if not applied:
+        click.echo("Schema is up to date.")
+    for name in applied:
+        click.echo(f"Applied {name}")
+
+
+@db_cli.command('status')
+def status_command():
+    """List migrations and whether they have been applied."""
+
+    with db.engine.connect() as conn:
+        done = applied_migrations(conn)
+    for name, _ in MIGRATIONS:
+        click.echo(f"[{'x' if name in done else ' '}] {name}")
+
+
+@db_cli.command('explain')
+def explain_command():
+    """Check that the hot queries use their indexes."""
+
+    failed = 0
+    for description, plan, ok in check_plans():
+        click.echo(f"{'ok  ' if ok else 'FAIL'} {description}")
+        for line in plan:
+            click.echo(f"       {line}")
+        failed += not ok
+    if failed:
+        raise click.ClickException(f"{failed} queries don't use their index")
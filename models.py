@@ -2,19 +2,37 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 import os
 
+from passwords import password_hasher
+
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 
+# every tag a product carries (Product.tag_id only holds the first one)
+product_tags = db.Table(
+    'product_tags',
+    db.Column('product_id', db.Integer,
+              db.ForeignKey('products.id', ondelete='cascade'),
+              primary_key=True),
+    db.Column('tag_id', db.Integer,
+              db.ForeignKey('tags.id', ondelete='cascade'),
+              primary_key=True),
+    db.Index('ix_product_tags_tag_product', 'tag_id', 'product_id'),
+)
+
+
 class Favorite(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'favorites'
+    __table_args__ = (
+        # one row per (user, product); also serves "favorites of user X"
+        db.Index('ix_favorites_user_product', 'user_id', 'product_id',
+                 unique=True),
+    )
 
     id = db.Column(
         db.Integer,
@@ -29,7 +47,6 @@ class Favorite(db.Model):
     product_id = db.Column(
         db.Integer,
         db.ForeignKey('products.id', ondelete='cascade'),
-        unique=True
     )
 
 
@@ -37,6 +54,13 @@ class User(db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
+    __table_args__ = (
+        # username substring search (list_users); PostgreSQL only
+        db.Index('ix_users_username_trgm', 'username',
+                 postgresql_using='gin',
+                 postgresql_ops={'username': 'gin_trgm_ops'}
+                 ).ddl_if(dialect='postgresql'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -65,6 +89,23 @@ class User(db.Model):
         nullable=False,
     )
 
+    # bumped on every profile change so cached copies (current_user.py)
+    # can tell they are out of date
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    # bumped with every change to the user's favorites, in the same
+    # transaction, so cached favorite sets and pages (favorites.py) can
+    # tell they are out of date
+    favorites_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
     # this allows message table to get information from this review table
     reviews = db.relationship('Review', backref="user",
                               cascade="all,delete-orphan")
@@ -84,7 +125,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_hasher().hash(password)
 
         user = User(
             username=username,
@@ -109,13 +150,25 @@ class User(db.Model):
 
         user = cls.query.filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            return user
 
         return False
 
+    def check_password(self, password):
+        """True if `password` is this user's.
+
+        A hash made with another BCRYPT_LOG_ROUNDS is replaced (the
+        caller commits).
+        """
+
+        hasher = password_hasher()
+        if not hasher.check(self.password, password):
+            return False
+        if hasher.needs_rehash(self.password):
+            self.password = hasher.hash(password)
+        return True
+
 
 class Postreview(db.Model):
 
@@ -146,7 +199,7 @@ class Review(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
     user_id = db.Column(
         db.Integer,
@@ -215,6 +268,49 @@ class Product(db.Model):
 
     )
 
+    product_type = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
+    description = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
+    price = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
+    price_sign = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
+    rating = db.Column(
+        db.Float,
+        nullable=True,
+    )
+
+    product_link = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
+    website_link = db.Column(
+        db.Text,
+        nullable=True,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        index=True,
+    )
+
     category_id = db.Column(
         db.Integer,
         db.ForeignKey('categories.id', ondelete='cascade')
@@ -228,6 +324,38 @@ class Product(db.Model):
     reviews = db.relationship('Review', backref="product",
                               cascade="all,delete-orphan")
 
+    category = db.relationship('Category', backref="products")
+
+    all_tags = db.relationship('Tag', secondary=product_tags,
+                               backref="tagged_products")
+
+    @property
+    def tag_names(self):
+        """Tags for this product as a list (stored comma separated)."""
+
+        if not self.tag_list:
+            return []
+        return [tag for tag in self.tag_list.split(',') if tag]
+
+    def to_dict(self):
+        """Serialize product in the same shape as the makeup API."""
+
+        return {
+            'id': self.id,
+            'brand': self.brand,
+            'name': self.name,
+            'price': self.price,
+            'price_sign': self.price_sign,
+            'image_link': self.image_link,
+            'product_link': self.product_link,
+            'website_link': self.website_link,
+            'description': self.description,
+            'rating': self.rating,
+            'product_type': self.product_type,
+            'tag_list': self.tag_names,
+            'api_featured_image': self.api_featured_image,
+        }
+
     # def __init__(self, id, no, brand, name, description):
     #     self.id = id
     #     self.no = no
@@ -262,10 +390,33 @@ class Tag(db.Model):
 
     tag_list = db.Column(db.Text,
                          nullable=False,
+                         index=True,
                          )
 
     products = db.relationship('Product', backref="tags")
 
+    @classmethod
+    def product_ids(cls, names, match_all=True):
+        """SELECT of the ids of products tagged with `names`.
+
+        With match_all a product needs every tag, otherwise any of them.
+        Tag names are compared case-insensitively.
+        """
+
+        names = {name.casefold() for name in names}
+        tag_name = db.func.lower(cls.tag_list)
+        # resolve the (few) tag ids first so product_tags is searched by
+        # tag_id; the join supplies the names for the AND count
+        tag_ids = db.select(cls.id).where(tag_name.in_(names))
+        query = (db.select(product_tags.c.product_id)
+                 .join(cls, cls.id == product_tags.c.tag_id)
+                 .where(product_tags.c.tag_id.in_(tag_ids)))
+        if match_all:
+            query = (query
+                     .group_by(product_tags.c.product_id)
+                     .having(db.func.count(db.distinct(tag_name)) == len(names)))
+        return query
+
 
 class Brand(db.Model):
     __tablename__ = 'brands'
@@ -278,6 +429,167 @@ class Brand(db.Model):
                      unique=True)
 
 
+class ProductSnapshot(db.Model):
+    """The upstream price / rating / link fields of a product.
+
+    Written by every catalog sync, but only when content_hash (a hash of
+    the fields) differs from the stored one; changed_at is when that last
+    happened. Product pages read these instead of calling the API.
+    """
+
+    __tablename__ = 'product_snapshots'
+
+    product_id = db.Column(db.Integer,
+                           db.ForeignKey('products.id', ondelete='cascade'),
+                           primary_key=True)
+
+    content_hash = db.Column(db.Text,
+                             nullable=False)
+
+    price = db.Column(db.Text,
+                      nullable=True)
+
+    price_sign = db.Column(db.Text,
+                           nullable=True)
+
+    rating = db.Column(db.Float,
+                       nullable=True)
+
+    product_link = db.Column(db.Text,
+                             nullable=True)
+
+    website_link = db.Column(db.Text,
+                             nullable=True)
+
+    image_link = db.Column(db.Text,
+                           nullable=True)
+
+    api_featured_image = db.Column(db.Text,
+                                   nullable=True)
+
+    changed_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.utcnow,
+                           index=True)
+
+    product = db.relationship('Product',
+                              backref=db.backref('snapshot', uselist=False))
+
+
+class ProductNeighbors(db.Model):
+    """Precomputed "also favorited" products (see recommendations.py).
+
+    neighbor_ids and scores are packed little-endian int32 / float32
+    arrays, best first.
+    """
+
+    __tablename__ = 'product_neighbors'
+
+    product_id = db.Column(db.Integer,
+                           db.ForeignKey('products.id', ondelete='cascade'),
+                           primary_key=True)
+
+    neighbor_ids = db.Column(db.LargeBinary,
+                             nullable=False)
+
+    scores = db.Column(db.LargeBinary,
+                       nullable=False)
+
+    stale = db.Column(db.Boolean,
+                      nullable=False,
+                      default=False)
+
+    computed_at = db.Column(db.DateTime,
+                            nullable=False,
+                            default=datetime.utcnow)
+
+    product = db.relationship('Product',
+                              backref=db.backref('neighbors', uselist=False))
+
+
+class CatalogSync(db.Model):
+    """One run of the catalog sync from the makeup API.
+
+    status is 'running', 'ok', 'unchanged' (upstream answered 304 or
+    sent nothing new) or 'failed'. The id of the newest 'ok' run is the catalog version."""
+
+    __tablename__ = 'catalog_syncs'
+
+    id = db.Column(db.Integer,
+                   primary_key=True,
+                   autoincrement=True)
+
+    started_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.utcnow)
+
+    finished_at = db.Column(db.DateTime,
+                            nullable=True)
+
+    status = db.Column(db.Text,
+                       nullable=False,
+                       default='running')
+
+    source = db.Column(db.Text,
+                       nullable=True)
+
+    product_count = db.Column(db.Integer,
+                              nullable=False,
+                              default=0)
+
+    error = db.Column(db.Text,
+                      nullable=True)
+
+    # validators from the upstream response, sent back on the next sync
+    etag = db.Column(db.Text,
+                     nullable=True)
+
+    last_modified = db.Column(db.Text,
+                              nullable=True)
+
+
+# newest-first review listings for a product and for a user; id breaks
+# ties the same way pagination.review_page does
+db.Index('ix_reviews_product_timestamp',
+         Review.product_id, Review.timestamp.desc(), Review.id.desc())
+db.Index('ix_reviews_user_timestamp',
+         Review.user_id, Review.timestamp.desc(), Review.id.desc())
+
+# the trigram opclass needs the extension before the index can be built
+db.event.listen(User.__table__, 'before_create',
+                db.DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'
+                       ).execute_if(dialect='postgresql'))
+
+
+class StoredSession(db.Model):
+    """A server-side session (see sessions.py); the cookie holds only sid."""
+
+    __tablename__ = 'sessions'
+
+    sid = db.Column(db.String(64),
+                    primary_key=True)
+
+    data = db.Column(db.Text,
+                     nullable=False)
+
+    expires_at = db.Column(db.DateTime,
+                           nullable=False,
+                           index=True)
+
+
+class SchemaMigration(db.Model):
+    """A migration from migrations.py that has been applied."""
+
+    __tablename__ = 'schema_migrations'
+
+    name = db.Column(db.Text,
+                     primary_key=True)
+
+    applied_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.utcnow)
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
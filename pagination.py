@@ -0,0 +1,88 @@
+"""Keyset (cursor) pagination for listings.
+
+Pages are found by "everything after the last row I showed", never by
+OFFSET, so page 50 costs the same as page 1:
+
+- product listings are ordered by id; the cursor is the last id
+  (`?after=1048`)
+- review listings are newest first; the cursor is the last review's
+  timestamp and id (`?before=2023-06-01T12:00:00_42`), the id breaking
+  ties between reviews posted in the same instant
+"""
+
+from bisect import bisect_right
+from datetime import datetime
+
+from flask import request, url_for
+from sqlalchemy import and_, or_
+
+from models import Product, Review
+
+
+def product_page(query, after=None, size=48):
+    """One page of `query` ordered by Product.id.
+
+    Returns (products, next_cursor); next_cursor is None on the last page.
+    """
+
+    query = query.order_by(Product.id)
+    if after is not None:
+        query = query.filter(Product.id > after)
+    rows = query.limit(size + 1).all()
+    if len(rows) > size:
+        return rows[:size], rows[size - 1].id
+    return rows, None
+
+
+def id_page(ids, after=None, size=48):
+    """Same as product_page for a sorted list of ids held in memory."""
+
+    start = bisect_right(ids, after) if after is not None else 0
+    page = list(ids[start:start + size])
+    if start + size < len(ids):
+        return page, page[-1]
+    return page, None
+
+
+def review_cursor(review):
+    return f"{review.timestamp.isoformat()}_{review.id}"
+
+
+def parse_review_cursor(cursor):
+    """(timestamp, id) from a review cursor, or None if it is malformed."""
+
+    try:
+        timestamp, review_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(timestamp), int(review_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def review_page(query, before=None, size=20):
+    """One page of `query`, newest reviews first.
+
+    Returns (reviews, next_cursor); next_cursor is None on the last page.
+    """
+
+    query = query.order_by(Review.timestamp.desc(), Review.id.desc())
+    position = parse_review_cursor(before) if before else None
+    if position is not None:
+        timestamp, review_id = position
+        query = query.filter(or_(
+            Review.timestamp < timestamp,
+            and_(Review.timestamp == timestamp, Review.id < review_id)))
+    rows = query.limit(size + 1).all()
+    if len(rows) > size:
+        return rows[:size], review_cursor(rows[size - 1])
+    return rows, None
+
+
+def next_page_url(param, cursor):
+    """URL of the current page with `param` set to `cursor`, or None."""
+
+    if cursor is None:
+        return None
+    args = request.args.to_dict(flat=False)
+    args[param] = cursor
+    # a query arg named like a view arg (/brands/x?name=y) loses to it
+    return url_for(request.endpoint, **{**args, **request.view_args})
@@ -0,0 +1,211 @@
+"""Password hashing off the request thread, with rate limits.
+
+bcrypt is slow on purpose, so a burst of logins would otherwise keep
+every worker busy hashing while catalog pages wait. Instead:
+
+- hashes are computed in a small process pool (PASSWORD_WORKERS
+  processes per gunicorn worker), so password work can use at most that
+  much CPU however many requests arrive
+- at most PASSWORD_MAX_PENDING hashes may be queued or running per
+  worker; past that, and when a hash takes longer than PASSWORD_TIMEOUT
+  seconds, PasswordsBusy (429) is raised instead of waiting
+- each client IP and each username gets LOGIN_RATE_LIMIT attempts per
+  LOGIN_RATE_WINDOW seconds (per worker); more raises TooManyAttempts
+  (429)
+
+The cost factor is BCRYPT_LOG_ROUNDS. `needs_rehash()` spots hashes made
+with another cost, and User.check_password rehashes them on the next
+successful login, so changing it locks nobody out. PASSWORD_WORKERS=0
+hashes inline (for tests and the dev server).
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+from flask import current_app, request
+from werkzeug.exceptions import TooManyRequests
+
+
+# bcrypt only looks at the first 72 bytes (newer versions refuse longer input)
+MAX_PASSWORD_BYTES = 72
+
+
+class PasswordsBusy(TooManyRequests):
+    """Too much password hashing is queued in this worker."""
+
+    description = "Too many logins right now, please try again in a moment."
+
+
+class TooManyAttempts(TooManyRequests):
+    """A client IP or username went over LOGIN_RATE_LIMIT."""
+
+    description = "Too many attempts, please wait a minute and try again."
+
+
+def _secret(password):
+    return password.encode('utf-8')[:MAX_PASSWORD_BYTES]
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(_secret(password), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(hashed, password):
+    try:
+        return bcrypt.checkpw(_secret(password), hashed.encode('utf-8'))
+    except ValueError:  # not a bcrypt hash
+        return False
+
+
+def hash_rounds(hashed):
+    """The cost factor of a '$2b$12$...' hash (None if it isn't one)."""
+
+    parts = (hashed or '').split('$')
+    return int(parts[2]) if len(parts) > 3 and parts[2].isdigit() else None
+
+
+class PasswordHasher:
+    """bcrypt in a bounded process pool; one per app, pool per worker."""
+
+    def __init__(self, rounds=12, workers=1, max_pending=4, timeout=10):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(rounds=config['BCRYPT_LOG_ROUNDS'],
+                   workers=config['PASSWORD_WORKERS'],
+                   max_pending=config['PASSWORD_MAX_PENDING'],
+                   timeout=config['PASSWORD_TIMEOUT'])
+
+    @property
+    def executor(self):
+        """The worker's hashing processes, started on first use (so each
+        gunicorn worker gets its own after the fork)."""
+
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _reset_executor(self):
+        with self._lock:
+            self._executor = None
+
+    def run(self, fn, *args):
+        """fn(*args) in the pool, or raise PasswordsBusy."""
+
+        if not self.workers:
+            return fn(*args)
+
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise PasswordsBusy(retry_after=1)
+        try:
+            future = self.executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._slots.release()
+            self._reset_executor()
+            raise
+        # the slot is freed when the hash finishes, even if we gave up on it
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            self.rejected += 1
+            raise PasswordsBusy(retry_after=max(1, round(self.timeout)))
+        except BrokenProcessPool:
+            self._reset_executor()
+            raise
+
+    def hash(self, password):
+        return self.run(_hash, password, self.rounds)
+
+    def check(self, hashed, password):
+        return self.run(_check, hashed, password)
+
+    def needs_rehash(self, hashed):
+        return hash_rounds(hashed) != self.rounds
+
+    def stats(self):
+        return {'workers': self.workers, 'max_pending': self.max_pending,
+                'rejected': self.rejected}
+
+
+class RateLimiter:
+    """Fixed-window counters: `limit` hits per key every `window` seconds."""
+
+    def __init__(self, limit=10, window=60):
+        self.limit = limit
+        self.window = window
+        self.rejected = 0
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key):
+        """Count one attempt for `key`; False if it is over the limit."""
+
+        current = int(time.monotonic() // self.window)
+        with self._lock:
+            window, count = self._counts.get(key, (current, 0))
+            if window != current:
+                count = 0
+            if count >= self.limit:
+                self.rejected += 1
+                return False
+            self._counts[key] = (current, count + 1)
+            if len(self._counts) > 10000:
+                self._counts = {k: v for k, v in self._counts.items()
+                                if v[0] == current}
+            return True
+
+    def retry_after(self):
+        return int(self.window - time.monotonic() % self.window) + 1
+
+
+def init_passwords(app):
+    """Create the app's PasswordHasher and login RateLimiter from config."""
+
+    app.extensions['passwords'] = {
+        'hasher': PasswordHasher.from_config(app.config),
+        'limiter': RateLimiter(app.config['LOGIN_RATE_LIMIT'],
+                               app.config['LOGIN_RATE_WINDOW']),
+    }
+
+
+def password_hasher():
+    return current_app.extensions['passwords']['hasher']
+
+
+def limit_attempts(username=None):
+    """Count a password attempt for this client IP and `username`.
+
+    Raises TooManyAttempts if either is over LOGIN_RATE_LIMIT.
+    """
+
+    limiter = current_app.extensions['passwords']['limiter']
+    keys = [f'ip:{request.remote_addr}']
+    if username:
+        keys.append(f'user:{username.casefold()}')
+    # count every key, so a spread-out attack still trips the username limit
+    allowed = [limiter.hit(key) for key in keys]
+    if not all(allowed):
+        raise TooManyAttempts(retry_after=limiter.retry_after())
+
+
+def password_stats():
+    extension = current_app.extensions['passwords']
+    return dict(extension['hasher'].stats(),
+                rate_limited=extension['limiter'].rejected)
@@ -0,0 +1,331 @@
+"""'Users who favorited this also favorited' from co-occurrence counts.
+
+A user likes a product if they favorited or reviewed it. Two products
+co-occur once for every user who likes both, and b's score as a
+neighbor of a is the cosine
+
+    cooccurrences(a, b) / sqrt(likes(a) * likes(b))
+
+so a product everyone likes doesn't top every list. The counts come
+from the sparse user x product matrix with NumPy: each user's likes are
+expanded into (a, b) pairs, and the pairs are counted with np.unique.
+Nothing is joined per request.
+
+Each product's best RECOMMENDATIONS_TOP_K neighbors are stored in
+product_neighbors as packed arrays, one row per product. The product
+page loads that row with the product itself.
+
+- `flask recommendations build` recomputes every row (e.g. nightly)
+- when a user's favorites change, `mark_stale()` marks the rows of the
+  products that changed and of the user's other favorites stale; that
+  is all a favorite click costs
+- `refresh_stale()` recomputes the stale rows, every
+  RECOMMENDATIONS_REFRESH_INTERVAL seconds on a background thread and
+  with `flask recommendations refresh`
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime
+
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import delete, func, literal, select, union
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, Favorite, Product, Review, ProductNeighbors
+
+
+logger = logging.getLogger(__name__)
+
+recommendations_cli = AppGroup(
+    'recommendations', help='Precompute "also favorited" products.')
+
+# users who like more than this many products add little signal and
+# n^2 pairs, so they are left out of the co-occurrence counts
+MAX_USER_LIKES = 500
+# pairs expanded at a time (two int64 arrays of this length)
+CHUNK_PAIRS = 2_000_000
+WRITE_BATCH = 1000
+# stale rows recomputed per background pass
+REFRESH_BATCH = 1000
+
+
+def likes(user_ids=None):
+    """SELECT of distinct (user_id, product_id) favorites and reviews."""
+
+    favorites = select(Favorite.user_id, Favorite.product_id)
+    reviews = (select(Review.user_id, Review.product_id)
+               .where(Review.user_id.is_not(None),
+                      Review.product_id.is_not(None)))
+    if user_ids is not None:
+        favorites = favorites.where(Favorite.user_id.in_(user_ids))
+        reviews = reviews.where(Review.user_id.in_(user_ids))
+    return union(favorites, reviews)
+
+
+def fans(product_ids):
+    """SELECT of the users who like any of `product_ids`."""
+
+    return union(
+        select(Favorite.user_id).where(Favorite.product_id.in_(product_ids)),
+        select(Review.user_id).where(Review.product_id.in_(product_ids),
+                                     Review.user_id.is_not(None)))
+
+
+def fetch_pairs(conn, statement):
+    """Two int64 arrays from a two-column SELECT."""
+
+    parts = [np.array(rows, dtype=np.int64).reshape(-1, 2)
+             for rows in conn.execute(statement).partitions(100_000)]
+    pairs = np.concatenate(parts) if parts else np.empty((0, 2), np.int64)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def ramp(sizes):
+    """0..n-1 for every n in `sizes`, concatenated."""
+
+    ends = np.cumsum(sizes)
+    return np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - sizes, sizes)
+
+
+def run_starts(values):
+    """Indexes where a new run of equal values starts in sorted `values`."""
+
+    if not len(values):
+        return np.empty(0, np.int64)
+    return np.flatnonzero(np.append(True, values[1:] != values[:-1]))
+
+
+def cooccurrences(users, products, rows=None):
+    """Sparse co-occurrence counts as arrays (a, b, count), a != b.
+
+    With `rows`, only pairs whose a is in `rows` are counted.
+    """
+
+    order = np.lexsort((products, users))
+    users, products = users[order], products[order]
+    _, starts, sizes = np.unique(users, return_index=True, return_counts=True)
+    keep = (sizes > 1) & (sizes <= MAX_USER_LIKES)
+    starts, sizes = starts[keep], sizes[keep]
+
+    width = int(products.max()) + 1 if len(products) else 1
+    keys, counts = [], []
+    chunk_of_user = (np.cumsum(sizes ** 2) - 1) // CHUNK_PAIRS
+    for chunk in np.unique(chunk_of_user):
+        chunk_starts = starts[chunk_of_user == chunk]
+        chunk_sizes = sizes[chunk_of_user == chunk]
+        # each like of a user, repeated once per like of the same user
+        first = np.repeat(chunk_starts, chunk_sizes)
+        repeats = np.repeat(chunk_sizes, chunk_sizes)
+        a = np.repeat(products[first + ramp(chunk_sizes)], repeats)
+        b = products[np.repeat(first, repeats) + ramp(repeats)]
+        wanted = a != b
+        if rows is not None:
+            wanted &= np.isin(a, rows)
+        chunk_keys, chunk_counts = np.unique(a[wanted] * width + b[wanted],
+                                             return_counts=True)
+        keys.append(chunk_keys)
+        counts.append(chunk_counts)
+
+    if not keys:
+        empty = np.empty(0, np.int64)
+        return empty, empty, empty
+    keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate(counts)).astype(np.int64)
+    return keys // width, keys % width, counts
+
+
+def top_neighbors(a, b, scores, k):
+    """Yield (product_id, neighbor ids, scores) with the k best b per a.
+
+    `a` and `b` are sorted as cooccurrences() returns them; scores are
+    in (0, 1], so one stable sort on 3a - score orders by a, then best
+    score, then b.
+    """
+
+    order = np.argsort(3 * a - scores, kind='stable')
+    a, b, scores = a[order], b[order], scores[order]
+    best = ramp(np.diff(np.append(run_starts(a), len(a)))) < k
+    a, b, scores = a[best], b[best], scores[best]
+    starts = run_starts(a)
+    for product_id, ids, values in zip(a[starts], np.split(b, starts[1:]),
+                                       np.split(scores, starts[1:])):
+        yield int(product_id), ids, values
+
+
+def cosine(a, b, counts, liked_ids, liked_counts):
+    """Score co-occurrence counts by the like counts of both products."""
+
+    by_id = np.zeros(int(liked_ids.max()) + 1 if len(liked_ids) else 1)
+    by_id[liked_ids] = liked_counts
+    return counts / np.sqrt(by_id[a] * by_id[b])
+
+
+def like_counts(conn, product_ids):
+    """Product ids and how many users like each."""
+
+    liked = likes().subquery()
+    ids, counts = [], []
+    product_ids = sorted(product_ids)
+    for i in range(0, len(product_ids), WRITE_BATCH):
+        batch = product_ids[i:i + WRITE_BATCH]
+        rows = conn.execute(select(liked.c.product_id, func.count())
+                            .where(liked.c.product_id.in_(batch))
+                            .group_by(liked.c.product_id)).all()
+        ids.extend(row[0] for row in rows)
+        counts.extend(row[1] for row in rows)
+    return np.array(ids, np.int64), np.array(counts, np.int64)
+
+
+def store(conn, neighbors):
+    """Upsert (product_id, ids, scores) rows; returns how many."""
+
+    module = postgresql if conn.dialect.name == 'postgresql' else sqlite
+    stmt = module.insert(ProductNeighbors)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['product_id'],
+        set_={name: stmt.excluded[name] for name in
+              ('neighbor_ids', 'scores', 'stale', 'computed_at')})
+
+    now = datetime.utcnow()
+    written, batch = 0, []
+    for product_id, ids, scores in neighbors:
+        batch.append({'product_id': product_id,
+                      'neighbor_ids': ids.astype('<i4').tobytes(),
+                      'scores': scores.astype('<f4').tobytes(),
+                      'stale': False,
+                      'computed_at': now})
+        if len(batch) == WRITE_BATCH:
+            conn.execute(stmt, batch)
+            written, batch = written + len(batch), []
+    if batch:
+        conn.execute(stmt, batch)
+        written += len(batch)
+    return written
+
+
+def build(conn, k):
+    """Recompute every product's neighbors; returns how many have some."""
+
+    started = datetime.utcnow()
+    users, products = fetch_pairs(conn, likes())
+    a, b, counts = cooccurrences(users, products)
+    liked_ids, liked_counts = np.unique(products, return_counts=True)
+    scores = cosine(a, b, counts, liked_ids, liked_counts)
+    written = store(conn, top_neighbors(a, b, scores, k))
+    # products nobody co-likes any more
+    conn.execute(delete(ProductNeighbors)
+                 .where(ProductNeighbors.computed_at < started))
+    return written
+
+
+def refresh(conn, product_ids, k):
+    """Recompute the neighbors of `product_ids` only."""
+
+    product_ids = sorted(set(product_ids))
+    if not product_ids:
+        return 0
+    users, products = fetch_pairs(conn, likes(fans(product_ids)))
+    a, b, counts = cooccurrences(users, products,
+                                 rows=np.array(product_ids, np.int64))
+    liked_ids, liked_counts = like_counts(conn, np.union1d(a, b).tolist())
+    scores = cosine(a, b, counts, liked_ids, liked_counts)
+    written = store(conn, top_neighbors(a, b, scores, k))
+    conn.execute(delete(ProductNeighbors)
+                 .where(ProductNeighbors.product_id.in_(
+                     sorted(set(product_ids) - set(a.tolist())))))
+    return written
+
+
+def mark_stale(conn, user_id, product_ids):
+    """After `user_id`'s favorites of `product_ids` changed.
+
+    The rows of `product_ids`, and of the user's other favorites (each
+    gained or lost one co-occurrence), are marked stale in one statement
+    for refresh_stale(); products without neighbors yet get an empty row
+    to mark.
+    """
+
+    module = postgresql if conn.dialect.name == 'postgresql' else sqlite
+    changed = union(
+        select(Favorite.product_id).where(Favorite.user_id == user_id),
+        select(Product.id).where(Product.id.in_(list(product_ids)))).subquery()
+    # SQLite needs a WHERE in INSERT ... SELECT before ON CONFLICT
+    rows = (select(changed.c.product_id, literal(b''), literal(b''),
+                   literal(True), literal(datetime.utcnow()))
+            .where(changed.c.product_id.is_not(None)))
+    conn.execute(module.insert(ProductNeighbors)
+                 .from_select(['product_id', 'neighbor_ids', 'scores', 'stale',
+                               'computed_at'], rows)
+                 .on_conflict_do_update(index_elements=['product_id'],
+                                        set_={'stale': True}))
+
+
+def refresh_stale(conn, k, limit=None):
+    """Recompute up to `limit` stale rows, oldest first.
+
+    Returns (rows that were stale, rows stored with neighbors).
+    """
+
+    query = (select(ProductNeighbors.product_id)
+             .where(ProductNeighbors.stale)
+             .order_by(ProductNeighbors.computed_at))
+    if limit is not None:
+        query = query.limit(limit)
+    stale = conn.execute(query).scalars().all()
+    return len(stale), refresh(conn, stale, k)
+
+
+def start_background_refresh(app, interval):
+    """Run refresh_stale every `interval` seconds on a daemon thread.
+
+    Each worker runs one; refreshing a row twice only wastes the work.
+    """
+
+    def run_forever():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    with db.engine.begin() as conn:
+                        refresh_stale(conn,
+                                      app.config['RECOMMENDATIONS_TOP_K'],
+                                      REFRESH_BATCH)
+                except Exception:
+                    logger.exception("Background neighbor refresh crashed")
+
+    thread = threading.Thread(target=run_forever,
+                              name='recommendations-refresh', daemon=True)
+    thread.start()
+    return thread
+
+
+def neighbor_ids(row, limit=None):
+    """The neighbor product ids stored in a ProductNeighbors row."""
+
+    if row is None:
+        return []
+    return np.frombuffer(row.neighbor_ids, dtype='<i4')[:limit].tolist()
+
+
+@recommendations_cli.command('build')
+def build_command():
+    """Recompute the similar products of every product."""
+
+    with db.engine.begin() as conn:
+        count = build(conn, current_app.config['RECOMMENDATIONS_TOP_K'])
+    click.echo(f"Stored neighbors for {count} products.")
+
+
+@recommendations_cli.command('refresh')
+def refresh_command():
+    """Recompute the rows marked stale by favorite changes."""
+
+    with db.engine.begin() as conn:
+        stale, count = refresh_stale(conn,
+                                     current_app.config['RECOMMENDATIONS_TOP_K'])
+    click.echo(f"Refreshed {stale} stale products ({count} with neighbors).")
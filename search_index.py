@@ -0,0 +1,216 @@
+"""Embedded full-text search over the local catalog.
+
+Products are tokenized on name, brand, tags and description and ranked
+with BM25 (name, brand and tag matches weigh more than description).
+The last word of a query also matches as a prefix, so results show up
+while typing, and a word with no match at all is retried against
+vocabulary terms within one or two typos.
+
+The index lives in memory and follows the catalog the same way as the
+browse index, so it behaves the same on SQLite and PostgreSQL.
+"""
+
+import math
+import re
+from bisect import bisect_left
+from collections import namedtuple
+
+from flask import current_app
+
+from browse_index import CatalogIndex, product_card
+
+
+FIELD_WEIGHTS = {'name': 3.0, 'brand': 2.0, 'tags': 2.0, 'description': 1.0}
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+PREFIX_WEIGHT = 0.8
+FUZZY_WEIGHT = 0.5
+
+TOKEN_RE = re.compile(r"[^\W_]+")
+
+
+def tokenize(text):
+    """Lower-case word tokens of two or more characters."""
+
+    return [token for token in TOKEN_RE.findall((text or '').casefold())
+            if len(token) > 1]
+
+
+def product_fields(product):
+    return {
+        'name': product.name,
+        'brand': product.brand,
+        'tags': ' '.join(product.tag_names),
+        'description': product.description,
+    }
+
+
+def within_edits(a, b, max_edits):
+    """True if Levenshtein distance between a and b is <= max_edits."""
+
+    if abs(len(a) - len(b)) > max_edits:
+        return False
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1,
+                               current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        if min(current) > max_edits:
+            return False
+        previous = current
+    return previous[-1] <= max_edits
+
+
+# Everything a search reads, replaced as one object (see SearchIndex).
+Terms = namedtuple('Terms', 'postings doc_terms doc_len total_len vocabulary')
+
+
+def frequencies(product):
+    """({token: weighted term frequency}, weighted length) of a product."""
+
+    found = {}
+    length = 0.0
+    for field, text in product_fields(product).items():
+        weight = FIELD_WEIGHTS[field]
+        for token in tokenize(text):
+            found[token] = found.get(token, 0.0) + weight
+            length += weight
+    return found, length
+
+
+class SearchIndex(CatalogIndex):
+    """term -> {product id: weighted term frequency}, plus BM25 stats.
+
+    The postings and stats live in one Terms tuple that is never edited:
+    build and update make new dicts (copying only the posting lists they
+    touch) and swap the reference, so a search running on another thread
+    keeps a consistent view.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.terms = Terms({}, {}, {}, 0.0, [])
+
+    def build(self, products):
+        """Replace the whole index with `products`."""
+
+        postings, doc_terms, doc_len, cards = {}, {}, {}, {}
+        for product in products:
+            found, doc_len[product.id] = frequencies(product)
+            for token, tf in found.items():
+                postings.setdefault(token, {})[product.id] = tf
+            doc_terms[product.id] = set(found)
+            cards[product.id] = product_card(product)
+
+        self.terms = Terms(postings, doc_terms, doc_len,
+                           sum(doc_len.values()), sorted(postings))
+        self.cards = cards
+
+    def update(self, products):
+        """Re-index changed products."""
+
+        terms = self.terms
+        postings = dict(terms.postings)
+        doc_terms, doc_len = dict(terms.doc_terms), dict(terms.doc_len)
+        cards = dict(self.cards)
+        copied = set()
+
+        def docs(token):
+            if token not in copied:
+                postings[token] = dict(postings.get(token, {}))
+                copied.add(token)
+            return postings[token]
+
+        for product in products:
+            for token in doc_terms.pop(product.id, ()):
+                docs(token).pop(product.id, None)
+            found, doc_len[product.id] = frequencies(product)
+            for token, tf in found.items():
+                docs(token)[product.id] = tf
+            doc_terms[product.id] = set(found)
+            cards[product.id] = product_card(product)
+
+        for token in copied:
+            if not postings[token]:
+                del postings[token]
+        vocabulary = (terms.vocabulary
+                      if postings.keys() == terms.postings.keys()
+                      else sorted(postings))
+        self.terms = Terms(postings, doc_terms, doc_len,
+                           sum(doc_len.values()), vocabulary)
+        self.cards = cards
+
+    @staticmethod
+    def expand(terms, token, prefix=False):
+        """{index term: weight} that a query token should match."""
+
+        matches = {}
+        if token in terms.postings:
+            matches[token] = 1.0
+
+        if prefix:
+            vocabulary = terms.vocabulary
+            i = bisect_left(vocabulary, token)
+            while i < len(vocabulary) and vocabulary[i].startswith(token):
+                matches.setdefault(vocabulary[i], PREFIX_WEIGHT)
+                i += 1
+
+        if not matches and len(token) >= 4:
+            max_edits = 1 if len(token) < 8 else 2
+            for candidate in terms.postings:
+                if within_edits(token, candidate, max_edits):
+                    matches[candidate] = FUZZY_WEIGHT
+        return matches
+
+    @staticmethod
+    def _bm25(terms, token, product_id, tf):
+        count = len(terms.doc_len)
+        df = len(terms.postings[token])
+        idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+        avg_len = terms.total_len / count
+        norm = K1 * (1 - B + B * terms.doc_len[product_id] / avg_len)
+        return idf * tf * (K1 + 1) / (tf + norm)
+
+    def search(self, query):
+        """Ranked [(product id, score)] for products matching every word."""
+
+        terms = self.terms
+        tokens = tokenize(query)
+        if not tokens or not terms.doc_len:
+            return []
+
+        scores = None
+        for position, token in enumerate(tokens):
+            token_scores = {}
+            is_last = position == len(tokens) - 1
+            for match, weight in self.expand(terms, token, prefix=is_last).items():
+                for product_id, tf in terms.postings[match].items():
+                    score = weight * self._bm25(terms, match, product_id, tf)
+                    if score > token_scores.get(product_id, 0.0):
+                        token_scores[product_id] = score
+
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {product_id: score + token_scores[product_id]
+                          for product_id, score in scores.items()
+                          if product_id in token_scores}
+            if not scores:
+                return []
+
+        return sorted(scores.items(), key=lambda hit: (-hit[1], hit[0]))
+
+
+search_index = SearchIndex()
+
+
+def current_search_index():
+    """The worker's search index, refreshed like the browse index."""
+
+    return search_index.refresh_if_due(
+        current_app.config['BROWSE_INDEX_REFRESH'])
@@ -0,0 +1,330 @@
+"""Server-side sessions.
+
+The session cookie holds only a random session id; the data (the
+logged-in user and profile version, flash messages) lives in a store
+chosen by SESSION_BACKEND:
+
+- 'database' keeps it in the sessions table, shared by every worker
+  (and every host) using the app database. Each worker also keeps the
+  rows it read or wrote for SESSION_CACHE_TTL seconds, so a logout or
+  login through another worker reaches it within that time
+- 'memory' keeps it in the worker process; for the dev server and tests
+- 'cookie' keeps Flask's signed-cookie session
+
+Sessions load lazily: a request that never reads `session` doesn't hit
+the store, and one without a session cookie never does (app.py doesn't
+look up the user for static files, images or autocomplete). A session is
+written only when it changed or is past half its lifetime (to push the
+expiry out), and the cookie is only set when the id is new. Expired
+rows are deleted SESSION_SWEEP_BATCH at a time, at most every
+SESSION_SWEEP_INTERVAL seconds per worker, or with `flask sessions sweep`.
+"""
+
+import secrets
+import threading
+import time
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from sqlalchemy import delete, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from cache import MemoryCache
+from models import db, StoredSession
+
+
+sessions_cli = AppGroup('sessions', help='Manage server-side sessions.')
+
+serializer = TaggedJSONSerializer()
+
+
+class SessionStore:
+    """Shared counters; subclasses store (data, expires_at) by sid."""
+
+    def __init__(self):
+        self.reads = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.deletes = 0
+        self.expired = 0
+
+    def load(self, sid):
+        """(data dict, expires_at) for a live `sid`, or None."""
+
+        raise NotImplementedError
+
+    def save(self, sid, data, expires_at):
+        raise NotImplementedError
+
+    def delete(self, sid):
+        raise NotImplementedError
+
+    def sweep(self, batch):
+        """Delete up to `batch` expired sessions; returns how many."""
+
+        raise NotImplementedError
+
+    def stats(self):
+        return {'reads': self.reads, 'hits': self.hits, 'misses': self.misses,
+                'writes': self.writes, 'deletes': self.deletes,
+                'expired': self.expired}
+
+
+class MemorySessionStore(SessionStore):
+    """Sessions in a dict in this worker."""
+
+    def __init__(self):
+        super().__init__()
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        self.reads += 1
+        with self._lock:
+            entry = self._sessions.get(sid)
+        if entry is None or entry[1] <= datetime.utcnow():
+            self.misses += 1
+            return None
+        return serializer.loads(entry[0]), entry[1]
+
+    def save(self, sid, data, expires_at):
+        self.writes += 1
+        with self._lock:
+            self._sessions[sid] = (serializer.dumps(data), expires_at)
+
+    def delete(self, sid):
+        self.deletes += 1
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def sweep(self, batch):
+        now = datetime.utcnow()
+        with self._lock:
+            expired = [sid for sid, (_, expires_at) in self._sessions.items()
+                       if expires_at <= now][:batch]
+            for sid in expired:
+                del self._sessions[sid]
+        self.expired += len(expired)
+        return len(expired)
+
+
+class DatabaseSessionStore(SessionStore):
+    """Sessions in the sessions table.
+
+    Uses its own connection, so it never touches the view's transaction.
+    With a `cache_ttl`, rows this worker read or wrote are kept (still
+    serialized, so every load gets its own dict) for that many seconds;
+    `hits` counts loads answered from there, `reads` the ones that
+    queried the table.
+    """
+
+    def __init__(self, cache_size=1024, cache_ttl=0):
+        super().__init__()
+        self._cache = MemoryCache(cache_size, cache_ttl) if cache_ttl else None
+
+    def load(self, sid):
+        if self._cache is not None:
+            found, entry = self._cache.get(sid)
+            if found and entry[1] > datetime.utcnow():
+                self.hits += 1
+                return serializer.loads(entry[0]), entry[1]
+
+        self.reads += 1
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                select(StoredSession.data, StoredSession.expires_at)
+                .where(StoredSession.sid == sid,
+                       StoredSession.expires_at > datetime.utcnow())).first()
+        if row is None:
+            self.misses += 1
+            return None
+        if self._cache is not None:
+            self._cache.set(sid, (row.data, row.expires_at))
+        return serializer.loads(row.data), row.expires_at
+
+    def save(self, sid, data, expires_at):
+        self.writes += 1
+        data = serializer.dumps(data)
+        if self._cache is not None:
+            self._cache.set(sid, (data, expires_at))
+        with db.engine.begin() as conn:
+            module = postgresql if conn.dialect.name == 'postgresql' else sqlite
+            stmt = module.insert(StoredSession).values(
+                sid=sid, data=data, expires_at=expires_at)
+            conn.execute(stmt.on_conflict_do_update(
+                index_elements=['sid'],
+                set_={'data': stmt.excluded.data,
+                      'expires_at': stmt.excluded.expires_at}))
+
+    def delete(self, sid):
+        self.deletes += 1
+        if self._cache is not None:
+            self._cache.delete(sid)
+        with db.engine.begin() as conn:
+            conn.execute(delete(StoredSession).where(StoredSession.sid == sid))
+
+    def sweep(self, batch):
+        expired = (select(StoredSession.sid)
+                   .where(StoredSession.expires_at <= datetime.utcnow())
+                   .limit(batch))
+        with db.engine.begin() as conn:
+            count = conn.execute(delete(StoredSession).where(
+                StoredSession.sid.in_(expired.scalar_subquery()))).rowcount
+        self.expired += count
+        return count
+
+
+class ServerSession(SessionMixin):
+    """A session whose data is only fetched from the store when used."""
+
+    def __init__(self, store, sid=None):
+        self.store = store
+        self.sid = sid
+        self.cookie_sid = sid
+        self.expires_at = None
+        self.new = sid is None
+        self.modified = False
+        self.accessed = False
+        self._data = None
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    @property
+    def data(self):
+        if self._data is None:
+            found = self.store.load(self.sid) if self.sid else None
+            if found is None:
+                # unknown or expired: never reuse an id the client made up
+                self.sid = None
+                self.new = True
+                self._data = {}
+            else:
+                self._data, self.expires_at = found
+        self.accessed = True
+        return self._data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def rotate(self):
+        """Move the data to a new id (call on login)."""
+
+        self.data  # load it under the old id first
+        self.new = True
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, store, sweep_interval=300, sweep_batch=500):
+        self.store = store
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self._last_sweep = time.monotonic()
+
+    def open_session(self, app, request):
+        return ServerSession(self.store,
+                             request.cookies.get(self.get_cookie_name(app)))
+
+    def save_session(self, app, session, response):
+        if not session.loaded:
+            return
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.sid:
+                self.store.delete(session.sid)
+            if session.cookie_sid:
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        lifetime = app.permanent_session_lifetime
+        now = datetime.utcnow()
+        stale = (session.expires_at is None
+                 or session.expires_at - now < lifetime / 2)
+        if not (session.modified or session.new or stale):
+            return
+
+        if session.new:
+            if session.sid:
+                self.store.delete(session.sid)
+            session.sid = secrets.token_urlsafe(32)
+        self.store.save(session.sid, dict(session.data), now + lifetime)
+        self.maybe_sweep()
+
+        if session.new:
+            response.set_cookie(
+                name, session.sid, expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app), domain=domain,
+                path=path, secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app))
+
+    def maybe_sweep(self):
+        if time.monotonic() - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = time.monotonic()
+        self.store.sweep(self.sweep_batch)
+
+
+def init_sessions(app):
+    """Install the SESSION_BACKEND store; returns it (None for 'cookie')."""
+
+    backend = app.config['SESSION_BACKEND']
+    if backend == 'cookie':
+        return None
+    if backend == 'memory':
+        store = MemorySessionStore()
+    elif backend == 'database':
+        store = DatabaseSessionStore(app.config['SESSION_CACHE_SIZE'],
+                                     app.config['SESSION_CACHE_TTL'])
+    else:
+        raise ValueError(f"unknown SESSION_BACKEND {backend!r}")
+
+    app.session_interface = ServerSessionInterface(
+        store, app.config['SESSION_SWEEP_INTERVAL'],
+        app.config['SESSION_SWEEP_BATCH'])
+    return store
+
+
+def rotate_session(session):
+    """Give the session a new id if it is server-side."""
+
+    if isinstance(session, ServerSession):
+        session.rotate()
+
+
+@sessions_cli.command('sweep')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Sessions deleted per statement.')
+def sweep_command(batch_size):
+    """Delete every expired session from the database."""
+
+    store = DatabaseSessionStore()
+    while store.sweep(batch_size) == batch_size:
+        pass
+    click.echo(f"Deleted {store.expired} expired sessions.")
@@ -0,0 +1,76 @@
+"""Change-detected snapshots of upstream per-product fields.
+
+Every catalog sync or import passes its records through
+`record_snapshots`, which hashes the fields in FIELDS for each product
+and compares the hash with the stored one. Only products whose hash
+changed are written, so an unchanged sync costs one SELECT per batch and
+no writes. The rows that were written carry `changed_at`, and
+`changed_since(ts)` answers "which products changed after ts" from its
+index, for anything downstream that needs to invalidate by product.
+"""
+
+import hashlib
+import json
+from datetime import datetime
+
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import ProductSnapshot
+
+
+FIELDS = ('price', 'price_sign', 'rating', 'product_link', 'website_link',
+          'image_link', 'api_featured_image')
+
+
+def snapshot_values(record):
+    """The snapshot fields of an upstream product record."""
+
+    return {field: record.get(field) for field in FIELDS}
+
+
+def stored_values(snapshot):
+    """The snapshot fields of a ProductSnapshot row."""
+
+    return {field: getattr(snapshot, field) for field in FIELDS}
+
+
+def content_hash(values):
+    data = json.dumps([values[field] for field in FIELDS], default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def upsert(conn):
+    module = postgresql if conn.dialect.name == 'postgresql' else sqlite
+    stmt = module.insert(ProductSnapshot.__table__)
+    return stmt.on_conflict_do_update(
+        index_elements=['product_id'],
+        set_={name: stmt.excluded[name] for name in
+              FIELDS + ('content_hash', 'changed_at')})
+
+
+def record_snapshots(conn, records):
+    """Store the snapshots of `records` that changed; returns how many."""
+
+    rows = {}
+    for record in records:
+        values = snapshot_values(record)
+        rows[record['id']] = dict(values, product_id=record['id'],
+                                  content_hash=content_hash(values))
+
+    stored = dict(conn.execute(
+        select(ProductSnapshot.product_id, ProductSnapshot.content_hash)
+        .where(ProductSnapshot.product_id.in_(rows))).all())
+    now = datetime.utcnow()
+    changed = [dict(row, changed_at=now) for product_id, row in rows.items()
+               if stored.get(product_id) != row['content_hash']]
+    if changed:
+        conn.execute(upsert(conn), changed)
+    return len(changed)
+
+
+def changed_since(timestamp):
+    """SELECT of the ids of products whose snapshot changed after `timestamp`."""
+
+    return (select(ProductSnapshot.product_id)
+            .where(ProductSnapshot.changed_at > timestamp))
@@ -0,0 +1,94 @@
+"""Test configuration: the app on a temporary SQLite database seeded from
+fixtures/products.json, with a SQL query budget on every request."""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURE = os.path.join(HERE, 'fixtures', 'products.json')
+TMP = tempfile.mkdtemp(prefix='makeupfinder-tests-')
+
+# app.py reads its settings from the environment at import time.
+os.environ.update({
+    'DATABASE_URL': f"sqlite:///{os.path.join(TMP, 'test.db')}",
+    'SECRET_KEY': 'test',
+    'CATALOG_SOURCE': FIXTURE,
+    'CATALOG_SYNC_INTERVAL': '0',
+    'RECOMMENDATIONS_REFRESH_INTERVAL': '0',
+    # nothing listens here: upstream calls fail at once
+    'MAKEUP_API_URL': 'http://127.0.0.1:9/api/v1',
+    'UPSTREAM_RETRIES': '0',
+    'SQL_QUERY_BUDGET': '10',
+    'SESSION_BACKEND': 'memory',
+    'PASSWORD_WORKERS': '0',
+    'BCRYPT_LOG_ROUNDS': '4',
+    # every test logs in from 127.0.0.1
+    'LOGIN_RATE_LIMIT': '1000',
+    'IMAGE_CACHE_DIR': os.path.join(TMP, 'images'),
+    'LOG_LEVEL': 'WARNING',
+})
+os.environ.pop('FLASK_DEBUG', None)
+sys.path.insert(0, HERE)
+
+from app import app as flask_app  # noqa: E402
+from catalog import sync_catalog  # noqa: E402
+from migrations import upgrade  # noqa: E402
+from models import db, User, Favorite  # noqa: E402
+
+PASSWORD = 'password'
+
+
+class FakeImage:
+    """A streamed image response, for stubbing the /img client."""
+
+    headers = {'Content-Type': 'image/png'}
+
+    def iter_content(self, size):
+        return [b'not really a png']
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(scope='session')
+def app():
+    flask_app.config['WTF_CSRF_ENABLED'] = False
+    with flask_app.app_context():
+        upgrade()
+        sync_catalog(FIXTURE)
+    return flask_app
+
+
+@pytest.fixture
+def user(app):
+    """A new user with two favorites; removed after the test."""
+
+    with app.app_context():
+        user = User.signup(username=f'user{os.urandom(4).hex()}',
+                           email='user@example.com', password=PASSWORD,
+                           image_url=None)
+        db.session.flush()
+        db.session.add_all([Favorite(user_id=user.id, product_id=product_id)
+                            for product_id in (1048, 1047)])
+        db.session.commit()
+        user_id, username = user.id, user.username
+    yield user_id, username
+    with app.app_context():
+        db.session.delete(db.session.get(User, user_id))
+        db.session.commit()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def logged_in(app, user):
+    client = app.test_client()
+    res = client.post('/login', data={'username': user[1], 'password': PASSWORD})
+    assert res.status_code == 302
+    return client
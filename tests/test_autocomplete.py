@@ -0,0 +1,34 @@
+"""Prefix completions."""
+
+from autocomplete import Autocomplete
+
+
+def test_complete_ranks_by_popularity():
+    completions = Autocomplete()
+    completions.build({'Lippie Pencil': 3, 'Lip Liner': 5, 'Vegan': 9,
+                       'Blotted Lip': 1})
+    assert completions.complete('li') == ['Lip Liner', 'Lippie Pencil',
+                                          'Blotted Lip']
+    assert completions.complete('penc') == ['Lippie Pencil']
+    assert completions.complete('', limit=1) == ['Vegan']
+    assert completions.complete('lip  li') == ['Lip Liner']
+
+
+def test_rebuild_replaces_one_reference():
+    completions = Autocomplete()
+    completions.build({'Lippie Pencil': 1}, version=1)
+    before = completions.completions
+
+    completions.build({'Mascara': 1}, version=2)
+    assert completions.complete('ma') == ['Mascara']
+    assert completions.complete('lip') == []
+    assert completions.version == 2
+    # a reader that took the old build keeps a consistent one
+    assert before.phrases == ['Lippie Pencil'] and before.version == 1
+    assert before.top['li'] == [0]
+
+
+def test_autocomplete_endpoint(client):
+    res = client.get('/_autocomplete?prefix=lippie')
+    assert res.status_code == 200
+    assert 'Lippie Pencil' in res.json
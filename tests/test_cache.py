@@ -0,0 +1,110 @@
+"""TTL + LRU caches and fill coalescing."""
+
+import os
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import cache as cache_module
+from cache import FileCache, MemoryCache, normalize_key
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Stands in for the time module in cache.py; advance `now` by hand."""
+
+    clock = SimpleNamespace(now=1000.0)
+    clock.monotonic = clock.time = lambda: clock.now
+    monkeypatch.setattr(cache_module, 'time', clock)
+    return clock
+
+
+def test_normalize_key():
+    assert (normalize_key('tag', 'Cruelty+Free ')
+            == normalize_key('tag', 'cruelty free'))
+
+
+def test_memory_ttl(clock):
+    cache = MemoryCache(ttl=10)
+    cache.set('a', 1)
+    clock.now += 9
+    assert cache.get('a') == (True, 1)
+    clock.now += 2
+    assert cache.get('a') == (False, None)
+    assert len(cache) == 0
+
+
+def test_memory_lru():
+    cache = MemoryCache(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') == (False, None)
+    assert cache.get('a') == (True, 1) and cache.get('c') == (True, 3)
+    assert cache.evictions == 1
+
+
+def test_concurrent_misses_fill_once():
+    cache = MemoryCache()
+    started, release = threading.Event(), threading.Event()
+    calls, results = [], []
+
+    def fill():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'value'
+
+    threads = [threading.Thread(
+        target=lambda: results.append(cache.get_or_fill('key', fill)))
+        for _ in range(5)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert calls == [1] and results == ['value'] * 5
+    assert (cache.misses, cache.coalesced + cache.hits) == (1, 4)
+    assert cache._key_locks == {}
+
+
+def test_file_ttl(tmp_path, clock):
+    cache = FileCache(str(tmp_path), ttl=10)
+    cache.set('a', {'x': 1})
+    assert cache.get('a') == (True, {'x': 1})
+    assert FileCache(str(tmp_path)).get('a') == (True, {'x': 1})
+    clock.now += 11
+    assert cache.get('a') == (False, None)
+    assert len(cache) == 0
+
+
+def test_file_lru_by_mtime(tmp_path):
+    cache = FileCache(str(tmp_path), max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    os.utime(cache._path('a'), (1, 1))
+    cache.set('c', 3)
+    assert cache.get('a') == (False, None)
+    assert cache.get('b') == (True, 2) and cache.get('c') == (True, 3)
+    assert cache.evictions == 1
+
+
+def test_file_eviction_keeps_held_lock_files(tmp_path):
+    cache = FileCache(str(tmp_path), max_entries=1)
+    cache.get_or_fill('free', lambda: 1)
+    lock_path = cache._path('free', '.lock')
+    assert os.path.exists(lock_path)
+
+    with cache._fill_lock('held'):
+        cache.set('held', 2)  # evicts 'free'
+        assert not os.path.exists(lock_path)
+        cache.set('other', 3)  # evicts 'held' while it is being filled
+        assert os.path.exists(cache._path('held', '.lock'))
+
+    # the next fill of 'held' takes the same lock file
+    assert cache.get_or_fill('held', lambda: 4) == 4
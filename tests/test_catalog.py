@@ -0,0 +1,86 @@
+"""Catalog sync into the local tables."""
+
+import json
+
+import pytest
+
+from catalog import (apply_records, catalog_version, import_catalog,
+                     iter_json_array, sync_catalog)
+from conftest import FIXTURE
+from instrumentation import assert_max_queries
+from models import db, Product
+
+
+def test_resync_statements_dont_grow_with_products(app):
+    with open(FIXTURE) as f:
+        records = json.load(f)
+    for record in records:
+        record['name'] += ' (new)'
+
+    with app.app_context():
+        # products with their tags, brands, categories, tags, one
+        # executemany UPDATE
+        with assert_max_queries(6):
+            apply_records(records)
+            db.session.flush()
+        db.session.rollback()
+
+
+def test_resync_of_same_data_is_unchanged(app, tmp_path):
+    with open(FIXTURE) as f:
+        records = json.load(f)
+    source = tmp_path / 'products.json'
+
+    with app.app_context():
+        version = catalog_version()
+        source.write_text(json.dumps(records))
+        assert sync_catalog(str(source)).status == 'unchanged'
+        assert catalog_version() == version
+
+        records[0]['price'] = '99.0'
+        source.write_text(json.dumps(records))
+        assert sync_catalog(str(source)).status == 'ok'
+        assert catalog_version() != version
+        assert sync_catalog(FIXTURE).status == 'ok'
+
+
+def test_iter_json_array_streams_across_chunks():
+    text = '[{"id": 1, "name": "a, [b]"},\n {"id": 2, "tags": ["x"]} ]'
+    for size in (1, 3, len(text)):
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        assert [item['id'] for item in iter_json_array(chunks)] == [1, 2]
+    assert list(iter_json_array(['[', ']'])) == []
+
+    with pytest.raises(ValueError):
+        list(iter_json_array(['{"id": 1}']))
+    with pytest.raises(ValueError):
+        list(iter_json_array(['[{"id": 1}, {"id"']))
+
+
+def test_reimport_is_idempotent(app):
+    with app.app_context():
+        version = catalog_version()
+        run, importer = import_catalog(FIXTURE, batch_size=7)
+        assert run.status == 'unchanged'
+        assert importer.changed == 0 and importer.snapshots == 0
+        assert catalog_version() == version
+
+
+def test_duplicate_ids_in_a_batch_keep_the_last(app, tmp_path):
+    with open(FIXTURE) as f:
+        records = json.load(f)
+    first = records[0]
+    renamed = dict(first, name=first['name'] + ' (renamed)', tag_list=[])
+    source = tmp_path / 'products.json'
+    source.write_text(json.dumps([first] + records[1:] + [renamed]))
+
+    with app.app_context():
+        run, importer = import_catalog(str(source), batch_size=len(records) + 1)
+        assert run.status == 'ok'
+        assert importer.products == len(records)
+        product = db.session.get(Product, first['id'])
+        assert product.name == renamed['name'] and product.tag_names == []
+
+        assert import_catalog(FIXTURE)[0].status == 'ok'
+        db.session.expire_all()
+        assert db.session.get(Product, first['id']).name == first['name']
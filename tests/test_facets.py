@@ -0,0 +1,81 @@
+"""Faceted filtering over bitsets."""
+
+from types import SimpleNamespace
+
+from facet_index import FacetIndex, PRICE_EDGES
+
+
+def product(id, brand, product_type, tags, price):
+    return SimpleNamespace(id=id, name=f'product {id}', brand=brand,
+                           product_type=product_type, tag_names=tags,
+                           price=price, image_link=None, api_featured_image=None)
+
+
+PRODUCTS = [
+    product(1, 'colourpop', 'lipstick', ['Vegan'], '5.0'),
+    product(2, 'colourpop', 'lipstick', ['Vegan', 'Natural'], '12.0'),
+    product(3, 'nyx', 'lipstick', ['Natural'], '30.0'),
+    product(4, 'nyx', 'eyeliner', [], '150.0'),
+    product(5, 'nyx', 'eyeliner', ['Vegan'], None),
+    product(6, 'dior', 'mascara', [], 'not a price'),
+]
+
+
+def index():
+    facets = FacetIndex()
+    facets.build(PRODUCTS)
+    return facets
+
+
+def counts(result, name):
+    return {entry['value']: entry['count'] for entry in result[name]}
+
+
+def price_counts(result):
+    return [entry['count'] for entry in result['price']]
+
+
+def test_no_filter_counts_everything():
+    ids, result = index().filter()
+    assert ids.tolist() == [1, 2, 3, 4, 5, 6]
+    assert counts(result, 'brand') == {'nyx': 3, 'colourpop': 2, 'dior': 1}
+    assert counts(result, 'tag') == {'Vegan': 3, 'Natural': 2}
+    assert [entry['min'] for entry in result['price']] == list(PRICE_EDGES)
+
+
+def test_brands_or_tags_and():
+    facets = index()
+    ids, result = facets.filter(brands=['colourpop', 'NYX'], tags=['Vegan'])
+    assert ids.tolist() == [1, 2, 5]
+    # a facet's counts ignore its own filter
+    assert counts(result, 'brand') == {'colourpop': 2, 'nyx': 1}
+    assert counts(result, 'product_type') == {'lipstick': 2, 'eyeliner': 1}
+
+    ids, _ = facets.filter(tags=['Vegan', 'Natural'])
+    assert ids.tolist() == [2]
+    ids, _ = facets.filter(tags=['Vegan', 'no such tag'])
+    assert ids.tolist() == []
+
+
+def test_products_without_a_price_are_in_no_bucket():
+    facets = index()
+    _, result = facets.filter()
+    assert price_counts(result) == [1, 1, 1, 0, 1]
+
+    # every bucket's count is what filtering on that range returns
+    for entry in result['price']:
+        high = entry['max'] - 0.01 if entry['max'] is not None else None
+        ids, _ = facets.filter(min_price=entry['min'], max_price=high)
+        assert len(ids) == entry['count']
+
+
+def test_price_range_and_update():
+    facets = index()
+    ids, result = facets.filter(min_price=10, max_price=50)
+    assert ids.tolist() == [2, 3]
+    # the price facet is counted without the price filter
+    assert sum(price_counts(result)) == 4
+
+    facets.update([product(5, 'nyx', 'eyeliner', ['Vegan'], '20.0')])
+    ids, _ = facets.filter(min_price=10, max_price=50)
+    assert ids.tolist() == [2, 3, 5]
@@ -0,0 +1,63 @@
+"""Favorites pages and the favorites JSON API."""
+
+from sqlalchemy import update
+
+from conftest import PASSWORD
+from models import db, Favorite, User
+from upstream import upstream_client
+
+
+def test_favorites_page_uses_local_products(app, logged_in, user, monkeypatch):
+    calls = []
+    with app.app_context():
+        monkeypatch.setattr(upstream_client(), 'submit_json',
+                            lambda url, **kwargs: calls.append(url))
+
+    res = logged_in.get(f'/users/{user[0]}/favorites')
+    assert res.status_code == 200
+    assert b'Lippie Pencil' in res.data and b'Blotted Lip' in res.data
+    assert calls == []
+
+
+def test_change_reaches_other_sessions(app, user):
+    first, second = app.test_client(), app.test_client()
+    for client in (first, second):
+        client.post('/login', data={'username': user[1], 'password': PASSWORD})
+    assert second.get('/api/favorites').json['favorites'] == [1047, 1048]
+    etag = second.get('/products').headers['ETag']
+
+    res = first.post('/api/favorites', json={'add': [495], 'remove': [1047]})
+    assert res.json['favorites'] == [495, 1048]
+
+    assert second.get('/api/favorites').json['favorites'] == [495, 1048]
+    assert second.get('/products').headers['ETag'] != etag
+
+
+def test_version_is_bumped_with_the_change(app, logged_in, user):
+    with app.app_context():
+        before = db.session.get(User, user[0]).favorites_version
+    logged_in.post('/api/favorites/1048')  # toggles it off
+    logged_in.post('/api/favorites', json={'add': [1048, 999999]})
+    logged_in.post('/api/favorites', json={'remove': [999999]})  # no change
+    with app.app_context():
+        assert db.session.get(User, user[0]).favorites_version == before + 2
+
+
+def test_toggle_ignores_a_stale_cached_set(app, logged_in, user):
+    assert logged_in.post('/api/favorites/1048').json['favorited'] is False
+    logged_in.get('/api/favorites')  # caches the set without 1048
+
+    # another worker favorites it again; this worker's caches don't hear
+    with app.app_context():
+        db.session.add(Favorite(user_id=user[0], product_id=1048))
+        db.session.execute(update(User).where(User.id == user[0]).values(
+            favorites_version=User.favorites_version + 1))
+        db.session.commit()
+
+    res = logged_in.post('/api/favorites/1048')
+    assert res.status_code == 200 and res.json['favorited'] is False
+    res = logged_in.post('/api/favorites/1048')
+    assert res.status_code == 200 and res.json['favorited'] is True
+
+    assert logged_in.post('/api/favorites/999999').status_code == 404
+    assert logged_in.post('/products/999999/favorite').status_code == 404
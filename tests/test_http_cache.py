@@ -0,0 +1,59 @@
+"""Cache headers and the rendered page cache."""
+
+import re
+
+from flask import render_template_string
+from flask_wtf.csrf import generate_csrf
+
+from http_cache import cached_page
+
+
+def csrf_token(res):
+    return re.search(rb'name="csrf_token" type="hidden" value="([^"]+)"',
+                     res.data).group(1)
+
+
+def test_homepage_form_tokens_are_per_session(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'WTF_CSRF_ENABLED', True)
+    first, second = app.test_client(), app.test_client()
+
+    pages = [client.get('/') for client in (first, second)]
+    assert csrf_token(pages[0]) != csrf_token(pages[1])
+    assert all('public' not in res.headers['Cache-Control'] for res in pages)
+
+    res = second.post('/', data={'name': 'Vegan', 'submit': 'Submit',
+                                 'csrf_token': csrf_token(pages[1])})
+    assert res.status_code == 302
+
+
+def test_pages_with_a_csrf_token_are_not_stored(app):
+    pages = app.extensions['http_cache']['pages']
+    with app.test_request_context('/brands'):
+        cached_page(pages, 'with-token',
+                    lambda: render_template_string('{{ token }}',
+                                                   token=generate_csrf()))
+        assert pages.get('with-token') == (False, None)
+
+    with app.test_request_context('/brands'):
+        cached_page(pages, 'without-token', lambda: 'catalog')
+        assert pages.get('without-token')[0]
+
+
+def test_catalog_pages_are_public_for_anonymous_visitors(client):
+    res = client.get('/brands')
+    assert res.headers['Cache-Control'].startswith('public, max-age=')
+    assert client.get('/brands', headers={'If-None-Match': res.headers['ETag']}
+                      ).status_code == 304
+
+
+def test_cache_stats_need_the_token(app, client, monkeypatch):
+    assert client.get('/_cache_stats').status_code == 404
+
+    monkeypatch.setitem(app.config, 'STATS_TOKEN', 'secret')
+    assert client.get('/_cache_stats').status_code == 401
+    res = client.get('/_cache_stats',
+                     headers={'Authorization': 'Bearer wrong'})
+    assert res.status_code == 401
+    res = client.get('/_cache_stats',
+                     headers={'Authorization': 'Bearer secret'})
+    assert res.status_code == 200 and 'pages' in res.json
@@ -0,0 +1,67 @@
+"""Image cache and the /img view."""
+
+import os
+import threading
+
+import requests
+
+import images
+from conftest import FakeImage
+from images import ImageCache
+
+
+def test_evict_keeps_held_locks(tmp_path):
+    cache = ImageCache(str(tmp_path), max_bytes=0)
+    acquired = threading.Event()
+
+    def make_file():
+        with cache.lock('name'):
+            acquired.set()
+
+    with cache.lock('name'):
+        cache.put('other', b'x')  # over max_bytes: evicts
+        thread = threading.Thread(target=make_file)
+        thread.start()
+        assert not acquired.wait(0.1)
+    thread.join()
+    assert acquired.is_set()
+    assert cache._locks == {}
+
+
+def test_original_evicted_after_fetch_is_fetched_again(app, client, monkeypatch):
+    extension = app.extensions['images']
+    downloads = []
+    monkeypatch.setattr(extension['client'], 'get',
+                        lambda url, **kwargs: downloads.append(url) or FakeImage())
+
+    fetch = images.fetch
+
+    def fetch_then_evict(extension, url):
+        digest, content_type = fetch(extension, url)
+        if len(downloads) == 1:
+            os.remove(extension['cache'].path(digest))
+        return digest, content_type
+
+    monkeypatch.setattr(images, 'fetch', fetch_then_evict)
+
+    res = client.get('/img/1047/small')
+    assert res.status_code == 200
+    assert res.data == b'not really a png'
+    assert len(downloads) == 2
+
+
+class DroppedImage(FakeImage):
+    def iter_content(self, size):
+        yield b'half a png'
+        raise requests.exceptions.ChunkedEncodingError('connection reset')
+
+
+def test_dropped_download_redirects_to_the_original(app, client, monkeypatch):
+    extension = app.extensions['images']
+    monkeypatch.setattr(extension['client'], 'get',
+                        lambda url, **kwargs: DroppedImage())
+
+    res = client.get('/img/495/small')
+    assert res.status_code == 302
+    with app.test_request_context():
+        assert res.location == images.product_source(495)
@@ -0,0 +1,26 @@
+"""Keyset pagination links."""
+
+import re
+
+
+def next_link(res):
+    found = re.search(r'href="([^"]*)" class="btn btn-primary">Next',
+                      res.get_data(as_text=True))
+    return found and found.group(1).replace('&amp;', '&')
+
+
+def test_next_page_keeps_view_args(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, 'PAGE_SIZE', 2)
+
+    # ?name= clashes with the view's own `name` argument
+    res = client.get('/brands/colourpop?name=x&sort=id')
+    assert res.status_code == 200
+    assert re.fullmatch(r'/brands/colourpop\?sort=id&after=\d+', next_link(res))
+
+
+def test_last_page_has_no_next_link(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, 'PAGE_SIZE', 48)
+
+    res = client.get('/brands/colourpop')
+    assert res.status_code == 200
+    assert next_link(res) is None
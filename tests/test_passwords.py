@@ -0,0 +1,20 @@
+"""Login rate limiting."""
+
+from flask import current_app
+
+
+def test_limit_counts_the_forwarded_client(app, client, monkeypatch):
+    with app.app_context():
+        limiter = current_app.extensions['passwords']['limiter']
+    monkeypatch.setattr(limiter, 'window', 10 ** 9)  # one window for the test
+    monkeypatch.setattr(limiter, 'limit', 3)
+
+    def login(ip, username):
+        return client.post('/login', headers={'X-Forwarded-For': ip},
+                           data={'username': username, 'password': 'not-the-password'})
+
+    for i in range(3):
+        assert login('203.0.113.7', f'nobody{i}').status_code != 429
+    assert login('203.0.113.7', 'nobody').status_code == 429
+    # the proxy's own address is not what is being limited
+    assert login('203.0.113.8', 'nobody').status_code != 429
@@ -0,0 +1,66 @@
+"""The product page."""
+
+from concurrent.futures import Future
+
+import pytest
+
+from catalog import sync_catalog
+from conftest import FIXTURE
+from models import db, ProductSnapshot
+from upstream import upstream_client
+
+
+@pytest.fixture
+def without_snapshot(app):
+    with app.app_context():
+        db.session.delete(db.session.get(ProductSnapshot, 1047))
+        db.session.commit()
+    yield 1047
+    with app.app_context():
+        sync_catalog(FIXTURE)
+
+
+def fetch_returning(app, monkeypatch, outcome):
+    """Stub submit_json; returns the URLs it was asked for."""
+
+    urls = []
+
+    def submit_json(url, **kwargs):
+        urls.append(url)
+        future = Future()
+        if isinstance(outcome, Exception):
+            future.set_exception(outcome)
+        else:
+            future.set_result(outcome)
+        return future
+
+    with app.app_context():
+        monkeypatch.setattr(upstream_client(), 'submit_json', submit_json)
+    return urls
+
+
+def test_snapshot_skips_the_api(app, logged_in, monkeypatch):
+    urls = fetch_returning(app, monkeypatch, {})
+    res = logged_in.get('/products/1048')
+    assert res.status_code == 200 and urls == []
+
+
+def test_no_snapshot_fetches_the_record(app, logged_in, without_snapshot,
+                                        monkeypatch):
+    record = {'id': 1047, 'name': 'Blotted Lip', 'brand': 'colourpop',
+              'price': '77.7', 'price_sign': '$', 'rating': None,
+              'product_link': '', 'website_link': '', 'description': '',
+              'tag_list': [], 'image_link': '', 'api_featured_image': ''}
+    urls = fetch_returning(app, monkeypatch, record)
+    res = logged_in.get(f'/products/{without_snapshot}')
+    assert res.status_code == 200
+    assert b'$77.70' in res.data
+    assert [url.rsplit('/', 1)[-1] for url in urls] == ['1047.json']
+
+
+def test_bad_upstream_body_keeps_the_local_row(app, logged_in,
+                                               without_snapshot, monkeypatch):
+    fetch_returning(app, monkeypatch, ValueError('not JSON'))
+    res = logged_in.get(f'/products/{without_snapshot}')
+    assert res.status_code == 200
+    assert b'Blotted Lip' in res.data
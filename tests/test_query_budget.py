@@ -0,0 +1,48 @@
+"""SQL statements per request on the product, profile and favorites views.
+
+Every request also runs under SQL_QUERY_BUDGET (see conftest.py); these
+pin the views that used to load collections one row at a time.
+"""
+
+import re
+
+from instrumentation import assert_max_queries
+from models import db, Review
+
+
+def add_reviews(app, user_id, product_id, count):
+    with app.app_context():
+        db.session.add_all([Review(text=f'review {i}', user_id=user_id,
+                                   product_id=product_id)
+                            for i in range(count)])
+        db.session.commit()
+
+
+def test_product_page(app, logged_in, user):
+    add_reviews(app, user[0], 1048, 5)
+    logged_in.get('/products/1048')  # warm the per-worker caches
+
+    # the product with its snapshot and neighbors, then the reviews with
+    # their authors
+    with assert_max_queries(2):
+        res = logged_in.get('/products/1048')
+    assert res.status_code == 200
+    assert b'review 4' in res.data
+
+
+def test_profile_counts(app, logged_in, user):
+    add_reviews(app, user[0], 1047, 3)
+
+    # the user and two counts; neither collection is loaded
+    with assert_max_queries(3):
+        res = logged_in.get(f'/users/{user[0]}')
+    assert res.status_code == 200
+    assert re.search(rb'/reviews"\s*>3<', res.data)
+    assert re.search(rb'/favorites"\s*>2<', res.data)
+
+
+def test_favorites_page(logged_in, user):
+    # favorites, the user and their products in one IN query
+    with assert_max_queries(3):
+        res = logged_in.get(f'/users/{user[0]}/favorites')
+    assert res.status_code == 200
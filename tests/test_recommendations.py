@@ -0,0 +1,67 @@
+"""Co-occurrence scoring and the product_neighbors rows."""
+
+import numpy as np
+import pytest
+
+from models import db, ProductNeighbors
+from recommendations import (cooccurrences, cosine, neighbor_ids,
+                             refresh_stale, top_neighbors)
+
+
+# user 1 likes 10, 20; user 2 likes 10, 20, 30; user 3 only 30
+USERS = np.array([1, 1, 2, 2, 2, 3])
+PRODUCTS = np.array([20, 10, 30, 10, 20, 30])
+
+
+def test_cooccurrences():
+    a, b, counts = cooccurrences(USERS, PRODUCTS)
+    assert list(zip(a.tolist(), b.tolist(), counts.tolist())) == [
+        (10, 20, 2), (10, 30, 1), (20, 10, 2), (20, 30, 1),
+        (30, 10, 1), (30, 20, 1)]
+
+    a, b, counts = cooccurrences(USERS, PRODUCTS, rows=np.array([30]))
+    assert (a.tolist(), b.tolist(), counts.tolist()) == ([30, 30], [10, 20],
+                                                         [1, 1])
+
+
+def test_cooccurrences_without_pairs():
+    a, b, counts = cooccurrences(np.array([1, 2]), np.array([10, 20]))
+    assert len(a) == len(b) == len(counts) == 0
+
+
+def test_cosine_and_top_neighbors():
+    a, b, counts = cooccurrences(USERS, PRODUCTS)
+    liked_ids, liked_counts = np.unique(PRODUCTS, return_counts=True)
+    scores = cosine(a, b, counts, liked_ids, liked_counts)
+    # every product is liked twice: 2 / sqrt(2 * 2) and 1 / sqrt(2 * 2)
+    assert scores.tolist() == [1.0, 0.5, 1.0, 0.5, 0.5, 0.5]
+
+    best = {product_id: (ids.tolist(), values.tolist())
+            for product_id, ids, values in top_neighbors(a, b, scores, 1)}
+    assert best == {10: ([20], [1.0]), 20: ([10], [1.0]), 30: ([10], [0.5])}
+
+    ranked = {product_id: ids.tolist()
+              for product_id, ids, _ in top_neighbors(a, b, scores, 5)}
+    assert ranked == {10: [20, 30], 20: [10, 30], 30: [10, 20]}
+
+
+def stored(product_id):
+    return db.session.get(ProductNeighbors, product_id)
+
+
+def test_favorite_marks_stale_and_refresh_recomputes(app, logged_in, user):
+    res = logged_in.post('/api/favorites', json={'add': [495]})
+    assert res.json['added'] == [495]
+
+    with app.app_context():
+        assert all(stored(product_id).stale for product_id in (495, 1047, 1048))
+
+        with db.engine.begin() as conn:
+            stale, written = refresh_stale(conn, k=12)
+        assert stale >= 3 and written >= 3
+        db.session.expire_all()
+        row = stored(495)
+        assert not row.stale
+        assert set(neighbor_ids(row)) >= {1047, 1048}
+        assert np.frombuffer(row.scores, '<f4') == pytest.approx(
+            sorted(np.frombuffer(row.scores, '<f4'), reverse=True))
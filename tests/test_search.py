@@ -0,0 +1,56 @@
+"""Full-text search index."""
+
+from types import SimpleNamespace
+
+from search_index import SearchIndex
+
+
+def product(id, name, brand='nyx', tags=(), description=''):
+    return SimpleNamespace(id=id, name=name, brand=brand, tag_names=list(tags),
+                           description=description, product_type='lipstick',
+                           image_link=None, api_featured_image=None)
+
+
+def index():
+    search = SearchIndex()
+    search.build([product(1, 'Lippie Pencil', 'colourpop', ['Vegan']),
+                  product(2, 'Matte Lipstick'),
+                  product(3, 'Blotted Lip', 'colourpop')])
+    return search
+
+
+def ids(search, query):
+    return [product_id for product_id, _ in search.search(query)]
+
+
+def test_ranking_prefix_and_typos():
+    search = index()
+    assert ids(search, 'colourpop lip') == [3, 1]
+    assert ids(search, 'lippie penc') == [1]
+    assert ids(search, 'pencel') == [1]
+    assert ids(search, 'vegan matte') == []
+
+
+def test_update_swaps_in_a_new_copy():
+    search = index()
+    before = search.terms
+
+    search.update([product(2, 'Glossy Lipstick'),
+                   product(4, 'Pencil Liner', 'dior')])
+    assert ids(search, 'glossy') == [2]
+    assert ids(search, 'matte') == []
+    assert sorted(ids(search, 'pencil')) == [1, 4]
+    assert 'matte' not in search.terms.vocabulary
+    assert 'liner' in search.terms.vocabulary
+    assert search.terms.total_len == sum(search.terms.doc_len.values())
+
+    # a search that started before the update still sees the old index
+    assert 'matte' in before.postings and 4 not in before.doc_len
+    assert before.postings['pencil'] == {1: 3.0}
+    assert sorted(search.cards) == [1, 2, 3, 4]
+
+
+def test_search_page(client):
+    res = client.get('/search?q=lippie+penc')
+    assert res.status_code == 200
+    assert b'Lippie Pencil' in res.data
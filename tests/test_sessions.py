@@ -0,0 +1,38 @@
+"""Server-side session store reads."""
+
+from datetime import datetime, timedelta
+
+from app import session_store
+from conftest import FakeImage
+from sessions import DatabaseSessionStore
+
+
+def test_assets_dont_read_the_session(app, logged_in, monkeypatch):
+    monkeypatch.setattr(app.extensions['images']['client'], 'get',
+                        lambda url, **kwargs: FakeImage())
+    before = session_store.reads
+    logged_in.get('/static/makeup.css')
+    logged_in.get('/img/1048/small')
+    logged_in.get('/_autocomplete?prefix=li')
+    assert session_store.reads == before
+
+    logged_in.get('/products')
+    assert session_store.reads == before + 1
+
+
+def test_database_store_keeps_rows_it_used(app):
+    expires_at = datetime.utcnow() + timedelta(hours=1)
+    with app.app_context():
+        worker, other = (DatabaseSessionStore(cache_ttl=60),
+                         DatabaseSessionStore(cache_ttl=60))
+        worker.save('sid', {'user': 1}, expires_at)
+        assert worker.load('sid') == ({'user': 1}, expires_at)
+        assert (worker.reads, worker.hits) == (0, 1)
+
+        assert other.load('sid')[0] == {'user': 1}
+        assert other.load('sid')[0] == {'user': 1}
+        assert (other.reads, other.hits) == (1, 1)
+
+        worker.delete('sid')
+        assert worker.load('sid') is None
+        assert worker.reads == 1
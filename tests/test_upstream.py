@@ -0,0 +1,95 @@
+"""The upstream client's retries and circuit breaker."""
+
+import time
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import upstream
+from upstream import (CircuitBreaker, CircuitOpenError, UpstreamClient,
+                      UpstreamError)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Stands in for the time module in upstream.py; advance `now` by hand."""
+
+    clock = SimpleNamespace(now=1000.0, perf_counter=time.perf_counter,
+                            sleep=time.sleep)
+    clock.monotonic = lambda: clock.now
+    monkeypatch.setattr(upstream, 'time', clock)
+    return clock
+
+
+def test_breaker_opens_and_closes(clock):
+    breaker = CircuitBreaker(threshold=2, reset_after=30)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    clock.now += 30
+    assert breaker.state == 'half-open'
+    breaker.before_call()  # the one trial call
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    breaker.before_call()
+
+
+def test_failed_trial_opens_again(clock):
+    breaker = CircuitBreaker(threshold=5, reset_after=30)
+    for _ in range(5):
+        breaker.record_failure()
+    clock.now += 31
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+
+class FakeSession:
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def get(self, url, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return SimpleNamespace(status_code=outcome, url=url, close=lambda: None)
+
+
+def client_with(session, **kwargs):
+    client = UpstreamClient(retries=1, backoff=0, **kwargs)
+    client._session, client._session_pid = session, upstream.os.getpid()
+    return client
+
+
+def test_retries_then_trips_the_breaker(app, clock):
+    session = FakeSession(*[requests.ConnectionError('refused'), 503] * 2)
+    client = client_with(session, breaker_threshold=2)
+    with app.app_context():
+        for _ in range(2):
+            with pytest.raises(UpstreamError):
+                client.get('http://upstream/products.json')
+        assert session.calls == 4
+        with pytest.raises(CircuitOpenError):
+            client.get('http://upstream/products.json')
+    assert session.calls == 4
+
+
+def test_client_errors_dont_trip_the_breaker(app, clock):
+    session = FakeSession(404, 404, 200)
+    client = client_with(session, breaker_threshold=1)
+    with app.app_context():
+        for _ in range(2):
+            with pytest.raises(UpstreamError):
+                client.get('http://upstream/missing.json')
+        assert client.get('http://upstream/products.json').status_code == 200
+    assert client.breaker.state == 'closed'
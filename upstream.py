@@ -0,0 +1,259 @@
+"""HTTP client for the makeup API.
+
+Every upstream call goes through one UpstreamClient per worker:
+
+- a pooled requests.Session (keep-alive, gzip) sized by UPSTREAM_POOL_SIZE
+- connect / read timeouts on every request
+- a bounded number of retries with jittered exponential backoff
+- a circuit breaker that fails fast while the API keeps failing
+- conditional GETs (If-None-Match / If-Modified-Since) so an unchanged
+  catalog costs a 304 instead of a full download
+- a small thread pool (UPSTREAM_FANOUT threads) so a view can start
+  several fetches, run its SQL, and then collect the responses
+"""
+
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from flask import current_app
+from requests.adapters import HTTPAdapter
+
+from instrumentation import add_timing
+
+
+class UpstreamError(requests.RequestException):
+    """The makeup API could not be reached or returned an error."""
+
+
+class CircuitOpenError(UpstreamError):
+    """Raised without calling upstream while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures.
+
+    While open, calls fail immediately. After `reset_after` seconds one
+    trial call is let through (half-open); success closes the breaker and
+    failure opens it again.
+    """
+
+    def __init__(self, threshold=5, reset_after=30):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_after:
+            return 'half-open'
+        return 'open'
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go upstream now."""
+
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return
+            if state == 'half-open' and not self._trial_running:
+                self._trial_running = True
+                return
+        raise CircuitOpenError("makeup API circuit breaker is open")
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class UpstreamClient:
+    """Pooled, timeout-bounded, retrying client for the makeup API."""
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, pool_size=10, connect_timeout=3.05, read_timeout=10,
+                 retries=2, backoff=0.25, breaker_threshold=5,
+                 breaker_reset=30, fanout=None):
+        self.pool_size = pool_size
+        self.fanout = fanout or pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+        self._session = None
+        self._session_pid = None
+        self._session_lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(pool_size=config['UPSTREAM_POOL_SIZE'],
+                   connect_timeout=config['UPSTREAM_CONNECT_TIMEOUT'],
+                   read_timeout=config['UPSTREAM_READ_TIMEOUT'],
+                   retries=config['UPSTREAM_RETRIES'],
+                   backoff=config['UPSTREAM_BACKOFF'],
+                   breaker_threshold=config['UPSTREAM_BREAKER_THRESHOLD'],
+                   breaker_reset=config['UPSTREAM_BREAKER_RESET'],
+                   fanout=config.get('UPSTREAM_FANOUT'))
+
+    @property
+    def session(self):
+        """The worker's Session, rebuilt after a fork so pools aren't shared."""
+
+        with self._session_lock:
+            if self._session is None or self._session_pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size,
+                                      pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers['Accept-Encoding'] = 'gzip, deflate'
+                self._session = session
+                self._session_pid = os.getpid()
+            return self._session
+
+    @property
+    def executor(self):
+        """The worker's fetch threads; like the Session, rebuilt after a fork."""
+
+        with self._session_lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.fanout, thread_name_prefix='upstream')
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _sleep_before_retry(self, attempt):
+        # "Full jitter": a random wait up to the exponential backoff.
+        time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def get(self, url, params=None, headers=None, timeout=None, stream=False):
+        """GET `url`, retrying transient failures.
+
+        Returns the Response for any 2xx or 304. Raises UpstreamError on
+        4xx, or once retries are used up, and CircuitOpenError without a
+        request while the breaker is open. With `stream` the body is left
+        unread for `res.iter_content()`.
+        """
+
+        self.breaker.before_call()
+
+        start = time.perf_counter()
+        try:
+            return self._get(url, params, headers, timeout or self.timeout,
+                             stream)
+        finally:
+            add_timing('upstream', time.perf_counter() - start)
+
+    def _get(self, url, params, headers, timeout, stream=False):
+        last_error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._sleep_before_retry(attempt - 1)
+            try:
+                res = self.session.get(url, params=params, headers=headers,
+                                       timeout=timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                last_error = e
+                continue
+            except requests.RequestException as e:
+                self.breaker.record_failure()
+                raise UpstreamError(f"GET {url} failed: {e}") from e
+
+            if res.status_code in self.RETRY_STATUSES:
+                last_error = UpstreamError(
+                    f"{res.status_code} from {res.url}", response=res)
+                res.close()
+                continue
+
+            if res.status_code >= 400:
+                # The API answered; a bad request isn't an outage.
+                self.breaker.record_success()
+                raise UpstreamError(f"{res.status_code} from {res.url}",
+                                    response=res)
+
+            self.breaker.record_success()
+            return res
+
+        self.breaker.record_failure()
+        raise UpstreamError(f"GET {url} failed: {last_error}")
+
+    def get_json(self, url, params=None, timeout=None):
+        """GET `url` and return the decoded JSON body."""
+
+        return self.get(url, params=params, timeout=timeout).json()
+
+    def submit_json(self, url, params=None, timeout=None):
+        """Start get_json(url) on the fetch threads; returns a Future.
+
+        Collect the results with `wait_json`.
+        """
+
+        return self.executor.submit(self.get_json, url, params, timeout)
+
+    def get_if_modified(self, url, etag=None, last_modified=None,
+                        timeout=None):
+        """Conditional GET using validators from an earlier response.
+
+        Check `res.status_code == 304` for "unchanged"; otherwise read the
+        body and keep `res.headers['ETag']` / `['Last-Modified']` for the
+        next call.
+        """
+
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return self.get(url, headers=headers, timeout=timeout)
+
+
+def wait_json(futures):
+    """Results of `submit_json` futures, in order.
+
+    A fetch that failed gives its UpstreamError (or ValueError for a body
+    that isn't JSON) in place of the data, so one bad record doesn't
+    sink the page. Time spent waiting counts as the request's upstream
+    time.
+    """
+
+    start = time.perf_counter()
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except (UpstreamError, ValueError) as e:
+            results.append(e)
+    add_timing('upstream', time.perf_counter() - start)
+    return results
+
+
+def init_upstream(app):
+    """Create the app's UpstreamClient from the UPSTREAM_* settings."""
+
+    app.extensions['upstream'] = UpstreamClient.from_config(app.config)
+    return app.extensions['upstream']
+
+
+def upstream_client():
+    """The current app's UpstreamClient."""
+
+    return current_app.extensions['upstream']